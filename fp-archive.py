@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import sys
+
+from pyflowerpower.history import History
+from pyflowerpower.archive import HistoryArchive, UNKNOWN_SESSION
+
+SCRIPT = 'fp-archive.py v1.0'
+
+'''
+fp-archive.py Copyright 2016 by gandy92@googlemail.com
+
+Maintains binary history archives (one per sensor, see pyflowerpower/archive.py)
+and converts history text files written by fp-download.py into this format.
+
+Usage:
+    python fp-archive.py import hist-ABCD-SID.dat [...]
+    python fp-archive.py list ABCD
+'''
+
+
+def short_id(filename):
+    m = re.match(r'hist-([^-]+)-\d+\.dat$', os.path.basename(filename))
+    if not m:
+        return None
+    return m.group(1)
+
+
+def import_files(archive_dir, filenames):
+    # oldest entries first, so later files only add what is new
+    histories = []
+    for fn in filenames:
+        short = short_id(fn)
+        if not short:
+            print("Can not determine sensor id from file name '%s', skipping." % fn)
+            continue
+        try:
+            history = History.from_text(fn)
+        except ValueError as e:
+            print("Problems reading %s:" % fn, e)
+            continue
+        histories.append((short, history.index(0), fn, history))
+
+    for short, first, fn, history in sorted(histories, key=lambda h: h[0:2]):
+        archive = HistoryArchive(os.path.join(archive_dir, short))
+        n = archive.append(history)
+        print("%s: %d of %d records added to archive %s" % (fn, n, len(history), short))
+
+
+def list_archive(archive_dir, short):
+    archive = HistoryArchive(os.path.join(archive_dir, short))
+    print("#%9s %8s %10s %7s %6s" % ('offset', 'count', 'first', 'session', 'period'))
+    for e in archive.entries:
+        session = e.session == UNKNOWN_SESSION and '?' or str(e.session)
+        print("%10d %8d %10d %7s %6d" % (e.offset, e.count, e.first_index, session, e.period))
+    print("# %d records, last index %d" % (sum(e.count for e in archive.entries), archive.last_index()))
+
+
+parser = argparse.ArgumentParser(prog=SCRIPT, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-d', '--dir', default='archive',
+                    help='directory holding the archives')
+parser.add_argument('command', choices=['import', 'list'],
+                    help='import history text files or list the index of an archive')
+parser.add_argument('args', nargs='+',
+                    help='history text files (import) or short sensor ids (list)')
+args = parser.parse_args()
+
+if args.command == 'import':
+    import_files(args.dir, args.args)
+elif args.command == 'list':
+    for short in args.args:
+        if not os.path.exists(os.path.join(args.dir, short + '.fpi')):
+            print("No archive for sensor %s in %s." % (short, args.dir))
+            sys.exit(-1)
+        list_archive(args.dir, short)
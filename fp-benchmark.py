@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pyflowerpower.sensor import PlantSensor
+from pyflowerpower.state import HandleCache
+from pyflowerpower.simulator import FakePeripheral
+
+try:
+    from time import process_time
+except ImportError:
+    from time import clock as process_time
+
+SCRIPT = 'fp-benchmark.py v1.0'
+
+'''
+fp-benchmark.py Copyright 2016 by gandy92@googlemail.com
+
+Measures sensor setup and history transfers against simulated sensors (see
+pyflowerpower/simulator.py), so no hardware is needed:
+
+  setup-discover  PlantSensor setup with service discovery
+  setup-cached    PlantSensor setup with handles from the handle cache
+  receive         FPUpload.receive of the full history
+  receive-async   concurrent transfers of several sensors with pyflowerpower.aioupload
+
+For each, wall clock and CPU time per run are reported, for transfers also frames per
+second. Received data is compared to what the simulated sensor sent, the exit code
+is 1 if any transfer was incomplete or wrong.
+'''
+
+
+class Quiet:
+    """Suppress the progress output of the transfer code while measuring."""
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def fake(opts, n=0):
+    return FakePeripheral(addr='a0:14:3d:00:00:%02x' % (n + 1), entries=opts.entries, latency=opts.latency,
+                          interval=opts.interval, jitter=opts.jitter, loss=opts.loss,
+                          write_delay=opts.write_delay, seed=opts.seed + n)
+
+
+def measure(name, runs, func):
+    """Call func runs times, func returns (ok, frames, requests), return the result summary."""
+    wall = cpu = 0.0
+    frames = requests = failed = 0
+    for i in range(0, runs):
+        t0, c0 = time.time(), process_time()
+        with Quiet():
+            ok, n, r = func()
+        wall += time.time() - t0
+        cpu += process_time() - c0
+        frames += n
+        requests += r
+        failed += not ok
+    result = {
+        'name': name,
+        'runs': runs,
+        'failed': failed,
+        'wall': wall / runs,
+        'cpu': cpu / runs,
+        'requests': float(requests) / runs,
+        'frames_per_second': frames / wall if frames and wall > 0 else 0.0,
+    }
+    print("%-15s %5d %7.4f %7.4f %9.1f %10.0f %s" %
+          (name, runs, result['wall'], result['cpu'], result['requests'], result['frames_per_second'],
+           failed and 'FAILED %d' % failed or 'ok'))
+    return result
+
+
+def requests(p):
+    return sum(p.requests.values())
+
+
+def bench_setup(opts, cache=None):
+    def run():
+        p = fake(opts)
+        ps = PlantSensor(p.addr, cache=cache, peripheral=p)
+        return ps.upload is not None, 0, requests(p)
+    return run
+
+
+def bench_receive(opts):
+    def run():
+        p = fake(opts)
+        ps = PlantSensor(p.addr, peripheral=p)
+        setup = requests(p)
+        ps.upload.receive(count=opts.entries)
+        ok = ps.upload.raw() == p.buffer(p.last_index - opts.entries + 1)
+        return ok, ps.upload.stats.frames + ps.upload.stats.duplicates, requests(p) - setup
+    return run
+
+
+def bench_receive_async(opts):
+    from pyflowerpower.aioupload import receive_all
+
+    def run():
+        fakes = [fake(opts, n) for n in range(0, opts.sensors)]
+        sensors = [PlantSensor(p.addr, peripheral=p) for p in fakes]
+        setup = sum(requests(p) for p in fakes)
+        uploads = receive_all(sensors, count=opts.entries)
+        ok = True
+        frames = 0
+        for p, upload in zip(fakes, uploads):
+            if isinstance(upload, Exception):
+                ok = False
+                continue
+            ok = ok and upload.data == p.buffer(p.last_index - opts.entries + 1)
+            frames += upload.stats.frames + upload.stats.duplicates
+        return ok, frames, sum(requests(p) for p in fakes) - setup
+    return run
+
+
+parser = argparse.ArgumentParser(prog=SCRIPT, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-n', '--entries', type=int, default=4096,
+                    help='history entries of the simulated sensor')
+parser.add_argument('-r', '--repeat', type=int, default=5,
+                    help='runs per measurement')
+parser.add_argument('--latency', type=float, default=0.0,
+                    help='notification latency in seconds')
+parser.add_argument('--interval', type=float, default=0.0,
+                    help='minimal interval between notifications in seconds')
+parser.add_argument('--jitter', type=float, default=0.0,
+                    help='maximal random delay added to each notification in seconds')
+parser.add_argument('--loss', type=float, default=0.0,
+                    help='probability of losing a data frame')
+parser.add_argument('--write-delay', type=float, default=0.0,
+                    help='time a write request takes in seconds')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed for jitter and loss')
+parser.add_argument('--sensors', type=int, default=4,
+                    help='number of concurrent sensors for receive-async, 0 to skip')
+parser.add_argument('--json',
+                    help='also write the results to this file')
+opts = parser.parse_args()
+
+print("%-15s %5s %7s %7s %9s %10s" % ('#benchmark', 'runs', 'wall/s', 'cpu/s', 'requests', 'frames/s'))
+results = []
+results.append(measure('setup-discover', opts.repeat, bench_setup(opts)))
+handle_dir = tempfile.mkdtemp()
+try:
+    cache = HandleCache(os.path.join(handle_dir, 'handles.json'))
+    with Quiet():
+        bench_setup(opts, cache)()
+    results.append(measure('setup-cached', opts.repeat, bench_setup(opts, cache)))
+finally:
+    shutil.rmtree(handle_dir)
+results.append(measure('receive', opts.repeat, bench_receive(opts)))
+if opts.sensors > 0 and sys.version_info >= (3, 5):
+    results.append(measure('receive-async', opts.repeat, bench_receive_async(opts)))
+
+if opts.json:
+    with open(opts.json, 'w') as f:
+        json.dump({'script': SCRIPT, 'options': vars(opts), 'results': results}, f, indent=1)
+
+sys.exit(any(r['failed'] for r in results) and 1 or 0)
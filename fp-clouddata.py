@@ -1,208 +1,211 @@
 #!/usr/bin/python3
 
-import requests
+from concurrent.futures import ProcessPoolExecutor
 from datetime import *
-from dateutil import parser as dateparser
 import json
+import os
 from pprint import pformat
 import argparse
-import string
-import sys
+
+from pyflowerpower.cloud import CLIENTS, SampleColumns, get_client
+from pyflowerpower.cloudcache import SampleCache
+from pyflowerpower.cassette import Cassette
+from pyflowerpower.correlate import read_sensor_file, select_sessions, merge_ranges, write_comparison
 
 SCRIPT = 'fp-clouddata.py v1.0'
 
 debug = 0
 
 
-def read_sensor_data_file(filename):
-    params = {}
-    data = []
-    head = ""
-    lines = open(filename).read().split('\n')
-    print("Reading from %s..." % filename)
-    for n, line in enumerate(lines):
-        if len(line) < 1:
-            continue
-        if line[0] == '#':
-            head += line + '\n'
-            if ': ' in line:
-                key, value = line[1:].strip().split(': ')
-                params[key] = value
-            elif ',' in line and '=' in line:
-                for kv in line[1:].strip().split(','):
-                    if '=' in kv:
-                        key, value = kv.split('=')
-                        params[key] = value
-        else:
-            dvec = line.split(' ')[8:14]
-            if int(dvec[0]) == 0x8000:
-                print("new session %d starts in line %d." % (int(dvec[1]), n))
-                if len(data) > 0:
-                    print("Dropping data from previous session with %d entries." % (len(data)))
-                data = []
-            data.append(dvec)
-
-    return params, data, head
-
-
-def fetch_cloud_samples_oldapi(credentials, sens_id, from_ts, to_ts):
-    credentials['grant_type'] = 'password'
-
-    req = requests.get(credentials['url']+'/user/v1/authenticate', data=credentials)
-    access_token = req.json()["access_token"]
-    a_header = {'Authorization': 'Bearer ' + access_token}
-
-    req = requests.get(credentials['url']+'/sensor_data/v3/sync', headers=a_header)
-
-    location_id = None
-    for data in req.json()[u'locations']:
-        if u'sensor_serial' in data:
-            sens, loc = data[u'sensor_serial'], data[u'location_identifier']
-            if sens[-len(sens_id):] == sens_id:
-                location_id = loc
-
-    if not location_id:
-        print("Could not find location with sensor %s. Bailing out." % sens_id)
-        return ()
-
-    3 <= debug and print(location_id)
-    # i = 0
-    # cloud sample timestamps are in utc
-    ts_1 = datetime.utcfromtimestamp(from_ts)
-    ts_e = datetime.utcfromtimestamp(to_ts)
-    titles = ['air_temp', 'par_umole_m2s', 'vwc_percent', 'utc']
-    data = {}
-    while ts_1 < ts_e:
-        ts_2 = ts_1 + timedelta(days=7, seconds=-1)
-        if ts_2 > ts_e:
-            ts_2 = ts_e
-        req = requests.get(credentials['url']+'/sensor_data/v2/sample/location/' + location_id,
-                           headers=a_header, params={'from_datetime_utc': ts_1,
-                                                     'to_datetime_utc': ts_2})
-        4 <= debug and print('Server response: \n {0}'.format(pformat(req.json())))
-        ts_1 = ts_2
-        for sample in req.json()['samples']:
-            cts = sample['capture_ts']
-            dt = dateparser.parse(cts)
-            ts = int(dt.timestamp()) # - (datetime.now() - datetime.utcnow()).total_seconds())
-            data[ts] = (sample['air_temperature_celsius'], sample['par_umole_m2s'], sample['vwc_percent'], cts)
-
-    return titles, data
-
-
-def fetch_cloud_samples_newapi(credentials, sens_id, from_ts, to_ts):
-    credentials['grant_type'] = 'password'
-
-    req = requests.get(credentials['url']+'/user/v1/authenticate', data=credentials)
-    access_token = req.json()["access_token"]
-    a_header = {'Authorization': 'Bearer ' + access_token}
-
-    req = requests.get(credentials['url']+'/garden/v2/configuration', headers=a_header)
-
-    location_id = None
-    for data in req.json()[u'locations']:
-        if u'sensor' in data and u'sensor_identifier' in data[u'sensor']:
-            sens, loc = data[u'sensor'][u'sensor_identifier'], data[u'location_identifier']
-            if sens[-len(sens_id):] == sens_id:
-                location_id = loc
-
-    if not location_id:
-        print("Could not find location with sensor %s. Bailing out." % sens_id)
-        return ()
-
-    3 <= debug and print(location_id)
-    # i = 0
-    # cloud sample timestamps are in utc
-    ts_1 = datetime.utcfromtimestamp(from_ts)
-    ts_e = datetime.utcfromtimestamp(to_ts)
-
-    titles = ['air_temp', 'light_level', 'moisture_percent', 'fertilizer_level', 'battery', 'utc']
-    data = {}
-    while ts_1 < ts_e:
-        ts_2 = ts_1 + timedelta(days=7, seconds=-1)
-        if ts_2 > ts_e:
-            ts_2 = ts_e
-        req = requests.get(credentials['url']+'/sensor_data/v6/sample/location/' + location_id,
-                           headers=a_header, params={'from_datetime_utc': ts_1,
-                                                     'to_datetime_utc': ts_2})
-        4 <= debug and print('Server response: \n {0}'.format(pformat(req.json())))
-        ts_1 = ts_2
-        for sample in req.json()['samples']:
-            cts = sample['capture_datetime_utc']
-            dt = dateparser.parse(cts)
-            ts = int(dt.timestamp()) # - (datetime.now() - datetime.utcnow()).total_seconds())
-            data[ts] = (sample['air_temperature_celsius'],
-                        sample['light'],
-                        sample['soil_moisture_percent'],
-                        sample['fertilizer_level'],
-                        sample['battery_percent'],
-                        cts)
-
-    return titles, data
-
-
-def fetch_cloud_samples(profile, sens_id, from_ts, to_ts):
+def cloud_client(profile):
+    """Return the client of profile, shared by all files."""
     # todo: create credentials.json if missing and exit with message to fill it in.
     profiles = json.loads(open('credentials.json').read())
     if profile not in profiles.keys():
         print("Error: profile '%s' not defined in 'credentials.json'. Bailing out." % profile)
         exit(-1)
     credentials = profiles[profile]
-    if credentials['method'] == 'oldapi':
-        return fetch_cloud_samples_oldapi(credentials, sens_id, from_ts, to_ts)
-    elif credentials['method'] == 'newapi':
-        return fetch_cloud_samples_newapi(credentials, sens_id, from_ts, to_ts)
-    print("Error: unknon method '%s' in profile '%s'. Bailing out." % (credentials['method'], profile))
-    exit(-2)
+    if credentials['method'] not in CLIENTS:
+        print("Error: unknon method '%s' in profile '%s'. Bailing out." % (credentials['method'], profile))
+        exit(-2)
+    return get_client(profile, credentials, concurrency=args.concurrency, rate=args.rate,
+                      retries=args.retries, backoff=args.backoff, cache=cache,
+                      cassette=cassette, replay=bool(args.replay))
+
+
+def comp_filename(profile, sens_id, sid):
+    return 'comp-%s-%s-%03d.dat' % (profile, sens_id, sid)
+
+
+def session_jobs(sf):
+    """Yield (session, first_ts, tolerance, from_ts, to_ts) for the selected sessions of a SensorFile."""
+    selected = select_sessions(sf.sessions, args.sessions)
+    for session, first_ts in zip(sf.sessions, sf.times):
+        if session not in selected:
+            continue
+        if first_ts is None:
+            print("%s: skipping %d records of unknown session." % (sf.filename, session.end - session.start))
+            continue
+        last_ts = first_ts + session.period * (session.end - session.start - 1)
+        tolerance = args.tolerance or session.period / 2
+        yield session, first_ts, tolerance, int(first_ts - tolerance), int(last_ts + tolerance)
+
+
+def print_stats(stats):
+    print('matched %d cloud samples, %d unmatched, %d records without cloud sample' %
+          (stats['matched'], stats['unmatched_samples'], stats['unmatched_records']))
+    if stats['matched']:
+        print('cloud time - sensor time: median %+.0f s, mean %+.1f s, std %.1f s, range %+d..%+d s' %
+              (stats['offset_median'], stats['offset_mean'], stats['offset_std'],
+               stats['offset_min'], stats['offset_max']))
 
 
 def handle_data(profile, filename):
-    sens_id = 'ABCD'
-    params, data, head = read_sensor_data_file(filename)
-    sens_addr = params['sensor addr']
-    if len(sens_addr.split(":")) == 6:
-        sens_id = ''.join(sens_addr.split(":")[4:]).upper()
-    sid = int(params['sid'])
-    print("sens_id =", sens_id)
-    2 <= debug and print(pformat(params))
-    5 <= debug and print(pformat(data))
-    startup = int(params['current time']) - int(params['sensor time'])
-    last_ts = startup + int(params['lts'])
-    first_ts = last_ts - int(params['sp'])*(len(data)-1)
-
-    column_titles, cdata = fetch_cloud_samples(profile, sens_id, first_ts-450, last_ts+450)
-    3 <= debug and print(pformat(cdata))
-
-    f = open('comp-%s-%s-%03d.dat' % (profile, sens_id, sid), 'w')
-    f.write('# Cloud samples collected by %s\n' % SCRIPT)
-    f.write(''.join(filter(lambda x: x in string.printable, head)))  # remove non-printable characters
-    f.write('#timestamp idx h0 h1 h2 h3 h4 h5 '+(' '.join(column_titles))+'\n')
-
-    for ts in sorted(cdata.keys()):
-        idx = int((ts - first_ts) / int(params['sp']) + 0.5)
-        if 0 <= idx < len(data):
-            2 <= debug and print(ts, idx, ' '.join(map(str, data[idx])), ' '.join(map(str, cdata[ts])))
-            f.write('%d\t%d\t%s\t%s\n' % (ts, idx, '\t'.join(map(str, data[idx])), '\t'.join(map(str, cdata[ts]))))
-
-    f.close()
-
-    print('sensor data ranges starts at %s (ts=%d)' % (str(datetime.fromtimestamp(first_ts)), first_ts))
-    print('                 and ends at %s (ts=%d)' % (str(datetime.fromtimestamp(last_ts)), last_ts))
+    print("Reading from %s..." % filename)
+    sf = read_sensor_file(filename)
+    print("sens_id =", sf.sens_id)
+    2 <= debug and print(pformat(sf.params))
+    client = cloud_client(profile)
+
+    for session, first_ts, tolerance, from_ts, to_ts in session_jobs(sf):
+        data = sf.records[session.start:session.end]
+        print("session %d: %d records" % (session.session, len(data)))
+        5 <= debug and print(pformat(data))
+        cdata = client.samples(sf.sens_id, from_ts, to_ts)
+        if cdata is None:
+            return
+        3 <= debug and print(pformat(list(cdata.rows())))
+
+        stats = write_comparison(comp_filename(profile, sf.sens_id, session.session), SCRIPT, sf.head,
+                                 data, first_ts, session.period, cdata, tolerance)
+        print_stats(stats)
+
+        last_ts = first_ts + session.period*(len(data)-1)
+        print('sensor data ranges starts at %s (ts=%d)' % (str(datetime.fromtimestamp(first_ts)), first_ts))
+        print('                 and ends at %s (ts=%d)' % (str(datetime.fromtimestamp(last_ts)), last_ts))
 
     1 <= debug and print(datetime.utcnow())
     1 <= debug and print(datetime.now())
 
 
+def handle_batch(profile, filenames):
+    """Correlate many files: read and write them in a process pool, fetch each sensor's samples once."""
+    client = cloud_client(profile)
+    summary = []
+    with ProcessPoolExecutor(max_workers=args.jobs or None) as pool:
+        jobs = []
+        futures = [(fn, pool.submit(read_sensor_file, fn)) for fn in filenames]
+        for fn, future in futures:
+            try:
+                sf = future.result()
+            except Exception as e:
+                print("%s: %s" % (fn, e))
+                summary.append({'file': fn, 'error': str(e)})
+                continue
+            for job in session_jobs(sf):
+                jobs.append((sf,) + job)
+        print("%d sessions in %d files" % (len(jobs), len(filenames)))
+
+        # overlapping ranges of a sensor are fetched once
+        samples = {}
+        for sens_id in sorted(set(sf.sens_id for sf, session, first_ts, tolerance, from_ts, to_ts in jobs)):
+            ranges = merge_ranges((from_ts, to_ts) for sf, session, first_ts, tolerance, from_ts, to_ts in jobs
+                                  if sf.sens_id == sens_id)
+            parts = [client.samples(sens_id, from_ts, to_ts) for from_ts, to_ts in ranges]
+            if any(part is None for part in parts):
+                samples[sens_id] = None
+            else:
+                samples[sens_id] = SampleColumns.concat(parts[0].titles, parts)
+                print("%s: %d cloud samples in %d ranges" % (sens_id, len(samples[sens_id]), len(ranges)))
+
+        futures = []
+        for sf, session, first_ts, tolerance, from_ts, to_ts in jobs:
+            entry = {'file': sf.filename, 'sensor': sf.sens_id, 'session': session.session,
+                     'records': session.end - session.start}
+            cdata = samples[sf.sens_id]
+            if cdata is None:
+                entry['error'] = 'no cloud location'
+                summary.append(entry)
+                continue
+            entry['output'] = comp_filename(profile, sf.sens_id, session.session)
+            futures.append((entry, pool.submit(write_comparison, entry['output'], SCRIPT, sf.head,
+                                               sf.records[session.start:session.end], first_ts,
+                                               session.period, cdata.select(from_ts, to_ts), tolerance)))
+        for entry, future in futures:
+            try:
+                entry.update(future.result())
+            except Exception as e:
+                entry['error'] = str(e)
+            summary.append(entry)
+
+    print("#%-29s %-6s %7s %8s %7s %9s %8s %s" %
+          ('file', 'sensor', 'session', 'records', 'matched', 'unmatched', 'offset', 'output'))
+    for e in summary:
+        if 'error' in e:
+            print("%-30s %-6s %7s %8s %s" % (e['file'], e.get('sensor', '-'), e.get('session', '-'),
+                                             e.get('records', '-'), e['error']))
+        else:
+            print("%-30s %-6s %7d %8d %7d %9d %+7.0fs %s" %
+                  (e['file'], e['sensor'], e['session'], e['records'], e['matched'], e['unmatched_records'],
+                   e.get('offset_median', 0), e['output']))
+    print("%d requests to the cloud" % client.requests)
+    if args.summary:
+        with open(args.summary + '.tmp', 'w') as f:
+            json.dump(summary, f, indent=4)
+        os.rename(args.summary + '.tmp', args.summary)
+    return summary
+
+
 parser = argparse.ArgumentParser(prog=SCRIPT, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('-p', '--profile', required=True,
                     help='use specified API profile as defined in credentials.json')
+parser.add_argument('-c', '--concurrency', type=int, default=4,
+                    help='number of parallel requests to the cloud')
+parser.add_argument('--rate', type=float, default=5.0,
+                    help='maximum number of requests per second, 0 for no limit')
+parser.add_argument('--retries', type=int, default=3,
+                    help='retries of a failed request')
+parser.add_argument('--backoff', type=float, default=1.0,
+                    help='delay before the first retry in seconds, doubled on every further retry')
+parser.add_argument('-s', '--sessions', default='last',
+                    help="sessions to correlate: 'last', 'all' or a comma separated list of session ids")
+parser.add_argument('--tolerance', type=float, default=0,
+                    help='maximum time between a cloud sample and a history record to match them, in seconds '
+                         '(0: half the session period)')
+parser.add_argument('--cache', default='fp-cloudcache.sqlite',
+                    help='cache of fetched cloud samples, empty to disable')
+parser.add_argument('--settle', type=float, default=24.0,
+                    help='hours after which cloud samples are complete and the range need not be fetched again')
+parser.add_argument('--record', default='',
+                    help='record the cloud responses in this cassette file')
+parser.add_argument('--replay', default='',
+                    help='replay the cloud responses from this cassette file instead of accessing the cloud')
+parser.add_argument('-b', '--batch', action='store_const', const=1, default=0,
+                    help='batch mode: read and write files in parallel processes and fetch each sensor once')
+parser.add_argument('-j', '--jobs', type=int, default=0,
+                    help='number of processes in batch mode, 0 for one per CPU')
+parser.add_argument('--summary', default='',
+                    help='write a json summary of the batch to this file')
 parser.add_argument('file', nargs='+',
                     help='downloaded sensor data')
-args = parser.parse_args()
 
+# worker processes may import this script, only the main process runs it
+if __name__ == '__main__':
+    args = parser.parse_args()
 
+    cache = SampleCache(args.cache, settle=args.settle * 3600) if args.cache else None
+    if args.record and args.replay:
+        parser.error('--record and --replay exclude each other')
+    cassette = Cassette(args.record or args.replay) if args.record or args.replay else None
 
-
-for fn in args.file:
-    handle_data(args.profile, fn)
+    try:
+        if args.batch:
+            handle_batch(args.profile, args.file)
+        else:
+            for fn in args.file:
+                handle_data(args.profile, fn)
+    finally:
+        if args.record:
+            cassette.save()
+            print("Recorded %d responses in %s" % (len(cassette), args.record))
 
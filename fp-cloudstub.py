@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+from __future__ import print_function
+
+import argparse
+import json
+
+from pyflowerpower.cassette import Cassette
+from pyflowerpower.cloudstub import CloudStub
+
+SCRIPT = 'fp-cloudstub.py v1.0'
+
+'''
+fp-cloudstub.py Copyright 2016 by gandy92@googlemail.com
+
+Run a local stand-in for the Parrot cloud API, serving the responses of a cassette
+recorded with fp-clouddata.py --record, or synthetic samples for the given sensors.
+Point the "url" of a profile in credentials.json (method "oldapi" or "newapi") to
+http://HOST:PORT to run fp-clouddata.py against it.
+'''
+
+parser = argparse.ArgumentParser(prog=SCRIPT, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--host', default='127.0.0.1',
+                    help='address to listen on')
+parser.add_argument('--port', type=int, default=8765,
+                    help='port to listen on')
+parser.add_argument('--cassette', default='',
+                    help='serve the responses recorded in this cassette instead of synthetic data')
+parser.add_argument('-s', '--sensor', action='append', default=[],
+                    help='serial number of a sensor to serve synthetic data for, may be repeated')
+parser.add_argument('--interval', type=int, default=900,
+                    help='seconds between synthetic samples')
+parser.add_argument('--jitter', type=int, default=60,
+                    help='maximum deviation of synthetic sample times in seconds')
+parser.add_argument('--max-days', type=float, default=7.0,
+                    help='longest time range a sample request may ask for, longer ones fail with HTTP 400, '
+                         '0 for no limit')
+parser.add_argument('--latency', type=float, default=0.0,
+                    help='delay of every response in seconds')
+parser.add_argument('--error-rate', type=float, default=0.0,
+                    help='fraction of requests failing with HTTP 503')
+parser.add_argument('--expires-in', type=int, default=3600,
+                    help='lifetime of access tokens in seconds')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed for synthetic data and errors')
+args = parser.parse_args()
+
+cassette = None
+if args.cassette:
+    cassette = Cassette(args.cassette)
+    print("Serving %d responses from %s" % (len(cassette), args.cassette))
+elif not args.sensor:
+    parser.error('either --cassette or --sensor is required')
+else:
+    print("Serving synthetic data for %s" % ', '.join(args.sensor))
+
+stub = CloudStub(args.sensor, cassette=cassette, interval=args.interval, jitter=args.jitter,
+                 latency=args.latency, max_window=int(args.max_days * 86400), error_rate=args.error_rate,
+                 expires_in=args.expires_in, seed=args.seed)
+server = stub.server((args.host, args.port))
+print("Listening on http://%s:%d" % server.server_address[:2])
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+server.server_close()
+print(json.dumps({'requests': stub.requests, 'errors': stub.errors}))
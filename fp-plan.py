@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+from __future__ import print_function
+
+import argparse
+import json
+from time import time, strftime, localtime
+
+from pyflowerpower.state import SensorState
+from pyflowerpower.planner import DownloadPlanner, DEFAULT_CAPACITY
+
+SCRIPT = 'fp-plan.py v1.0'
+
+'''
+fp-plan.py Copyright 2016 by gandy92@googlemail.com
+
+Print the download plan for all sensors known from the state file of fp-download.py:
+when each sensor should be downloaded next, so its history buffer does not overflow,
+later on low batteries and spread over time so the gateways are not overloaded.
+Use fp-download.py --scan --planned to only download sensors that are due.
+'''
+
+
+def fmt_time(t):
+    return strftime("%Y-%m-%d %H:%M", localtime(t)) if t else 'now'
+
+
+parser = argparse.ArgumentParser(prog=SCRIPT, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--state', default='fp-state.json',
+                    help='state file written by fp-download.py')
+parser.add_argument('--capacity', type=int, default=DEFAULT_CAPACITY,
+                    help='history entries a sensor holds, unless observed')
+parser.add_argument('--safety', type=float, default=0.5,
+                    help='fraction of the buffer fill time between downloads at a good battery level')
+parser.add_argument('--max-fill', type=float, default=0.9,
+                    help='fraction of the buffer fill time between downloads at a low battery level')
+parser.add_argument('--low-battery', type=int, default=20,
+                    help='battery level (percent) from which downloads are as rare as possible')
+parser.add_argument('--min-interval', type=float, default=6.0,
+                    help='minimum time between downloads of a sensor in hours')
+parser.add_argument('--slot', type=int, default=300,
+                    help='length of a time slot for connections in seconds')
+parser.add_argument('--per-slot', type=int, default=1,
+                    help='connections per time slot (number of adapters times links)')
+parser.add_argument('--json', action='store_const', const=1, default=0,
+                    help='output the plan as json')
+args = parser.parse_args()
+
+state = SensorState(args.state)
+planner = DownloadPlanner(capacity=args.capacity, safety=args.safety, max_fill=args.max_fill,
+                          low_battery=args.low_battery, min_interval=args.min_interval * 3600,
+                          slot=args.slot, per_slot=args.per_slot)
+plan = planner.plan(state.sensors, time())
+
+if args.json:
+    print(json.dumps([e._asdict() for e in plan], indent=4))
+else:
+    print("#%-17s %-16s %-16s %9s %7s %s" % ('addr', 'next download', 'due', 'interval', 'battery', 'reason'))
+    for e in plan:
+        print("%-18s %-16s %-16s %8.1fh %7s %s" %
+              (e.addr, fmt_time(e.time), fmt_time(e.due), e.interval / 3600.0,
+               e.battery is None and '-' or '%d%%' % e.battery, e.reason))
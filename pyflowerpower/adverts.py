@@ -0,0 +1,198 @@
+from __future__ import print_function
+
+from array import array
+import json
+import math
+import os
+from time import time
+
+'''
+Deduplicated store of advertisements, one fixed size ring buffer per device address.
+
+A ring keeps (timestamp, rssi, flags) in compact arrays, flags as an index into a
+small per-device table of distinct values. An advertisement is only recorded if the
+flags changed or the RSSI moved by at least rssi_delta since the last recorded one;
+last-seen time and RSSI statistics are updated for every advertisement.
+'''
+
+
+class DeviceAdverts:
+
+    def __init__(self, size):
+        self.size = size
+        self.ts = array('d', [0.0]) * size
+        self.rssi = array('b', [0]) * size
+        self.flag_idx = array('H', [0]) * size
+        self.flag_values = []
+        self.flag_index = {}
+        self.start = 0
+        self.count = 0
+        self.last_seen = 0.0
+        self.last_rssi = None
+        self.last_flags = None
+        # running RSSI statistics over all advertisements (Welford)
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def seen(self, ts, rssi):
+        self.last_seen = max(self.last_seen, ts)
+        self.n += 1
+        delta = rssi - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (rssi - self.mean)
+        self.min = rssi if self.min is None else min(self.min, rssi)
+        self.max = rssi if self.max is None else max(self.max, rssi)
+
+    def flag(self, flags):
+        if flags not in self.flag_index:
+            if len(self.flag_values) >= 0xffff:
+                self.compact()
+            self.flag_index[flags] = len(self.flag_values)
+            self.flag_values.append(flags)
+        return self.flag_index[flags]
+
+    def compact(self):
+        """Drop flag values no longer referenced by the ring."""
+        used = [self.flag_values[self.flag_idx[i % self.size]] for i in range(self.start, self.start + self.count)]
+        self.flag_values = []
+        self.flag_index = {}
+        for n, flags in enumerate(used):
+            self.flag_idx[(self.start + n) % self.size] = self.flag(flags)
+
+    def append(self, ts, rssi, flags):
+        pos = (self.start + self.count) % self.size
+        if self.count == self.size:
+            self.start = (self.start + 1) % self.size
+        else:
+            self.count += 1
+        self.ts[pos] = ts
+        self.rssi[pos] = max(-128, min(127, rssi))
+        self.flag_idx[pos] = self.flag(flags)
+        self.last_rssi = rssi
+        self.last_flags = flags
+
+    def entries(self):
+        """Yield the recorded (timestamp, rssi, flags), oldest first."""
+        for i in range(self.start, self.start + self.count):
+            pos = i % self.size
+            yield self.ts[pos], self.rssi[pos], self.flag_values[self.flag_idx[pos]]
+
+    def rssi_stats(self):
+        return {
+            'count': self.n,
+            'mean': self.mean,
+            'std': math.sqrt(self.m2 / self.n) if self.n > 1 else 0.0,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    def dict(self):
+        ts, rssi, flags = [], [], []
+        for entry in self.entries():
+            ts.append(entry[0])
+            rssi.append(entry[1])
+            flags.append(entry[2])
+        return {
+            'ts': ts, 'rssi': rssi, 'flags': flags, 'last_seen': self.last_seen,
+            'n': self.n, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, size, d):
+        dev = cls(size)
+        for entry in list(zip(d['ts'], d['rssi'], d['flags']))[-size:]:
+            dev.append(*entry)
+        dev.last_seen = d['last_seen']
+        dev.n, dev.mean, dev.m2, dev.min, dev.max = d['n'], d['mean'], d['m2'], d['min'], d['max']
+        return dev
+
+
+class AdvertisementStore:
+
+    def __init__(self, size=256, rssi_delta=5):
+        self.size = size
+        self.rssi_delta = rssi_delta
+        self.devices = {}
+        self.adverts = 0
+        self.recorded = 0
+
+    def add(self, addr, rssi, flags, ts=None):
+        """Account for one advertisement, return True if it was recorded as a change."""
+        ts = time() if ts is None else ts
+        addr = addr.lower()
+        dev = self.devices.get(addr)
+        if dev is None:
+            dev = self.devices[addr] = DeviceAdverts(self.size)
+        dev.seen(ts, rssi)
+        self.adverts += 1
+        if dev.count and flags == dev.last_flags and abs(rssi - dev.last_rssi) < self.rssi_delta:
+            return False
+        dev.append(ts, rssi, flags)
+        self.recorded += 1
+        return True
+
+    def addresses(self):
+        return sorted(self.devices.keys())
+
+    def last_seen(self, addr):
+        dev = self.devices.get(addr.lower())
+        return dev.last_seen if dev is not None else None
+
+    def rssi_stats(self, addr):
+        dev = self.devices.get(addr.lower())
+        return dev.rssi_stats() if dev is not None else None
+
+    def flags(self, addr):
+        """Current flags of a device, None if never seen."""
+        dev = self.devices.get(addr.lower())
+        return dev.last_flags if dev is not None else None
+
+    def flag_history(self, addr, since=0):
+        """Return (timestamp, flags) for every recorded change of the flags after since."""
+        dev = self.devices.get(addr.lower())
+        history = []
+        if dev is None:
+            return history
+        last = None
+        for ts, rssi, flags in dev.entries():
+            if flags != last and ts > since:
+                history.append((ts, flags))
+            last = flags
+        return history
+
+    def flags_changed(self, addr, since=0):
+        """Whether the flags of a device changed after since."""
+        dev = self.devices.get(addr.lower())
+        if dev is None:
+            return False
+        last = None
+        for ts, rssi, flags in dev.entries():
+            if last is not None and flags != last and ts > since:
+                return True
+            last = flags
+        return False
+
+    def history(self, addr):
+        dev = self.devices.get(addr.lower())
+        return list(dev.entries()) if dev is not None else []
+
+    def save(self, filename):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'size': self.size, 'devices': dict((addr, dev.dict())
+                                                                    for addr, dev in self.devices.items())}))
+        os.rename(tmp, filename)
+
+    def load(self, filename):
+        if not os.path.exists(filename):
+            return
+        try:
+            data = json.loads(open(filename).read())
+        except ValueError:
+            print("Could not read advertisements from file '%s', starting over." % filename)
+            return
+        for addr, d in data['devices'].items():
+            self.devices[addr] = DeviceAdverts.from_dict(self.size, d)
@@ -0,0 +1,219 @@
+import asyncio
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from pyflowerpower.upload import FrameAssembler, UploadStates, AdaptiveTimeout, receiver_step
+from pyflowerpower.history import History
+from pyflowerpower.metrics import TransferStats
+
+'''
+asyncio implementation of the upload state machine (python 3 only).
+
+An AsyncUpload talks to the sensor through a link object providing the coroutines
+
+    read(name)          with name 'nb_entries' or 'last_index'
+    write(name, value)  with name 'rx_status' or 'start_index'
+
+and calling upload.notify_tx_buffer(data) / upload.notify_tx_status(data) from the
+event loop thread for every notification. BluepyLink adapts a connected PlantSensor,
+other BLE backends only need to provide the same methods.
+'''
+
+debug = 0
+
+
+class AsyncUpload(UploadStates):
+
+    def __init__(self, link, name=''):
+        self.link = link
+        self.name = name
+        self.rx_state = self.RX_STANDBY
+        self.tx_state = self.TX_IDLE
+        self.tx_updates = 0
+        self.frames = FrameAssembler()
+        self.stats = TransferStats()
+        self.timing = AdaptiveTimeout()
+        self.notifications = asyncio.Queue()
+        self.data = b""
+
+    def notify_tx_buffer(self, data):
+        self.notifications.put_nowait((self.handle_tx_buffer, data))
+
+    def notify_tx_status(self, data):
+        self.notifications.put_nowait((self.handle_tx_status, data))
+
+    def handle_tx_buffer(self, data):
+        frame = struct.unpack('<H', data[0:2])[0]
+        self.timing.notified('frames')
+        self.frames.add(frame, data[2:20])
+
+    def handle_tx_status(self, data):
+        self.tx_state = struct.unpack('<B', data)[0]
+        self.tx_updates += 1
+        self.stats.state(self.tx_state)
+        self.timing.notified(self.tx_state == self.TX_TRANSFER and 'frames' or 'status')
+        2 <= debug and print("%s: got new tx status %d" % (self.name, self.tx_state))
+
+    async def wait(self, kind):
+        """Process the next notification, return False if there was none within the timeout."""
+        timeout = self.timing.timeout(kind)
+        try:
+            handler, data = await asyncio.wait_for(self.notifications.get(), timeout)
+        except asyncio.TimeoutError:
+            if self.timing.expired():
+                print("%s: deadline reached" % self.name)
+                self.stats.timeout('deadline')
+            else:
+                print("%s: timeout waiting for %s after %.2f s" % (self.name, kind, timeout))
+                self.stats.timeout(kind)
+            return False
+        handler(data)
+        return True
+
+    async def set_rx_state(self, state):
+        self.rx_state = state
+        await self.link.write('rx_status', state)
+
+    async def receive(self, index=None, count=None, deadline=None):
+        await self.set_rx_state(self.RX_STANDBY)
+        self.frames.reset()
+        self.stats = TransferStats()
+        self.stats.start(self.tx_state)
+        self.timing = AdaptiveTimeout(deadline=deadline)
+        while not self.notifications.empty():
+            self.notifications.get_nowait()
+
+        if index is not None:
+            await self.link.write('start_index', index)
+        elif count is not None:
+            entries = await self.link.read('nb_entries')
+            last = await self.link.read('last_index')
+            count = max(1, min(count, entries))
+            await self.link.write('start_index', last-count+1)
+
+        await self.set_rx_state(self.RX_RECEIVING)
+        self.timing.start('status')
+        while True:
+            step = receiver_step(self.tx_state, self.frames, self.timing)
+            if step == 'deadline':
+                print("%s: deadline reached" % self.name)
+                self.stats.timeout('deadline')
+                await self.set_rx_state(self.RX_CANCEL)
+                break
+
+            elif step == 'done':
+                await self.set_rx_state(self.RX_STANDBY)
+                break
+
+            elif step in ('status', 'frames'):
+                if not await self.wait(step):
+                    await self.set_rx_state(self.RX_ERROR)
+                    break
+
+            elif step in ('ack', 'nack'):
+                updates = self.tx_updates
+                if step == 'ack':
+                    self.stats.ack()
+                    await self.link.write('rx_status', self.RX_ACK)
+                else:
+                    self.stats.nack()
+                    await self.link.write('rx_status', self.RX_NACK)
+                self.timing.start('status')
+                # frames still queued must not trigger another ACK/NACK for the same window
+                while self.tx_updates == updates:
+                    if not await self.wait('status'):
+                        break
+                if self.tx_updates == updates:
+                    await self.set_rx_state(self.RX_ERROR)
+                    break
+
+            else:
+                print("%s: unknown TX state %d" % (self.name, self.tx_state))
+                await self.set_rx_state(self.RX_CANCEL)
+                break
+
+        self.stats.finish(self.frames)
+        self.data = self.frames.data()
+        return self
+
+    def history(self):
+        return History.from_bytes(self.data)
+
+
+class BluepyLink:
+    """Feed notifications of a connected PlantSensor into an event loop.
+
+    All calls to the bluepy peripheral, including polling for notifications, run in one
+    worker thread per link, since bluepy peripherals must not be used concurrently.
+    """
+
+    def __init__(self, sensor, poll=0.02):
+        self.sensor = sensor
+        self.poll = poll
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.regs = {
+            'nb_entries': sensor.upload.c_hist_nb_entries,
+            'last_index': sensor.upload.c_hist_last_index,
+            'start_index': sensor.upload.c_hist_start_index,
+            'rx_status': sensor.upload.c_upload_rxs,
+        }
+        self.pump = None
+
+    async def call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def read(self, name):
+        return await self.call(self.regs[name].read)
+
+    async def write(self, name, value):
+        return await self.call(self.regs[name].write, value)
+
+    def attach(self, upload):
+        """Route the sensor's upload notifications to upload and start polling."""
+        loop = asyncio.get_running_loop()
+        handles = self.sensor.handles
+        handles[self.sensor.upload.c_upload_txb.getHandle()] = \
+            lambda data: loop.call_soon_threadsafe(upload.notify_tx_buffer, data)
+        handles[self.sensor.upload.c_upload_txs.getHandle()] = \
+            lambda data: loop.call_soon_threadsafe(upload.notify_tx_status, data)
+        self.pump = loop.create_task(self.run_pump())
+
+    async def run_pump(self):
+        while True:
+            await self.call(self.sensor.p.waitForNotifications, self.poll)
+
+    def detach(self):
+        if self.pump is not None:
+            self.pump.cancel()
+            self.pump = None
+        upload = self.sensor.upload
+        self.sensor.handles[upload.c_upload_txb.getHandle()] = upload.handle_tx_buffer
+        self.sensor.handles[upload.c_upload_txs.getHandle()] = upload.handle_tx_status
+
+    def close(self):
+        self.detach()
+        self.executor.shutdown(wait=False)
+
+
+async def receive_sensor(sensor, index=None, count=None, deadline=None):
+    """Receive history data of a connected PlantSensor on the running event loop."""
+    link = BluepyLink(sensor)
+    upload = AsyncUpload(link, sensor.addr)
+    link.attach(upload)
+    try:
+        return await upload.receive(index=index, count=count, deadline=deadline)
+    finally:
+        link.close()
+
+
+def receive_all(sensors, count=10000):
+    """Run history transfers of several connected sensors concurrently on one event loop."""
+    async def gather():
+        tasks = [receive_sensor(sensor, count=count) for sensor in sensors]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather())
+    finally:
+        loop.close()
@@ -0,0 +1,151 @@
+from __future__ import print_function
+
+from collections import namedtuple
+import mmap
+import os
+import struct
+import numpy as np
+
+from pyflowerpower.history import History, HEADER_SIZE, RECORD_SIZE, RECORD_FIELDS, RECORD_DTYPE, SESSION_MARKER, \
+    UNKNOWN_SESSION
+
+'''
+Append-only binary archive of history data, one per sensor.
+
+The data file (.fpa) holds the raw upload buffers as received from the sensor: a 16 byte
+header followed by the 12 byte records. Only records newer than the last archived entry
+are appended, so the header's record count may exceed the number of records stored after
+it. The index file (.fpi) has one fixed size entry per session segment of a block, giving
+the byte offset of its first record, the number of records, the global index of the first
+record, the session id and period. Readers map the data file and get numpy views on it
+without copying.
+'''
+
+INDEX_FORMAT = '>QQLLHH'
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+
+IndexEntry = namedtuple('IndexEntry', ['block', 'offset', 'count', 'first_index', 'session', 'period'])
+
+
+class HistoryArchive:
+
+    def __init__(self, path):
+        """Open the archive with the given path prefix, e.g. 'archive/ABCD'."""
+        self.data_file = path + '.fpa'
+        self.index_file = path + '.fpi'
+        self.entries = []
+        self.mm = None
+        if os.path.exists(self.index_file):
+            raw = open(self.index_file, 'rb').read()
+            n = int(len(raw) / INDEX_SIZE)
+            self.entries = [IndexEntry(*struct.unpack(INDEX_FORMAT, raw[i*INDEX_SIZE:(i+1)*INDEX_SIZE]))
+                            for i in range(0, n)]
+
+    def last_index(self):
+        """Global index of the last archived record, -1 if the archive is empty."""
+        if not self.entries:
+            return -1
+        e = self.entries[-1]
+        return e.first_index + e.count - 1
+
+    def session_at(self, index):
+        for e in reversed(self.entries):
+            if e.first_index <= index < e.first_index + e.count:
+                return e.session, e.period
+        return UNKNOWN_SESSION, 0
+
+    def append(self, history):
+        """Append the records of a History newer than the archive, return their number."""
+        first = history.index(0)
+        skip = max(0, self.last_index() + 1 - first)
+        if skip >= len(history):
+            return 0
+        values = history.values[skip:]
+        first += skip
+
+        data_dir = os.path.dirname(self.data_file)
+        if data_dir and not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        with open(self.data_file, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            block = f.tell()
+            f.write(history.bytes()[0:HEADER_SIZE])
+            f.write(values.astype(RECORD_DTYPE).tobytes())
+
+        # split the block at session markers, a leading segment without marker continues
+        # the session archived before, the records up to the end belong to the header's session
+        starts = [0] + [int(i) for i in np.flatnonzero(values[:, 0] == SESSION_MARKER) if i > 0]
+        previous = self.session_at(first - 1)
+        entries = []
+        for n, start in enumerate(starts):
+            end = starts[n+1] if n+1 < len(starts) else len(values)
+            if values[start, 0] == SESSION_MARKER:
+                session, period = int(values[start, 1]), int(values[start, 2])
+            elif len(starts) == 1:
+                session, period = history.session, history.period
+            else:
+                session, period = previous
+            entries.append(IndexEntry(block, block + HEADER_SIZE + start*RECORD_SIZE, end - start,
+                                      first + start, session, period))
+        with open(self.index_file, 'ab') as f:
+            for e in entries:
+                f.write(struct.pack(INDEX_FORMAT, *e))
+        self.entries += entries
+        # views handed out before keep the old mapping alive
+        self.mm = None
+        return len(values)
+
+    def open(self):
+        if self.mm is None and self.entries:
+            with open(self.data_file, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mm
+
+    def close(self):
+        """Unmap the data file, views returned before must not be used afterwards."""
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def view(self, entry):
+        """Return the records of an index entry as (n, 6) array view on the mapped file."""
+        mm = self.open()
+        values = np.frombuffer(mm, dtype=RECORD_DTYPE, count=entry.count*RECORD_FIELDS, offset=entry.offset)
+        return values.reshape(entry.count, RECORD_FIELDS)
+
+    def header(self, entry):
+        """Return the raw block header of an index entry as History header tuple."""
+        mm = self.open()
+        return History.from_bytes(mm[entry.block:entry.block+HEADER_SIZE]).header
+
+    def sessions(self):
+        return sorted(set(e.session for e in self.entries))
+
+    def segments(self, session=None):
+        """Yield (entry, view) for all segments, or those of one session."""
+        for e in self.entries:
+            if session is None or e.session == session:
+                yield e, self.view(e)
+
+    def session(self, session):
+        """Return all records of a session, a view if stored in one segment, else a copy."""
+        views = [v for e, v in self.segments(session)]
+        if len(views) == 1:
+            return views[0]
+        if not views:
+            return np.zeros((0, RECORD_FIELDS), dtype=RECORD_DTYPE)
+        return np.concatenate(views)
+
+    def range(self, first, last):
+        """Return the records with global index first..last (inclusive)."""
+        parts = []
+        for e in self.entries:
+            lo = max(first, e.first_index)
+            hi = min(last, e.first_index + e.count - 1)
+            if lo <= hi:
+                parts.append(self.view(e)[lo - e.first_index:hi - e.first_index + 1])
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.zeros((0, RECORD_FIELDS), dtype=RECORD_DTYPE)
+        return np.concatenate(parts)
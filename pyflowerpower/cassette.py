@@ -0,0 +1,128 @@
+from __future__ import print_function
+
+import json
+import os
+import threading
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+try:
+    from urllib.parse import urlsplit, parse_qsl
+except ImportError:
+    from urlparse import urlsplit, parse_qsl
+
+'''
+Recording and replaying of cloud API responses in cassette files, so the cloud
+fetching can be run and benchmarked without the Parrot cloud.
+
+A cassette is a json file holding one interaction per request: method, path, query
+parameters, status, content type and the response body. Requests are matched on
+method, path and query, independent of the server's base URL. Request bodies (the
+credentials) are not recorded and access tokens in responses are replaced.
+'''
+
+RECORDED_TOKEN = 'recorded'
+
+
+def interaction_key(method, url):
+    parts = urlsplit(url)
+    return method.upper(), parts.path, tuple(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+
+class Cassette:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.interactions = {}
+        self.replayed = 0
+        if os.path.exists(filename):
+            self.load()
+
+    def load(self):
+        with open(self.filename) as f:
+            for i in json.load(f)['interactions']:
+                key = i['method'], i['path'], tuple(tuple(p) for p in i['query'])
+                self.interactions[key] = i
+
+    def save(self):
+        interactions = [self.interactions[key] for key in sorted(self.interactions)]
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump({'interactions': interactions}, f, indent=1)
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def __len__(self):
+        return len(self.interactions)
+
+    def record(self, method, url, status, content_type, body):
+        """Add a response, body as text. Access tokens are not recorded.
+
+        Server errors, which the client retries, do not replace a recorded response.
+        """
+        if 'json' in content_type:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                pass
+            else:
+                if isinstance(data, dict) and 'access_token' in data:
+                    data['access_token'] = RECORDED_TOKEN
+                    body = json.dumps(data)
+        method, path, query = interaction_key(method, url)
+        with self.lock:
+            if status >= 500 and (method, path, query) in self.interactions:
+                return
+            self.interactions[(method, path, query)] = {
+                'method': method, 'path': path, 'query': [list(p) for p in query],
+                'status': status, 'content_type': content_type, 'body': body}
+
+    def find(self, method, url):
+        """Return the interaction recorded for a request, None if there is none."""
+        return self.interactions.get(interaction_key(method, url))
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Transport adapter passing requests on and recording the responses in a cassette."""
+
+    def __init__(self, cassette, **kwargs):
+        HTTPAdapter.__init__(self, **kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        response = HTTPAdapter.send(self, request, **kwargs)
+        self.cassette.record(request.method, request.url, response.status_code,
+                             response.headers.get('Content-Type', ''), response.text)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter answering requests from a cassette, with 404 for requests not recorded."""
+
+    def __init__(self, cassette):
+        BaseAdapter.__init__(self)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        interaction = self.cassette.find(request.method, request.url)
+        response = Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        response.reason = 'Replayed'
+        if interaction is None:
+            response.reason = 'Not Recorded'
+            response.status_code = 404
+            response.headers = CaseInsensitiveDict({'Content-Type': 'text/plain'})
+            response._content = b'not recorded'
+        else:
+            with self.cassette.lock:
+                self.cassette.replayed += 1
+            response.status_code = interaction['status']
+            response.headers = CaseInsensitiveDict({'Content-Type': interaction['content_type']})
+            response._content = interaction['body'].encode('utf-8')
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+import os
+import struct
+
+from pyflowerpower.history import HEADER_FORMAT, HEADER_SIZE, RECORD_SIZE
+
+'''
+On-disk checkpoints of history transfers, so an interrupted transfer can be resumed
+instead of started over.
+
+The checkpoint file always holds a valid history buffer: the header of the transfer,
+with record count, last index and timestamp adjusted to the records saved so far,
+followed by these records. It is updated whenever a window was acknowledged and
+synced to disk every sync_every updates and when a transfer is aborted (see sync()).
+A later transfer starting at next_index() continues the file, which finally holds
+the stitched history under the header of the last transfer.
+'''
+
+
+class TransferCheckpoint:
+
+    def __init__(self, filename, sync_every=8):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.header = None
+        self.records = 0
+        self.base = 0
+        self.written = 0
+        self.unsynced = 0
+        if os.path.exists(filename):
+            self.load()
+
+    def load(self):
+        with open(self.filename, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+            if len(head) < HEADER_SIZE:
+                return
+            header = struct.unpack(HEADER_FORMAT, head)
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+        # a record not completely written before a crash is dropped
+        self.records = min(header[2], int((size - HEADER_SIZE) / RECORD_SIZE))
+        if self.records > 0:
+            self.header = self.adjusted(header, header[4] - (header[2] - self.records), self.records)
+
+    def first_index(self):
+        return self.header[4] - self.records + 1
+
+    def next_index(self):
+        return self.header[4] + 1
+
+    def resumable(self, last_index, entries):
+        """Whether the sensor still holds the entries following the checkpoint."""
+        if not self.records:
+            return False
+        if self.next_index() > last_index:
+            print("no entries left to resume checkpoint %s with, discarding it" % self.filename)
+            return False
+        if last_index - self.next_index() >= entries:
+            print("history wrapped since checkpoint %s, discarding it" % self.filename)
+            return False
+        return True
+
+    @staticmethod
+    def adjusted(header, last_index, records):
+        """Return header with the last index moved to last_index, timestamp following along."""
+        d1, d2, n, lts, lidx, session, period = header
+        return (d1, d2, records, max(0, lts - (lidx - last_index) * period), last_index, session, period)
+
+    def begin(self):
+        """Start a transfer continuing the records saved so far."""
+        self.base = self.records
+        self.written = 0
+
+    def update(self, frames):
+        """Save the records of all completely received windows of a FrameAssembler."""
+        size = frames.contiguous()
+        if size < HEADER_SIZE:
+            return
+        header = struct.unpack(HEADER_FORMAT, bytes(frames.view[0:HEADER_SIZE]))
+        n = int((size - HEADER_SIZE) / RECORD_SIZE)
+        if n <= self.written:
+            return
+        first = header[4] - header[2] + 1
+        if self.base and first != self.next_index() - self.written:
+            print("transfer starts at index %d, not at checkpoint index %d, discarding checkpoint" %
+                  (first, self.next_index() - self.written))
+            self.base = self.records = self.written = 0
+
+        data_dir = os.path.dirname(self.filename)
+        if data_dir and not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        records = self.base + n
+        self.header = self.adjusted(header, first + n - 1, records)
+        head = struct.pack(HEADER_FORMAT, *self.header)
+        with open(self.filename, self.records and 'r+b' or 'wb') as f:
+            f.write(head)
+            f.seek(HEADER_SIZE + (self.base + self.written) * RECORD_SIZE)
+            start = HEADER_SIZE + self.written * RECORD_SIZE
+            f.write(frames.view[start:HEADER_SIZE + n * RECORD_SIZE])
+            f.truncate()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                f.flush()
+                os.fsync(f.fileno())
+                self.unsynced = 0
+        self.written = n
+        self.records = records
+
+    def sync(self):
+        """Make sure all saved records are on disk, e.g. after an aborted transfer."""
+        if not self.unsynced or not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r+b') as f:
+            os.fsync(f.fileno())
+        self.unsynced = 0
+
+    def data(self):
+        with open(self.filename, 'rb') as f:
+            return f.read(HEADER_SIZE + self.records * RECORD_SIZE)
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+        data_dir = os.path.dirname(self.filename)
+        if data_dir and os.path.isdir(data_dir) and not os.listdir(data_dir):
+            try:
+                os.rmdir(data_dir)
+            except OSError:
+                pass
+        self.header = None
+        self.records = self.base = self.written = self.unsynced = 0
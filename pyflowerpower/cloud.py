@@ -0,0 +1,367 @@
+from __future__ import print_function
+
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pprint import pformat
+import threading
+from time import time, sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+from dateutil import parser as dateparser
+import numpy as np
+
+from pyflowerpower.cassette import RecordingAdapter, ReplayAdapter
+
+'''
+Access to the Parrot cloud API for fetching the samples recorded for a sensor.
+
+One CloudClient per credentials profile keeps a pooled HTTP session and the bearer
+token until it expires. Samples are requested in 7 day windows, fetched concurrently
+under a limit of parallel requests and a rate limit, with retries and exponential
+backoff on connection errors and server errors. With a SampleCache (see cloudcache),
+only time ranges not fetched before are requested. With a Cassette,
+responses are recorded, or replayed instead of accessing the cloud.
+
+Each response is turned into typed columns (see SampleColumns) described by the
+client's COLUMNS schema, with capture times parsed by a fixed format ISO-8601 fast
+path (see parse_utc).
+'''
+
+debug = 0
+
+WINDOW = timedelta(days=7, seconds=-1)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class CloudError(Exception):
+    pass
+
+
+def parse_utc(text):
+    """Return the unix time of an ISO-8601 time, like int(dateutil.parser.parse(text).timestamp()).
+
+    Times of the form YYYY-MM-DDTHH:MM:SS[.fff](Z|+HH:MM|+HHMM) are converted directly,
+    anything else is passed to dateutil.
+    """
+    if len(text) >= 20 and text[4] == '-' and text[7] == '-' and text[10] in 'T ' and text[13] == ':' \
+            and text[16] == ':':
+        i = 19
+        if text[i] == '.':
+            i += 1
+            while i < len(text) and text[i].isdigit():
+                i += 1
+        zone = text[i:]
+        offset = None
+        if zone in ('Z', 'z'):
+            offset = 0
+        elif len(zone) in (5, 6) and zone[0] in '+-' and zone[1:3].isdigit() and zone[-2:].isdigit() \
+                and (len(zone) == 5 or zone[3] == ':'):
+            offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+            if zone[0] == '-':
+                offset = -offset
+        if offset is not None:
+            try:
+                return timegm((int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                               int(text[11:13]), int(text[14:16]), int(text[17:19]), 0, 0, 0)) - offset
+            except ValueError:
+                pass
+    return int(dateparser.parse(text).timestamp())
+
+
+def make_column(values, dtype):
+    """Return a column for a list of json values, typed as far as this keeps str() of every value.
+
+    Numbers (dtype float) are float64 with NaN for None if all are floats or None, int64
+    if all are ints, and an object array of the values otherwise, like other columns.
+    """
+    if dtype == float:
+        kinds = set(map(type, values))
+        if kinds <= set([float, type(None)]):
+            return np.array(values, dtype=float)
+        if kinds == set([int]):
+            return np.array(values, dtype=np.int64)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def column_values(column):
+    """Return the values of a column as a list of python values, None for missing numbers."""
+    if column.dtype.kind == 'f':
+        return [None if v != v else v for v in column.tolist()]
+    return column.tolist()
+
+
+class SampleColumns:
+    """Cloud samples as columns: ts (int64 unix times, sorted and unique) and one array per title.
+
+    Columns are typed by make_column, so each value still formats like the json value
+    received: numbers as float64 (NaN for missing values) or int64, anything else in
+    object arrays.
+    """
+
+    def __init__(self, titles, ts, columns):
+        self.titles = list(titles)
+        self.ts = ts
+        self.columns = columns
+
+    @classmethod
+    def from_samples(cls, schema, ts_field, samples):
+        """Build columns from the decoded json samples of a response."""
+        ts = [parse_utc(sample[ts_field]) for sample in samples]
+        return cls.from_lists(schema, ts, [[sample.get(field) for sample in samples] for title, field, dtype in schema])
+
+    @classmethod
+    def from_lists(cls, schema, ts, values):
+        """Build columns from a list of timestamps and one list of values per column of schema."""
+        columns = [make_column(list(v), dtype) for (title, field, dtype), v in zip(schema, values)]
+        return cls([c[0] for c in schema], np.array(ts, dtype=np.int64), columns).unique()
+
+    @classmethod
+    def concat(cls, titles, parts):
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls(titles, np.empty(0, dtype=np.int64), [np.empty(0) for t in titles])
+        columns = []
+        for i in range(len(titles)):
+            column = [p.columns[i] for p in parts]
+            if len(set(c.dtype for c in column)) > 1:
+                # e.g. ints in one window and floats in another: keep the values as they are
+                column = [make_column(column_values(c), object) for c in column]
+            columns.append(np.concatenate(column))
+        return cls(titles, np.concatenate([p.ts for p in parts]), columns).unique()
+
+    def unique(self):
+        """Sort by time and drop duplicate times, keeping the last sample."""
+        order = np.argsort(self.ts, kind='stable')
+        ts = self.ts[order]
+        keep = np.ones(len(ts), dtype=bool)
+        keep[:-1] = ts[1:] != ts[:-1]
+        order = order[keep]
+        return SampleColumns(self.titles, self.ts[order], [c[order] for c in self.columns])
+
+    def select(self, from_ts, to_ts):
+        """Return the samples with from_ts <= ts <= to_ts."""
+        lo = np.searchsorted(self.ts, from_ts, side='left')
+        hi = np.searchsorted(self.ts, to_ts, side='right')
+        return SampleColumns(self.titles, self.ts[lo:hi], [c[lo:hi] for c in self.columns])
+
+    def __len__(self):
+        return len(self.ts)
+
+    def values(self):
+        """Return the values of all columns as lists of python values, None for missing numbers."""
+        return [column_values(c) for c in self.columns]
+
+    def rows(self):
+        """Iterate over (ts, row) by time, rows as tuples of python values."""
+        return zip(self.ts.tolist(), zip(*self.values()))
+
+
+class CloudClient:
+    # overridden for the old and new API: COLUMNS is the schema of (title, json field, type)
+    CONFIG_PATH = None
+    SAMPLE_PATH = None
+    TS_FIELD = None
+    COLUMNS = []
+
+    def __init__(self, credentials, concurrency=4, rate=5.0, retries=3, backoff=1.0, timeout=60.0,
+                 profile=None, cache=None, cassette=None, replay=False):
+        self.profile = profile
+        self.cache = cache
+        self.credentials = dict(credentials)
+        self.url = self.credentials['url']
+        self.concurrency = max(1, concurrency)
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        # with a cassette, responses are recorded or replayed without network access
+        if cassette is not None and replay:
+            adapter = ReplayAdapter(cassette)
+        elif cassette is not None:
+            adapter = RecordingAdapter(cassette, pool_connections=1, pool_maxsize=self.concurrency)
+        else:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        # held while authenticating, so concurrent requests wait for one new token
+        self.auth_lock = threading.Lock()
+        self.token = None
+        self.token_expires = 0.0
+        self.next_request = 0.0
+        self.config = None
+        self.requests = 0
+
+    def throttle(self):
+        """Wait until the next request may start according to the rate limit."""
+        with self.lock:
+            now = time()
+            start = max(now, self.next_request)
+            self.next_request = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+    def request(self, path, headers=None, **kwargs):
+        """GET url+path with retries, return the decoded json response."""
+        for attempt in range(0, self.retries + 1):
+            self.throttle()
+            with self.lock:
+                self.requests += 1
+            delay = self.backoff * (2 ** attempt)
+            try:
+                req = self.session.get(self.url + path, headers=headers, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = str(e)
+            else:
+                if req.status_code == 401 and headers is not None and attempt < self.retries:
+                    # token revoked or expired early
+                    with self.lock:
+                        self.token = None
+                    headers = self.auth_header()
+                    continue
+                if req.status_code not in RETRY_STATUS:
+                    req.raise_for_status()
+                    return req.json()
+                error = "HTTP %d" % req.status_code
+                retry_after = req.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            if attempt < self.retries:
+                1 <= debug and print("%s: %s, retrying in %.1f s" % (path, error, delay))
+                sleep(delay)
+        raise CloudError("%s: %s after %d attempts" % (path, error, self.retries + 1))
+
+    def auth_header(self):
+        """Return the authorization header, authenticating if the token expired."""
+        with self.auth_lock:
+            with self.lock:
+                token = self.token if time() < self.token_expires else None
+            if token is None:
+                data = dict(self.credentials)
+                data['grant_type'] = 'password'
+                # authenticate outside the rate limit
+                req = self.session.get(self.url + '/user/v1/authenticate', data=data, timeout=self.timeout)
+                req.raise_for_status()
+                auth = req.json()
+                token = auth['access_token']
+                with self.lock:
+                    self.token = token
+                    # renew a minute before the token expires
+                    self.token_expires = time() + int(auth.get('expires_in', 3600)) - 60
+        return {'Authorization': 'Bearer ' + token}
+
+    def configuration(self):
+        if self.config is None:
+            self.config = self.request(self.CONFIG_PATH, headers=self.auth_header())
+        return self.config
+
+    def location(self, sens_id):
+        """Return the location identifier of the sensor with the given id suffix, None if unknown."""
+        if self.cache is not None:
+            location_id = self.cache.location(self.profile, sens_id)
+            if location_id:
+                return location_id
+        location_id = None
+        for data in self.configuration()[u'locations']:
+            sens = self.sensor_serial(data)
+            if sens is not None and sens[-len(sens_id):] == sens_id:
+                location_id = data[u'location_identifier']
+        if location_id and self.cache is not None:
+            self.cache.set_location(self.profile, sens_id, location_id)
+        return location_id
+
+    def fetch_window(self, location_id, ts_1, ts_2):
+        """Fetch the samples of one window."""
+        response = self.request(self.SAMPLE_PATH + location_id, headers=self.auth_header(),
+                                params={'from_datetime_utc': ts_1, 'to_datetime_utc': ts_2})
+        4 <= debug and print('Server response: \n {0}'.format(pformat(response)))
+        return SampleColumns.from_samples(self.COLUMNS, self.TS_FIELD, response['samples'])
+
+    def samples(self, sens_id, from_ts, to_ts):
+        """Fetch all samples of a sensor between two unix timestamps as SampleColumns, None if not found."""
+        location_id = self.location(sens_id)
+        if not location_id:
+            print("Could not find location with sensor %s. Bailing out." % sens_id)
+            return None
+        3 <= debug and print(location_id)
+
+        if self.cache is None:
+            gaps = [(from_ts, to_ts)]
+        else:
+            gaps = self.cache.missing(self.profile, location_id, from_ts, to_ts)
+            1 <= debug and print("%s: fetching %s" % (location_id, gaps))
+
+        # cloud sample timestamps are in utc
+        windows = []
+        for start, end in gaps:
+            ts_1 = datetime.utcfromtimestamp(start)
+            ts_e = datetime.utcfromtimestamp(end)
+            while ts_1 < ts_e:
+                ts_2 = min(ts_1 + WINDOW, ts_e)
+                windows.append((ts_1, ts_2))
+                ts_1 = ts_2
+
+        titles = [c[0] for c in self.COLUMNS]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            parts = list(executor.map(lambda w: self.fetch_window(location_id, *w), windows))
+        data = SampleColumns.concat(titles, parts)
+
+        if self.cache is None:
+            return data
+        for start, end in gaps:
+            self.cache.add(self.profile, location_id, start, end, data.select(start, end))
+        return self.cache.samples(self.profile, location_id, self.COLUMNS, from_ts, to_ts)
+
+
+class OldApiClient(CloudClient):
+    CONFIG_PATH = '/sensor_data/v3/sync'
+    SAMPLE_PATH = '/sensor_data/v2/sample/location/'
+    TS_FIELD = 'capture_ts'
+    COLUMNS = [('air_temp', 'air_temperature_celsius', float),
+               ('par_umole_m2s', 'par_umole_m2s', float),
+               ('vwc_percent', 'vwc_percent', float),
+               ('utc', 'capture_ts', str)]
+
+    def sensor_serial(self, location):
+        return location.get(u'sensor_serial')
+
+
+class NewApiClient(CloudClient):
+    CONFIG_PATH = '/garden/v2/configuration'
+    SAMPLE_PATH = '/sensor_data/v6/sample/location/'
+    TS_FIELD = 'capture_datetime_utc'
+    COLUMNS = [('air_temp', 'air_temperature_celsius', float),
+               ('light_level', 'light', float),
+               ('moisture_percent', 'soil_moisture_percent', float),
+               ('fertilizer_level', 'fertilizer_level', float),
+               ('battery', 'battery_percent', float),
+               ('utc', 'capture_datetime_utc', str)]
+
+    def sensor_serial(self, location):
+        return location.get(u'sensor', {}).get(u'sensor_identifier')
+
+
+CLIENTS = {
+    'oldapi': OldApiClient,
+    'newapi': NewApiClient,
+}
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(profile, credentials, **options):
+    """Return the client of a profile, created on first use with options (see CloudClient)."""
+    with clients_lock:
+        if profile not in clients:
+            if credentials['method'] not in CLIENTS:
+                raise CloudError("unknown method '%s' in profile '%s'" % (credentials['method'], profile))
+            clients[profile] = CLIENTS[credentials['method']](credentials, profile=profile, **options)
+        return clients[profile]
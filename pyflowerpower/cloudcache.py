@@ -0,0 +1,138 @@
+from __future__ import print_function
+
+import sqlite3
+from time import time
+
+from pyflowerpower.cloud import SampleColumns
+
+'''
+Local cache of cloud samples in a SQLite database, so that repeated runs only request
+time ranges from the cloud that were not fetched before.
+
+Samples are stored per profile and location with the time ranges already fetched, one
+column per sample title. The columns are declared without type, so SQLite keeps ints,
+floats and strings as they were received and they format as before when read back.
+Ranges ending less than settle seconds ago are not marked as fetched, as the cloud
+may still receive samples for them when a sensor is synced later. Location lookups
+are cached as well.
+'''
+
+debug = 0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS locations (
+    profile TEXT NOT NULL,
+    sens_id TEXT NOT NULL,
+    location TEXT NOT NULL,
+    time REAL NOT NULL,
+    PRIMARY KEY (profile, sens_id));
+CREATE TABLE IF NOT EXISTS ranges (
+    profile TEXT NOT NULL,
+    location TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS sample_values (
+    profile TEXT NOT NULL,
+    location TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    PRIMARY KEY (profile, location, ts));
+'''
+
+# 1: samples as json rows, 2: sample_values with a column per title
+VERSION = 2
+
+
+def quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class SampleCache:
+
+    def __init__(self, filename, settle=86400):
+        self.filename = filename
+        self.settle = settle
+        self.db = sqlite3.connect(filename)
+        with self.db:
+            if self.db.execute('PRAGMA user_version').fetchone()[0] < VERSION:
+                # samples of older caches are fetched again
+                self.db.execute('DROP TABLE IF EXISTS samples')
+                self.db.execute('DROP TABLE IF EXISTS ranges')
+                self.db.execute('PRAGMA user_version=%d' % VERSION)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.titles = set(row[1] for row in self.db.execute('PRAGMA table_info(sample_values)'))
+
+    def close(self):
+        self.db.close()
+
+    def location(self, profile, sens_id):
+        """Return the cached location identifier of a sensor, None if not cached."""
+        row = self.db.execute('SELECT location FROM locations WHERE profile=? AND sens_id=?',
+                              (profile, sens_id)).fetchone()
+        return row[0] if row else None
+
+    def set_location(self, profile, sens_id, location):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?)',
+                            (profile, sens_id, location, time()))
+
+    def ranges(self, profile, location):
+        return self.db.execute('SELECT start, end FROM ranges WHERE profile=? AND location=? ORDER BY start',
+                               (profile, location)).fetchall()
+
+    def missing(self, profile, location, from_ts, to_ts):
+        """Return the (start, end) ranges between from_ts and to_ts that were not fetched yet."""
+        gaps = []
+        start = from_ts
+        for r_start, r_end in self.ranges(profile, location):
+            if r_end < start:
+                continue
+            if r_start >= to_ts:
+                break
+            if r_start > start:
+                gaps.append((start, r_start))
+            start = max(start, r_end)
+        if start < to_ts:
+            gaps.append((start, to_ts))
+        return gaps
+
+    def add_titles(self, titles):
+        for title in titles:
+            if title not in self.titles:
+                self.db.execute('ALTER TABLE sample_values ADD COLUMN %s' % quote(title))
+                self.titles.add(title)
+
+    def add(self, profile, location, from_ts, to_ts, samples):
+        """Store the samples (SampleColumns) fetched for the range from_ts to to_ts."""
+        with self.db:
+            self.add_titles(samples.titles)
+            sql = 'INSERT OR REPLACE INTO sample_values (profile, location, ts, %s) VALUES (?, ?, ?%s)' % (
+                ', '.join(quote(t) for t in samples.titles), ', ?' * len(samples.titles))
+            n = len(samples)
+            self.db.executemany(sql, zip([profile] * n, [location] * n, samples.ts.tolist(), *samples.values()))
+            to_ts = min(to_ts, int(time() - self.settle))
+            if from_ts >= to_ts:
+                return
+            # merge with overlapping or adjacent ranges
+            merged = [(from_ts, to_ts)]
+            for r_start, r_end in self.ranges(profile, location):
+                if r_end < from_ts or r_start > to_ts:
+                    merged.append((r_start, r_end))
+                else:
+                    from_ts, to_ts = min(from_ts, r_start), max(to_ts, r_end)
+                    merged[0] = (from_ts, to_ts)
+            self.db.execute('DELETE FROM ranges WHERE profile=? AND location=?', (profile, location))
+            self.db.executemany('INSERT INTO ranges VALUES (?, ?, ?, ?)',
+                                ((profile, location, s, e) for s, e in merged))
+            2 <= debug and print("cached ranges %s:%s: %s" % (profile, location, sorted(merged)))
+
+    def samples(self, profile, location, schema, from_ts, to_ts):
+        """Return the cached samples between from_ts and to_ts as SampleColumns of schema (see cloud)."""
+        titles = [c[0] for c in schema]
+        with self.db:
+            self.add_titles(titles)
+        rows = self.db.execute('SELECT ts, %s FROM sample_values WHERE profile=? AND location=? AND ts BETWEEN ? AND ? '
+                               'ORDER BY ts' % ', '.join(quote(t) for t in titles),
+                               (profile, location, from_ts, to_ts)).fetchall()
+        values = list(zip(*rows)) or [[] for i in range(len(titles) + 1)]
+        return SampleColumns.from_lists(schema, values[0], values[1:])
@@ -0,0 +1,174 @@
+from __future__ import print_function
+
+from calendar import timegm
+import json
+import random
+import threading
+from time import strftime, gmtime, sleep, strptime
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+
+'''
+Local stand-in for the Parrot cloud API endpoints used by fp-clouddata.py, for tests
+and benchmarks without the cloud.
+
+The server answers from a cassette (see cassette.Cassette) or with synthetic data:
+configurations listing the given sensors for the old and new API, and samples every
+interval seconds (with jitter) for the requested time range. Requests for more than
+max_window seconds of samples are rejected with HTTP 400, which the client's 7 day
+windows have to stay below. Responses can be delayed by latency seconds and fail
+with HTTP 503 at error_rate, to exercise the client's concurrency, rate limits and
+retries.
+'''
+
+debug = 0
+
+OLD_CONFIG = '/sensor_data/v3/sync'
+NEW_CONFIG = '/garden/v2/configuration'
+OLD_SAMPLES = '/sensor_data/v2/sample/location/'
+NEW_SAMPLES = '/sensor_data/v6/sample/location/'
+
+
+def parse_param_time(text):
+    """Unix time of a from/to_datetime_utc parameter, as sent by the client: 'YYYY-MM-DD HH:MM:SS' in utc."""
+    return timegm(strptime(text[:19].replace('T', ' '), '%Y-%m-%d %H:%M:%S'))
+
+
+def param_time(ts):
+    return strftime('%Y-%m-%d %H:%M:%S', gmtime(ts))
+
+
+def capture_time(ts):
+    return strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(ts))
+
+
+class CloudStub:
+
+    def __init__(self, sensors=(), cassette=None, interval=900, jitter=60, latency=0.0, max_window=7 * 86400,
+                 error_rate=0.0, expires_in=3600, seed=0):
+        """Serve cassette if given, else synthetic data for sensors (serial numbers)."""
+        self.sensors = list(sensors)
+        self.cassette = cassette
+        self.interval = interval
+        self.jitter = jitter
+        self.latency = latency
+        self.max_window = max_window
+        self.error_rate = error_rate
+        self.expires_in = expires_in
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def location(self, serial):
+        return 'loc-' + serial
+
+    def configuration(self, new_api):
+        locations = []
+        for serial in self.sensors:
+            if new_api:
+                locations.append({'location_identifier': self.location(serial),
+                                  'sensor': {'sensor_identifier': serial}})
+            else:
+                locations.append({'location_identifier': self.location(serial), 'sensor_serial': serial})
+        return {'locations': locations}
+
+    def sample(self, location, ts, new_api):
+        """Return the synthetic sample of location at ts (a multiple of interval), the same on every request."""
+        rnd = random.Random(zlib.crc32(location.encode('utf-8')) ^ ts ^ self.seed)
+        capture = capture_time(ts + rnd.randint(-self.jitter, self.jitter))
+        temperature = round(rnd.uniform(5.0, 30.0), 2)
+        if new_api:
+            return {'capture_datetime_utc': capture,
+                    'air_temperature_celsius': temperature,
+                    'light': round(rnd.uniform(0.0, 40.0), 2),
+                    'soil_moisture_percent': round(rnd.uniform(5.0, 50.0), 1),
+                    'fertilizer_level': round(rnd.uniform(0.0, 5.0), 2),
+                    'battery_percent': 80}
+        return {'capture_ts': capture,
+                'air_temperature_celsius': temperature,
+                'par_umole_m2s': round(rnd.uniform(0.0, 2000.0), 1),
+                'vwc_percent': round(rnd.uniform(5.0, 50.0), 1)}
+
+    def samples(self, location, from_ts, to_ts, new_api):
+        first = -(-from_ts // self.interval) * self.interval
+        times = range(first, to_ts + 1, self.interval)
+        return {'samples': [self.sample(location, ts, new_api) for ts in times]}
+
+    def respond(self, path, query):
+        """Return (status, json response) for a GET request."""
+        params = dict(query)
+        if path == '/user/v1/authenticate':
+            return 200, {'access_token': 'stub', 'expires_in': self.expires_in}
+        if path in (OLD_CONFIG, NEW_CONFIG):
+            return 200, self.configuration(path == NEW_CONFIG)
+        for prefix in (OLD_SAMPLES, NEW_SAMPLES):
+            if path.startswith(prefix):
+                location = path[len(prefix):]
+                if location not in [self.location(serial) for serial in self.sensors]:
+                    return 404, {'error': 'unknown location'}
+                from_ts = parse_param_time(params['from_datetime_utc'])
+                to_ts = parse_param_time(params['to_datetime_utc'])
+                if self.max_window and to_ts - from_ts > self.max_window:
+                    return 400, {'error': 'time range longer than %d s' % self.max_window}
+                return 200, self.samples(location, from_ts, to_ts, prefix == NEW_SAMPLES)
+        return 404, {'error': 'unknown path'}
+
+    def handle(self, method, url):
+        """Return (status, content type, body) for a request."""
+        with self.lock:
+            self.requests += 1
+            fail = self.error_rate and self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            sleep(self.latency)
+        if fail:
+            return 503, 'application/json', json.dumps({'error': 'unavailable'})
+        if self.cassette is not None:
+            interaction = self.cassette.find(method, url)
+            if interaction is None:
+                return 404, 'text/plain', 'not recorded'
+            return interaction['status'], interaction['content_type'], interaction['body']
+        parts = urlsplit(url)
+        status, response = self.respond(parts.path, parse_qsl(parts.query))
+        return status, 'application/json', json.dumps(response)
+
+    def server(self, address=('127.0.0.1', 0)):
+        """Return a threading HTTP server for this stub, not started yet."""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections open for the client's connection pool
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                # the authentication sends the credentials as body
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                status, content_type, body = stub.handle('GET', self.path)
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                2 <= debug and BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+        return StubServer(address, Handler)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
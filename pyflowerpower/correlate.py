@@ -0,0 +1,68 @@
+from __future__ import print_function
+
+from collections import namedtuple
+import string
+
+from pyflowerpower.history import read_history_file, session_index, session_times
+from pyflowerpower.join import record_times, tolerance_join, join_stats, write_columns
+
+'''
+Correlation of downloaded sensor history with cloud samples, as done by fp-clouddata.py.
+
+The functions only take and return picklable values, so that files can be read and
+comparisons written in worker processes while the cloud samples are fetched by the
+main process.
+'''
+
+SensorFile = namedtuple('SensorFile', ['filename', 'params', 'records', 'sessions', 'times', 'head', 'sens_id'])
+
+
+def read_sensor_file(filename):
+    """Read a hist-*.dat file with all its sessions and their estimated start times."""
+    params, records, head = read_history_file(filename)
+    sessions = session_index(records, int(params['sid']), int(params['sp']))
+    startup = int(params['current time']) - int(params['sensor time'])
+    times = session_times(sessions, startup + int(params['lts']))
+    sens_id = 'ABCD'
+    sens_addr = params['sensor addr']
+    if len(sens_addr.split(":")) == 6:
+        sens_id = ''.join(sens_addr.split(":")[4:]).upper()
+    return SensorFile(filename, params, records, sessions, times, head, sens_id)
+
+
+def select_sessions(sessions, spec):
+    """Return the sessions selected by spec: 'last', 'all' or a comma separated list of session ids."""
+    if spec == 'last':
+        return sessions[-1:]
+    if spec == 'all':
+        return sessions
+    ids = set(int(sid) for sid in spec.split(','))
+    return [s for s in sessions if s.session in ids]
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent (start, end) ranges, return them sorted."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def write_comparison(filename, script, head, data, first_ts, period, cdata, tolerance):
+    """Join the records data, starting at first_ts, with the SampleColumns cdata and write them to filename.
+
+    Returns the join statistics, see join.join_stats.
+    """
+    with open(filename, 'w') as f:
+        f.write('# Cloud samples collected by %s\n' % script)
+        f.write(''.join(filter(lambda x: x in string.printable, head)))  # remove non-printable characters
+        f.write('#timestamp idx h0 h1 h2 h3 h4 h5 '+(' '.join(cdata.titles))+'\n')
+
+        joined = tolerance_join(record_times(first_ts, period, len(data)), cdata.ts, tolerance)
+        rows, idx = joined.samples, joined.records
+        write_columns(f, [cdata.ts[rows], idx] + [data[idx, i] for i in range(data.shape[1])] +
+                      [c[rows] for c in cdata.columns])
+    return join_stats(joined, len(data), len(cdata))
@@ -0,0 +1,130 @@
+from __future__ import print_function
+
+import json
+import os
+from time import time
+
+from bluepy.btle import DefaultDelegate
+
+from pyflowerpower.sensor import device_is_fp
+
+'''
+Streaming discovery: sensors are handed to a DownloadScheduler as their advertisements
+arrive, so processing starts while scanning continues. With a ScanGate, the scan is
+stopped while connections are made on the scanning adapter.
+'''
+
+debug = 0
+
+# never downloaded sensors go first in 'overdue' order
+NEVER = 1e9
+
+
+def load_registry(filename):
+    """Return the sensor addresses of an address table like addresstable.json."""
+    if not filename or not os.path.exists(filename):
+        return set()
+    try:
+        return set(addr.lower() for addr in json.loads(open(filename).read()).keys())
+    except ValueError:
+        print("Could not load address table from file '%s'." % filename)
+        return set()
+
+
+def start_scan(scanner, gate=None):
+    if gate is not None:
+        gate.start_scan()
+    scanner.start()
+
+
+def stop_scan(scanner, gate=None):
+    try:
+        scanner.stop()
+    finally:
+        if gate is not None:
+            gate.stop_scan()
+
+
+def pause_scan(scanner, gate=None):
+    """Stop scanning while gate has connections in flight, return the time paused."""
+    if gate is None or not gate.paused():
+        return 0.0
+    start = time()
+    2 <= debug and print("scan paused for connections")
+    stop_scan(scanner, gate)
+    start_scan(scanner, gate)
+    return time() - start
+
+
+def rssi_priority(dev, known):
+    """Strongest signal first."""
+    return -dev.rssi
+
+
+def overdue_priority(dev, known, now=None):
+    """Longest time since the last download first, then strongest signal."""
+    if 'time' not in known:
+        return -NEVER - dev.rssi / 1000.0
+    return -((now or time()) - known['time']) - dev.rssi / 1000.0
+
+
+PRIORITIES = {
+    'rssi': rssi_priority,
+    'overdue': overdue_priority,
+}
+
+
+class StreamingDiscovery(DefaultDelegate):
+
+    def __init__(self, scheduler, state, order='overdue', registry=(), accept=None):
+        """Submit each discovered FlowerPower once to scheduler.
+
+        state is the SensorState used for the overdue order, registry a set of addresses
+        expected to be seen; scanning stops early once all of them were seen. With
+        accept(addr), only sensors it returns a true value for are submitted.
+        """
+        DefaultDelegate.__init__(self)
+        self.scheduler = scheduler
+        self.state = state
+        self.priority = PRIORITIES[order]
+        self.registry = set(registry)
+        self.accept = accept
+        self.seen = set()
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        addr = dev.addr.lower()
+        if addr in self.seen or not device_is_fp(dev):
+            return
+        self.seen.add(addr)
+        if self.accept is not None and not self.accept(addr):
+            print("Device %s (%s), RSSI=%d dB, not due" % (dev.addr, dev.addrType, dev.rssi))
+            return
+        priority = self.priority(dev, self.state.get(addr))
+        print("Device %s (%s), RSSI=%d dB" % (dev.addr, dev.addrType, dev.rssi))
+        2 <= debug and print("%s: queued with priority %.3f" % (addr, priority))
+        self.scheduler.submit(dev.addr, dev, priority)
+
+    def complete(self):
+        return len(self.registry) > 0 and self.registry <= self.seen
+
+    def run(self, scanner, timeout=15.0, step=0.5, gate=None):
+        """Scan with scanner (using this delegate) for at most timeout seconds.
+
+        With a gate (ScanGate), scanning pauses while connections are in flight on the
+        scanning adapter; time paused does not count towards timeout.
+        """
+        start = time()
+        scanner.clear()
+        start_scan(scanner, gate)
+        try:
+            while time() - start < timeout and not self.complete():
+                scanner.process(max(0.01, min(step, timeout - (time() - start))))
+                start += pause_scan(scanner, gate)
+        finally:
+            stop_scan(scanner, gate)
+        if self.complete():
+            print("All %d registered sensors seen after %.1f s" % (len(self.registry), time() - start))
+        elif self.registry:
+            missing = sorted(self.registry - self.seen)
+            print("Registered sensors not seen: %s" % ', '.join(missing))
+        return self.seen
@@ -0,0 +1,231 @@
+from __future__ import print_function
+
+from collections import namedtuple
+import os
+import struct
+import numpy as np
+
+'''
+Decoding of FlowerPower history data, see Sensordata.md for the data layout.
+
+The raw upload buffer comprises a 16 byte header followed by n x 12 byte records,
+with all values in MSB order. A record starting with 0x8000 marks a new session.
+'''
+
+HEADER_FORMAT = '>BBHLLHH'
+HEADER_SIZE = 16
+RECORD_SIZE = 12
+RECORD_FIELDS = 6
+SESSION_MARKER = 0x8000
+UNKNOWN_SESSION = 0xffff
+
+RECORD_DTYPE = np.dtype('>u2')
+
+HEADER_LINE = "# %d,%d,records=%d,lts=%d,lidx=%d,sid=%d,sp=%d\n"
+RECORD_LINE = "%d " + " 0x%04x" * RECORD_FIELDS + " %d" * RECORD_FIELDS + "\n"
+
+# number of records formatted in one go when writing text
+CHUNK_RECORDS = 4096
+# number of text lines decoded in one go when reading
+CHUNK_LINES = 65536
+
+# records start:end of values belong to session, recorded every period seconds
+Session = namedtuple('Session', ['session', 'period', 'start', 'end'])
+
+
+class History:
+    """History header and records decoded from a raw upload buffer.
+
+    `values` is an (n, 6) array of the raw record fields, `markers` flags the rows
+    holding a session marker instead of measurement data.
+    """
+
+    def __init__(self, header, values):
+        self.header = tuple(header)
+        self.values = values
+        d1, d2, self.records, self.last_ts, self.last_idx, self.session, self.period = self.header
+
+    @classmethod
+    def from_text(cls, filename):
+        """Read a hist-*.dat file as written by fp-download.py, see read_history_file."""
+        params, values, head = read_history_file(filename)
+        header = None
+        for line in head.splitlines():
+            if 'records=' in line:
+                header = [int(v.split('=')[-1]) for v in line[1:].strip().split(',')]
+                break
+        if header is None:
+            raise ValueError("no history header found in %s" % filename)
+        return cls(header, values)
+
+    def bytes(self):
+        """Return the raw upload buffer."""
+        return struct.pack(HEADER_FORMAT, *self.header) + self.values.astype(RECORD_DTYPE).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        header = struct.unpack(HEADER_FORMAT, data[0:HEADER_SIZE])
+        n = int((len(data) - HEADER_SIZE) / RECORD_SIZE)
+        values = np.frombuffer(data, dtype=RECORD_DTYPE, count=n*RECORD_FIELDS, offset=HEADER_SIZE)
+        return cls(header, values.reshape(n, RECORD_FIELDS))
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def markers(self):
+        return self.values[:, 0] == SESSION_MARKER
+
+    def header_str(self):
+        return HEADER_LINE % self.header + "#\n"
+
+    def index(self, i):
+        """Global entry index of record i."""
+        return self.last_idx - len(self.values) + 1 + i
+
+    def lines(self, first=0):
+        """Yield the text representation of the records in chunks, numbered from first."""
+        for start in range(0, len(self.values), CHUNK_RECORDS):
+            chunk = self.values[start:start+CHUNK_RECORDS].astype(np.int64)
+            rows = np.empty((len(chunk), 1 + 2*RECORD_FIELDS), dtype=np.int64)
+            rows[:, 0] = np.arange(first+start, first+start+len(chunk))
+            rows[:, 1:1+RECORD_FIELDS] = chunk
+            rows[:, 1+RECORD_FIELDS:] = chunk
+            yield RECORD_LINE * len(chunk) % tuple(rows.ravel().tolist())
+
+    def write(self, f):
+        f.write(self.header_str())
+        for text in self.lines():
+            f.write(text)
+
+    def str(self):
+        return self.header_str() + ''.join(self.lines())
+
+
+def append_history(filename, head, history):
+    """Append the records of history to an existing hist-*.dat file.
+
+    The file comment block is replaced by head and the header line of history,
+    with the number of records updated to cover all records in the file.
+    """
+    with open(filename) as f:
+        records = [line for line in f if line.strip() and line[0] != '#']
+    header = list(history.header)
+    header[2] = len(records) + len(history)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(head)
+        f.write(HEADER_LINE % tuple(header) + "#\n")
+        f.writelines(records)
+        for text in history.lines(len(records)):
+            f.write(text)
+    os.rename(tmp, filename)
+
+
+def parse_params(line, params):
+    """Add the values of a comment line of a hist-*.dat file to params."""
+    if ': ' in line:
+        key, value = line[1:].strip().split(': ', 1)
+        params[key] = value
+    elif ',' in line and '=' in line:
+        for kv in line[1:].strip().split(','):
+            if '=' in kv:
+                key, value = kv.split('=')
+                params[key] = value
+
+
+def decode_lines(lines):
+    """Decode the value columns of record lines into an (n, 6) array."""
+    values = np.loadtxt(lines, usecols=range(7, 7+RECORD_FIELDS), dtype=np.int64, ndmin=2)
+    return values.astype(RECORD_DTYPE).reshape(-1, RECORD_FIELDS)
+
+
+def read_history_file(filename, last_session=False, chunk_lines=CHUNK_LINES):
+    """Stream a hist-*.dat file, return (params, values, head).
+
+    params holds the values of all comment lines (later ones take precedence), values
+    the records as (n, 6) array and head the comment lines. Record lines are decoded
+    in chunks of chunk_lines. With last_session, records before the last session
+    marker are dropped as soon as the marker is read, so memory use only depends on
+    the size of the last session.
+    """
+    params = {}
+    head = []
+    chunks = []
+    lines = []
+    read = [0]
+
+    def flush():
+        values = decode_lines(lines) if lines else np.zeros((0, RECORD_FIELDS), dtype=RECORD_DTYPE)
+        starts = np.flatnonzero(values[:, 0] == SESSION_MARKER)
+        for i in starts:
+            print("new session %d starts in record %d." % (values[i, 1], read[0] + i))
+        read[0] += len(lines)
+        del lines[:]
+        if last_session and len(starts):
+            dropped = sum(len(c) for c in chunks) + starts[-1]
+            if dropped:
+                print("Dropping data from previous session with %d entries." % dropped)
+            del chunks[:]
+            values = values[starts[-1]:]
+        chunks.append(values)
+
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if line[0] == '#':
+                head.append(line if line.endswith('\n') else line + '\n')
+                parse_params(line, params)
+                continue
+            lines.append(line)
+            if len(lines) >= chunk_lines:
+                flush()
+    if lines or not chunks:
+        flush()
+
+    values = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+    return params, values, ''.join(head)
+
+
+def session_index(values, session=UNKNOWN_SESSION, period=0):
+    """Return the Sessions of the records in values, found from their session markers.
+
+    A session starts with its marker record. If there is no marker at all, all records
+    belong to session with period, usually taken from the header. Otherwise, records
+    before the first marker belong to an earlier, unknown session.
+    """
+    if not len(values):
+        return []
+    starts = [int(i) for i in np.flatnonzero(values[:, 0] == SESSION_MARKER)]
+    if not starts or starts[0] > 0:
+        starts.insert(0, 0)
+    sessions = []
+    for n, start in enumerate(starts):
+        end = starts[n+1] if n+1 < len(starts) else len(values)
+        if values[start, 0] == SESSION_MARKER:
+            sessions.append(Session(int(values[start, 1]), int(values[start, 2]), start, end))
+        elif len(starts) == 1:
+            sessions.append(Session(session, period, start, end))
+        else:
+            sessions.append(Session(UNKNOWN_SESSION, 0, start, end))
+    return sessions
+
+
+def session_times(sessions, last_ts):
+    """Return the time of the first record of each session, None where the period is unknown.
+
+    Times are counted back from last_ts, the time of the last record, one period per
+    record. As the time between sessions is not recorded, times of earlier sessions
+    are estimates assuming the sensor recorded without a break.
+    """
+    times = [None] * len(sessions)
+    ts = last_ts
+    for n in range(len(sessions) - 1, -1, -1):
+        s = sessions[n]
+        if not s.period:
+            break
+        times[n] = ts - s.period * (s.end - s.start - 1)
+        if n:
+            ts = times[n] - (sessions[n-1].period or s.period)
+    return times
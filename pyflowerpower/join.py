@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+from collections import namedtuple
+
+import numpy as np
+
+'''
+Joining of sensor history records with cloud samples by time.
+
+Record times are computed for all records at once from the first record time and the
+session period. Each cloud sample is matched to the record nearest in time, if it is
+within the tolerance, using a sorted search instead of per sample arithmetic. The
+differences between sample and record times (residuals) show the offset between the
+sensor clock and the cloud.
+'''
+
+JoinResult = namedtuple('JoinResult', ['samples', 'records', 'residuals'])
+
+
+def record_times(first_ts, period, n):
+    """Return the unix times of n records, period seconds apart, starting at first_ts."""
+    return first_ts + period * np.arange(n, dtype=np.int64)
+
+
+def tolerance_join(record_ts, sample_ts, tolerance):
+    """Match sorted sample times to the nearest of the sorted record times, at most tolerance seconds away.
+
+    Returns a JoinResult with the indices of the matched samples, the indices of their
+    records and the residuals (sample time - record time). On a tie, the later record
+    is taken. Several samples may match the same record.
+    """
+    record_ts = np.asarray(record_ts, dtype=np.int64)
+    sample_ts = np.asarray(sample_ts, dtype=np.int64)
+    if not len(record_ts) or not len(sample_ts):
+        empty = np.empty(0, dtype=np.int64)
+        return JoinResult(empty, empty, empty)
+    pos = np.searchsorted(record_ts, sample_ts)
+    after = np.minimum(pos, len(record_ts) - 1)
+    before = np.maximum(pos - 1, 0)
+    nearest = np.where(np.abs(record_ts[after] - sample_ts) <= np.abs(sample_ts - record_ts[before]), after, before)
+    residuals = sample_ts - record_ts[nearest]
+    matched = np.flatnonzero(np.abs(residuals) <= tolerance)
+    return JoinResult(matched, nearest[matched], residuals[matched])
+
+
+def join_stats(result, n_records, n_samples):
+    """Return a dict with counts of matched and unmatched records and samples, and residual statistics."""
+    stats = {
+        'matched': len(result.samples),
+        'unmatched_samples': n_samples - len(result.samples),
+        'unmatched_records': n_records - len(np.unique(result.records)),
+    }
+    if len(result.residuals):
+        residuals = result.residuals.astype(float)
+        stats.update(offset_median=float(np.median(residuals)), offset_mean=float(residuals.mean()),
+                     offset_std=float(residuals.std()), offset_min=int(residuals.min()),
+                     offset_max=int(residuals.max()))
+    return stats
+
+
+def format_column(column):
+    """Format a column as an array of strings, each like str() of the python value.
+
+    NaN in float columns stands for a missing value and is formatted as None.
+    """
+    column = np.asarray(column)
+    if column.dtype.kind in 'iub':
+        return column.astype(np.int64).astype(str).astype(object)
+    if column.dtype.kind == 'f':
+        # numpy formats float64 with the shortest repr, like str() of python floats
+        text = column.astype(np.float64).astype(str).astype(object)
+        text[np.isnan(column)] = 'None'
+        return text
+    return np.array(['None' if v != v else str(v) for v in column], dtype=object)
+
+
+def write_columns(f, columns, sep='\t', chunk=65536):
+    """Write columns of equal length as lines of separated values."""
+    texts = [format_column(c) for c in columns]
+    n = len(texts[0]) if texts else 0
+    for start in range(0, n, chunk):
+        lines = [sep.join(row) + '\n' for row in zip(*[t[start:start + chunk] for t in texts])]
+        f.write(''.join(lines))
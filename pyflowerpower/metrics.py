@@ -0,0 +1,148 @@
+from __future__ import print_function
+
+import os
+import threading
+from time import time
+
+'''
+Per-transfer statistics of history uploads and export in Prometheus textfile format.
+'''
+
+TX_STATE_NAMES = {0: 'idle', 1: 'transfer', 2: 'wait_ack'}
+
+
+class TransferStats:
+
+    def __init__(self):
+        self.started = 0.0
+        self.finished = 0.0
+        self.tx_state = None
+        self.state_since = 0.0
+        self.state_seconds = dict((name, 0.0) for name in TX_STATE_NAMES.values())
+        self.timeouts = {}
+        self.acks = 0
+        self.nacks = 0
+        self.bytes = 0
+        self.frames = 0
+        self.duplicates = 0
+        self.windows = 0
+        self.complete = 0
+
+    def start(self, tx_state=0):
+        self.started = self.state_since = time()
+        self.tx_state = tx_state
+
+    def state(self, tx_state):
+        now = time()
+        name = TX_STATE_NAMES.get(self.tx_state)
+        if name is not None:
+            self.state_seconds[name] += now - self.state_since
+        self.tx_state = tx_state
+        self.state_since = now
+
+    def ack(self):
+        self.acks += 1
+
+    def nack(self):
+        self.nacks += 1
+
+    def timeout(self, kind):
+        self.timeouts[kind] = self.timeouts.get(kind, 0) + 1
+
+    def finish(self, frames):
+        """Stop timing and take over the counters of the FrameAssembler frames."""
+        self.state(self.tx_state)
+        self.finished = time()
+        self.bytes = frames.bytes_received()
+        self.frames = frames.frames_received
+        self.duplicates = frames.duplicates
+        self.windows = frames.windows()
+        self.complete = frames.frames_complete
+
+    def duration(self):
+        return (self.finished or time()) - self.started
+
+    def throughput(self):
+        """Effective throughput in bytes per second."""
+        duration = self.duration()
+        return float(self.bytes) / duration if duration > 0 else 0.0
+
+    def frame_rate(self):
+        duration = self.duration()
+        return float(self.frames) / duration if duration > 0 else 0.0
+
+    def dict(self):
+        return {
+            'bytes': self.bytes,
+            'frames': self.frames,
+            'duplicates': self.duplicates,
+            'windows': self.windows,
+            'acks': self.acks,
+            'nacks': self.nacks,
+            'complete': self.complete,
+            'duration': self.duration(),
+            'throughput': self.throughput(),
+            'frame_rate': self.frame_rate(),
+            'state_seconds': dict(self.state_seconds),
+            'timeouts': dict(self.timeouts),
+        }
+
+    def str(self):
+        return "%d bytes in %d frames (%d duplicates), %d windows, %d ACK, %d NACK, %.1f s, %.0f bytes/s" % \
+            (self.bytes, self.frames, self.duplicates, self.windows, self.acks, self.nacks,
+             self.duration(), self.throughput())
+
+
+METRICS = [
+    ('fp_upload_bytes', 'Bytes received in the last history transfer', lambda s: s.bytes),
+    ('fp_upload_frames', 'Distinct frames received in the last history transfer', lambda s: s.frames),
+    ('fp_upload_duplicate_frames', 'Frames received more than once (retransmissions)', lambda s: s.duplicates),
+    ('fp_upload_windows', 'Number of 128 frame windows of the last history transfer', lambda s: s.windows),
+    ('fp_upload_acks', 'ACKs sent in the last history transfer', lambda s: s.acks),
+    ('fp_upload_nacks', 'NACKs sent in the last history transfer', lambda s: s.nacks),
+    ('fp_upload_complete', 'Whether the last history transfer was complete', lambda s: s.complete),
+    ('fp_upload_duration_seconds', 'Duration of the last history transfer', lambda s: s.duration()),
+    ('fp_upload_throughput_bytes_per_second', 'Effective throughput of the last history transfer',
+     lambda s: s.throughput()),
+    ('fp_upload_timestamp_seconds', 'End time of the last history transfer', lambda s: s.finished),
+]
+
+
+class PrometheusFile:
+    """Keep the last transfer statistics per sensor in a Prometheus textfile.
+
+    The file is rewritten atomically on every update, for the node exporter's
+    textfile collector.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.sensors = {}
+        self.lock = threading.Lock()
+
+    def update(self, addr, stats):
+        with self.lock:
+            self.sensors[addr] = stats
+            self.write()
+
+    def write(self):
+        lines = []
+        for name, desc, value in METRICS:
+            lines.append('# HELP %s %s' % (name, desc))
+            lines.append('# TYPE %s gauge' % name)
+            for addr, stats in sorted(self.sensors.items()):
+                lines.append('%s{addr="%s"} %s' % (name, addr, repr(float(value(stats)))))
+        lines.append('# HELP fp_upload_state_seconds Time spent in each sender state in the last history transfer')
+        lines.append('# TYPE fp_upload_state_seconds gauge')
+        for addr, stats in sorted(self.sensors.items()):
+            for state, seconds in sorted(stats.state_seconds.items()):
+                lines.append('fp_upload_state_seconds{addr="%s",state="%s"} %s' % (addr, state, repr(seconds)))
+        lines.append('# HELP fp_upload_timeouts Timeouts fired in the last history transfer')
+        lines.append('# TYPE fp_upload_timeouts gauge')
+        for addr, stats in sorted(self.sensors.items()):
+            for kind, count in sorted(stats.timeouts.items()):
+                lines.append('fp_upload_timeouts{addr="%s",kind="%s"} %d' % (addr, kind, count))
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, self.filename)
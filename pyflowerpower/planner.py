@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+from collections import namedtuple
+from time import time
+
+'''
+Download planning from the sensor state kept by fp-download.py (see SensorState).
+
+A sensor's history buffer holds capacity entries, one per session period, so it is
+filled with new entries capacity * period seconds after the last download; entries
+not downloaded by then are overwritten. Sensors are planned to be downloaded after a
+fraction (safety) of this fill time, which grows on low batteries up to max_fill,
+as every connection costs battery. Downloads are spread over time slots so that at
+most per_slot connections are planned per slot.
+
+The state entries used are 'time' (last download), 'period', 'battery' and
+'entries', 'capacity' (see observe()).
+'''
+
+# entries the sensor holds, if not observed: 80 days at the default 15 minute period
+DEFAULT_CAPACITY = 7680
+
+PlanEntry = namedtuple('PlanEntry', ['addr', 'time', 'due', 'interval', 'battery', 'reason'])
+
+
+def observe(known, battery, entries, last_index):
+    """Return state values to store for a sensor after reading its battery and history registers.
+
+    The capacity is taken as known once the number of entries stayed the same while
+    the last index advanced, i.e. the history buffer is full.
+    """
+    values = {'battery': battery, 'entries': entries, 'sensor_last_index': last_index}
+    if known.get('entries') == entries and last_index > known.get('sensor_last_index', last_index):
+        values['capacity'] = entries
+    return values
+
+
+class DownloadPlanner:
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, safety=0.5, max_fill=0.9, low_battery=20, good_battery=50,
+                 min_interval=6 * 3600, slot=300, per_slot=1):
+        self.capacity = capacity
+        self.safety = safety
+        self.max_fill = max_fill
+        self.low_battery = low_battery
+        self.good_battery = good_battery
+        self.min_interval = min_interval
+        self.slot = slot
+        self.per_slot = per_slot
+
+    def fill_fraction(self, battery):
+        """Fraction of the fill time to wait between downloads at the given battery level."""
+        if battery is None or battery >= self.good_battery:
+            return self.safety
+        if battery <= self.low_battery:
+            return self.max_fill
+        scale = float(self.good_battery - battery) / (self.good_battery - self.low_battery)
+        return self.safety + scale * (self.max_fill - self.safety)
+
+    def interval(self, known):
+        capacity = known.get('capacity') or self.capacity
+        period = known.get('period') or 900
+        fill_time = capacity * period
+        # never plan beyond the point where entries would be lost
+        return min(max(self.min_interval, self.fill_fraction(known.get('battery')) * fill_time),
+                   self.max_fill * fill_time)
+
+    def due(self, known):
+        if 'time' not in known:
+            return 0
+        return known['time'] + self.interval(known)
+
+    def reason(self, known):
+        if 'time' not in known:
+            return "never downloaded"
+        battery = known.get('battery')
+        if battery is not None and battery < self.good_battery:
+            return "battery %d%%" % battery
+        return "capacity"
+
+    def plan(self, sensors, now=None):
+        """Plan the next download of all sensors (address -> state), return PlanEntries by time."""
+        now = now or time()
+        entries = sorted((self.due(known), addr) for addr, known in sensors.items())
+        slots = {}
+        plan = []
+        for due, addr in entries:
+            known = sensors[addr]
+            start = max(now, due)
+            first = n = int((start - now) / self.slot)
+            while slots.get(n, 0) >= self.per_slot:
+                n += 1
+            slots[n] = slots.get(n, 0) + 1
+            if n != first:
+                start = now + n * self.slot
+            plan.append(PlanEntry(addr, start, due, self.interval(known), known.get('battery'), self.reason(known)))
+        return sorted(plan, key=lambda e: e.time)
+
+    def current(self, sensors, now=None):
+        """Return the addresses planned for the current slot, the others are deferred to a later slot."""
+        now = now or time()
+        return set(e.addr for e in self.plan(sensors, now) if e.time < now + self.slot)
+
+    def is_due(self, known, now=None):
+        return self.due(known) <= (now or time())
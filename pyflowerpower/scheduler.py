@@ -0,0 +1,161 @@
+from __future__ import print_function
+
+import itertools
+import threading
+import traceback
+
+try:
+    from queue import PriorityQueue
+except ImportError:
+    from Queue import PriorityQueue
+
+'''
+Distribution of sensor jobs over a pool of worker threads, one or more per local
+bluetooth adapter. Jobs failing are queued again with lower priority after a delay.
+
+When the adapter used for scanning also runs jobs, a ScanGate keeps both apart: jobs
+wait until the scan is stopped, and the scan is only restarted when no job is left.
+'''
+
+debug = 0
+
+
+class ScanGate:
+
+    def __init__(self, iface):
+        """Keep scanning and connections on adapter iface (N of hciN) apart."""
+        self.iface = iface
+        self.cond = threading.Condition()
+        self.connections = 0
+        self.scanning = False
+
+    def enter(self, iface):
+        """Called by a worker before connecting on iface, returns once the scan is stopped."""
+        if iface != self.iface:
+            return
+        with self.cond:
+            self.connections += 1
+            while self.scanning:
+                self.cond.wait(1.0)
+
+    def leave(self, iface):
+        if iface != self.iface:
+            return
+        with self.cond:
+            self.connections -= 1
+            self.cond.notify_all()
+
+    def paused(self):
+        """True if the scan should be stopped for a connection waiting or in flight."""
+        return self.connections > 0
+
+    def start_scan(self):
+        """Called before starting the scan, returns once no connection is in flight."""
+        with self.cond:
+            while self.connections > 0:
+                self.cond.wait(1.0)
+            self.scanning = True
+
+    def stop_scan(self):
+        """Called after the scan was stopped."""
+        with self.cond:
+            self.scanning = False
+            self.cond.notify_all()
+
+
+class DownloadScheduler:
+
+    def __init__(self, job, adapters=(0,), links=1, concurrency=0, retries=2, retry_delay=10.0, done=None,
+                 gate=None):
+        """Create a scheduler calling job(item, iface) for every submitted item.
+
+        The job returns a true value on success. With concurrency > 0, at most that many
+        jobs run at the same time, regardless of the number of workers. done(key, ok) is
+        called when an item is finished, after the last retry. With a gate (ScanGate),
+        jobs on the scanning adapter only run while the scan is stopped.
+        """
+        self.job = job
+        self.done = done
+        self.gate = gate
+        self.ifaces = [iface for iface in adapters for i in range(0, links)]
+        self.slots = threading.Semaphore(concurrency) if concurrency > 0 else None
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.queue = PriorityQueue()
+        self.seq = itertools.count()
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.results = {}
+        self.attempts = {}
+        self.workers = []
+
+    def submit(self, key, item, priority=0):
+        """Queue item under key, lower priority values are processed first."""
+        with self.cond:
+            self.pending += 1
+        self.queue.put((priority, next(self.seq), key, item, 0))
+
+    def start(self):
+        for iface in self.ifaces:
+            t = threading.Thread(target=self.worker, args=(iface,))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def wait(self):
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait(1.0)
+
+    def stop(self):
+        for t in self.workers:
+            self.queue.put((float('inf'), next(self.seq), None, None, 0))
+        for t in self.workers:
+            t.join()
+        self.workers = []
+
+    def run(self):
+        """Process all submitted items and return the results per key."""
+        self.start()
+        self.wait()
+        self.stop()
+        return self.results
+
+    def worker(self, iface):
+        while True:
+            priority, seq, key, item, attempt = self.queue.get()
+            if key is None:
+                break
+            1 <= debug and print("hci%d: processing %s (attempt %d)" % (iface, key, attempt + 1))
+            ok = 0
+            if self.slots:
+                self.slots.acquire()
+            if self.gate is not None:
+                self.gate.enter(iface)
+            try:
+                ok = self.job(item, iface)
+            except Exception as e:
+                print("Problems while handling %s:" % key, e)
+                2 <= debug and traceback.print_exc()
+            finally:
+                if self.gate is not None:
+                    self.gate.leave(iface)
+                if self.slots:
+                    self.slots.release()
+
+            self.attempts[key] = attempt + 1
+            if not ok and attempt < self.retries:
+                print("%s: queued again for retry %d of %d" % (key, attempt + 1, self.retries))
+                entry = (priority + 1, next(self.seq), key, item, attempt + 1)
+                t = threading.Timer(self.retry_delay * (attempt + 1), self.queue.put, args=(entry,))
+                t.daemon = True
+                t.start()
+                continue
+
+            self.results[key] = ok
+            if self.done is not None:
+                self.done(key, ok)
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify_all()
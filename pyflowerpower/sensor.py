@@ -0,0 +1,651 @@
+from __future__ import print_function
+
+from bluepy import btle
+from bluepy.btle import UUID, DefaultDelegate, Peripheral, BTLEException
+import struct
+import string
+from time import time
+
+from pyflowerpower.upload import FrameAssembler, UploadStates, AdaptiveTimeout, receiver_step
+from pyflowerpower.history import History
+from pyflowerpower.snapshot import Snapshot
+from pyflowerpower.metrics import TransferStats
+
+debug = 0
+
+'''
+BLE access to FlowerPower sensors, see FlowerPower-BLE.pdf for the services and characteristics.
+'''
+
+
+FP_GAP = 0x1800
+FP_DEV_NAME = 0x2A00
+
+FP_INFO = 0x180A
+FP_INFO_FW_VERSION = 0x2A26
+
+FB_BATTERY = 0x180f
+FB_BATTERY_LEVEL = 0x2A19
+
+FP_SERVICE_LIFE = 0x39e1FA00
+FP_CHAR_LIFE_DLI = 0x39e1FA01
+FP_CHAR_LIFE_SEC = 0x39e1FA02
+FP_CHAR_LIFE_STEMP = 0x39e1FA03
+FP_CHAR_LIFE_ATEMP = 0x39e1FA04
+FP_CHAR_LIFE_VWC = 0x39e1FA05
+FP_CHAR_LIFE_PERIOD = 0x39e1FA06
+FP_CHAR_LIFE_LED = 0x39e1FA07
+FP_CHAR_LIFE_LAST_MOVE = 0x39e1FA08
+FP_CHAR_LIFE_VWC_CAL = 0x39e1FA09
+FP_CHAR_LIFE_ATEMP_CAL = 0x39e1FA0A
+FP_CHAR_LIFE_DLI_CAL = 0x39e1FA0B
+FP_CHAR_LIFE_EA_CAL = 0x39e1FA0C
+FP_CHAR_LIFE_ECB_CAL = 0x39e1FA0D
+FP_CHAR_LIFE_ECP_CAL = 0x39e1FA0E
+
+FP_SERVICE_NEW = 0x39e1fd80
+FP_CHAR_NEW_1 = 0x39e1fd81
+FP_CHAR_NEW_2 = 0x39e1fd82
+FP_CHAR_NEW_3 = 0x39e1fd83
+FP_CHAR_NEW_4 = 0x39e1fd84
+FP_CHAR_NEW_5 = 0x39e1fd85
+FP_CHAR_NEW_6 = 0x39e1fd86
+
+FP_UPLOAD = 0x39e1FB00
+FP_UPLOAD_TX_BUFFER = 0x39e1FB01
+FP_UPLOAD_TX_STATUS = 0x39e1FB02
+FP_UPLOAD_RX_STATUS = 0x39e1FB03
+
+FP_HISTORY = 0x39e1FC00
+FP_HISTORY_NB_ENTRIES = 0x39e1FC01
+FP_HISTORY_LAST_INDEX = 0x39e1FC02
+FP_HISTORY_START_INDEX = 0x39e1FC03
+FP_HISTORY_SESSION_ID = 0x39e1FC04
+FP_HISTORY_SESSION_START = 0x39e1FC05
+FP_HISTORY_SESSION_PERIOD = 0x39e1FC06
+
+FB_CALIB = 0x39e1FE00
+FB_CALIB_DATA = 0x39e1FE01
+
+FB_CLOCK = 0x39e1FD00
+FB_TIME = 0x39e1FD01
+
+
+def device_is_fp(dev):
+    for (adtype, desc, value) in dev.getScanData():
+        if adtype == 6 and value == '1bc5d5a50200baafe211a88400fae139':
+            return 1
+    return 0
+
+
+def device_flags(dev):
+    """Return the manufacturer specific data (flags) advertised by a scanned device, '' if none."""
+    for (adtype, desc, value) in dev.getScanData():
+        if adtype == 0xff:
+            return value
+    return ''
+
+
+class ScanDelegate(DefaultDelegate):
+    def __init__(self):
+        DefaultDelegate.__init__(self)
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if not device_is_fp(dev):
+            return
+        if isNewDev:
+            print("Discovered device", dev.addr)
+        elif isNewData:
+            print("Received new data from", dev.addr)
+
+
+def FP_UUID(val):
+    if isinstance(val, str):
+        return UUID(val)
+    elif (val & 0xffff0000) == 0x00000000:
+        return UUID("%08X-0000-1000-8000-00805f9b34fb" % (val & 0xffffffff))
+    elif (val & 0xffff0000) == 0xf0000000:
+        return UUID("%08X-0451-4000-b000-000000000000" % (val & 0xffffffff))
+    elif (val & 0xffff0000) == 0x39e10000:
+        return UUID("%08X-84a8-11e2-afba-0002a5d5c51b" % (val & 0xffffffff))
+
+
+class FPRegister:
+
+    def __init__(self, p, handle, fmt):
+        self.p = p
+        self.handle = handle
+        self.fmt = fmt
+
+    def unpack(self, data):
+        return struct.unpack(self.fmt, data)[0]
+
+    def values(self):
+        if self.fmt == 'utf8':
+            return clean_str(self.read_raw().decode('utf8', 'replace'))
+        return struct.unpack(self.fmt, self.read_raw())
+
+    def read_raw(self):
+        return self.p.readCharacteristic(self.handle)
+
+    def read(self):
+        if self.fmt == 'utf8':
+            return str(self.read_raw())
+        return self.unpack(self.read_raw())
+
+    def str(self):
+        if self.fmt == 'utf8':
+            return str(self.read_raw())
+        return ','.join(map(str, struct.unpack(self.fmt, self.read_raw())))
+
+    def write(self, data):
+        return self.p.writeCharacteristic(self.handle, struct.pack(self.fmt, data))
+
+    def getHandle(self):
+        return self.handle
+
+
+def not_found(e):
+    """Whether e reports a service or characteristic the sensor does not have, rather than a link problem."""
+    if isinstance(e, IndexError):
+        return True
+    if hasattr(btle, 'BTLEGattError'):
+        return isinstance(e, btle.BTLEGattError)
+    # bluepy < 1.3 has error codes instead of subclasses
+    return getattr(e, 'code', None) == BTLEException.GATT_ERROR
+
+
+def clean_str(str):
+    return ''.join(filter(lambda x: x in string.printable, str))
+
+
+CT_UTF8 = 'utf8'
+CT_U8 = '<B'
+CT_U16 = '<H'
+CT_U32 = '<L'
+CT_F32 = '<f'
+
+# snapshot field, service, characteristic, format
+SNAPSHOT_REGS = [
+    ('name', FP_GAP, FP_DEV_NAME, CT_UTF8),
+    ('firmware', FP_INFO, FP_INFO_FW_VERSION, CT_UTF8),
+    ('sensor_time', FB_CLOCK, FB_TIME, CT_U32),
+    ('battery', FB_BATTERY, FB_BATTERY_LEVEL, CT_U8),
+    ('calib', FB_CALIB, FB_CALIB_DATA, '<11H'),
+    ('dli', FP_SERVICE_LIFE, FP_CHAR_LIFE_DLI, CT_U16),
+    ('soil_ec', FP_SERVICE_LIFE, FP_CHAR_LIFE_SEC, CT_U16),
+    ('soil_temp', FP_SERVICE_LIFE, FP_CHAR_LIFE_STEMP, CT_U16),
+    ('air_temp', FP_SERVICE_LIFE, FP_CHAR_LIFE_ATEMP, CT_U16),
+    ('soil_vwc', FP_SERVICE_LIFE, FP_CHAR_LIFE_VWC, CT_U16),
+    ('period', FP_SERVICE_LIFE, FP_CHAR_LIFE_PERIOD, CT_U8),
+    ('led', FP_SERVICE_LIFE, FP_CHAR_LIFE_LED, CT_U8),
+    ('last_move', FP_SERVICE_LIFE, FP_CHAR_LIFE_LAST_MOVE, CT_U32),
+    ('dli_cal', FP_SERVICE_LIFE, FP_CHAR_LIFE_DLI_CAL, CT_F32),
+    ('vwc_cal', FP_SERVICE_LIFE, FP_CHAR_LIFE_VWC_CAL, CT_F32),
+    ('air_temp_cal', FP_SERVICE_LIFE, FP_CHAR_LIFE_ATEMP_CAL, CT_F32),
+    ('ea_cal', FP_SERVICE_LIFE, FP_CHAR_LIFE_EA_CAL, CT_F32),
+    ('ecb_cal', FP_SERVICE_LIFE, FP_CHAR_LIFE_ECB_CAL, CT_F32),
+    ('ec_porous_cal', FP_SERVICE_LIFE, FP_CHAR_LIFE_ECP_CAL, CT_F32),
+    ('new_1', FP_SERVICE_NEW, FP_CHAR_NEW_1, CT_U16),
+    ('new_2', FP_SERVICE_NEW, FP_CHAR_NEW_2, CT_U16),
+    ('new_3', FP_SERVICE_NEW, FP_CHAR_NEW_3, CT_U16),
+    ('new_4', FP_SERVICE_NEW, FP_CHAR_NEW_4, CT_U16),
+    ('new_5', FP_SERVICE_NEW, FP_CHAR_NEW_5, CT_U16),
+    ('new_6', FP_SERVICE_NEW, FP_CHAR_NEW_6, CT_U8),
+]
+
+# live service characteristics sending notifications while a live period is set
+LIVE_REGS = [
+    ('dli', FP_CHAR_LIFE_DLI, CT_U16),
+    ('soil_ec', FP_CHAR_LIFE_SEC, CT_U16),
+    ('soil_temp', FP_CHAR_LIFE_STEMP, CT_U16),
+    ('air_temp', FP_CHAR_LIFE_ATEMP, CT_U16),
+    ('soil_vwc', FP_CHAR_LIFE_VWC, CT_U16),
+    ('dli_cal', FP_CHAR_LIFE_DLI_CAL, CT_F32),
+    ('vwc_cal', FP_CHAR_LIFE_VWC_CAL, CT_F32),
+    ('air_temp_cal', FP_CHAR_LIFE_ATEMP_CAL, CT_F32),
+    ('ea_cal', FP_CHAR_LIFE_EA_CAL, CT_F32),
+    ('ecb_cal', FP_CHAR_LIFE_ECB_CAL, CT_F32),
+    ('ec_porous_cal', FP_CHAR_LIFE_ECP_CAL, CT_F32),
+]
+LIVE_FIELDS = ['addr', 'time'] + [field for field, char, fmt in LIVE_REGS]
+
+
+class FPUpload(UploadStates):
+
+    def __init__(self, sensor):
+        self.p = sensor.p
+        self.rx_state = self.RX_STANDBY
+        self.tx_state = self.TX_IDLE
+        self.tx_updates = 0
+
+        self.c_upload_txb = sensor.register(FP_UPLOAD, FP_UPLOAD_TX_BUFFER, None)
+        self.c_upload_txs = sensor.register(FP_UPLOAD, FP_UPLOAD_TX_STATUS, CT_U8)
+        self.c_upload_rxs = sensor.register(FP_UPLOAD, FP_UPLOAD_RX_STATUS, CT_U8)
+
+        self.c_hist_nb_entries = sensor.register(FP_HISTORY, FP_HISTORY_NB_ENTRIES, CT_U16)
+        self.c_hist_last_index = sensor.register(FP_HISTORY, FP_HISTORY_LAST_INDEX, CT_U32)
+        self.c_hist_start_index = sensor.register(FP_HISTORY, FP_HISTORY_START_INDEX, CT_U32)
+        self.c_hist_session_id = sensor.register(FP_HISTORY, FP_HISTORY_SESSION_ID, CT_U16)
+        self.c_hist_session_start = sensor.register(FP_HISTORY, FP_HISTORY_SESSION_START, CT_U32)
+        self.c_hist_session_period = sensor.register(FP_HISTORY, FP_HISTORY_SESSION_PERIOD, CT_U16)
+
+        self.frames = FrameAssembler()
+        self.stats = TransferStats()
+        self.timing = AdaptiveTimeout()
+
+        self.data = b""
+        self.records = 0
+        self.last_ts = 0
+        self.last_idx = 0
+        self.session = 0
+        self.period = 0
+
+    def handle_tx_buffer(self, data):
+        frame = struct.unpack('<H', data[0:2])[0]
+        payload = data[2:20]
+        self.timing.notified('frames')
+        2 <= debug and print("got new tx data frame #%04x: %s" % (frame, ' %02x'*len(payload) % tuple(bytearray(payload))))
+        if not self.frames.add(frame, payload):
+            2 <= debug and print("> dropped frame %04x" % frame)
+            return
+        if frame == 0:
+            print("will download %d bytes in %d frames" % (self.frames.buffer_size, self.frames.frames_max))
+        if self.frames.frames_complete:
+            2 <= debug and print("maximum frame #%04x detected" % self.frames.frames_max)
+
+        return
+
+    def handle_tx_status(self, data):
+        state = struct.unpack('<B', data)[0]
+        2 <= debug and print("got new tx status %d" % state)
+        self.tx_state = state
+        self.tx_updates += 1
+        self.stats.state(state)
+        self.timing.notified(state == self.TX_TRANSFER and 'frames' or 'status')
+        return
+
+    def set_rx_state(self, state):
+        self.rx_state = state
+        self.c_upload_rxs.write(state)
+
+    def get_tx_state(self):
+        return self.c_upload_txs.read()
+
+    def wait(self, kind):
+        """Wait for the next notification with an adaptive timeout, return 0 on timeout."""
+        timeout = self.timing.timeout(kind)
+        if self.p.waitForNotifications(timeout):
+            return 1
+        if self.timing.expired():
+            print("deadline reached")
+            self.stats.timeout('deadline')
+        else:
+            print("timeout waiting for %s after %.2f s" % (kind == 'frames' and 'frames' or 'status change', timeout))
+            self.stats.timeout(kind)
+        return 0
+
+    def receive(self, index=None, count=None, deadline=None, checkpoint=None):
+        """Receive history data, starting at index or with the last count entries.
+
+        With deadline (absolute time), the transfer is aborted when the deadline is reached.
+        With a TransferCheckpoint, acknowledged windows are saved as they arrive; when
+        resuming (index is the checkpoint's next index), the data is stitched to the
+        records saved before.
+        """
+        print("receive new data...")
+        self.set_rx_state(self.RX_STANDBY)
+        self.frames.reset()
+        self.stats = TransferStats()
+        self.stats.start(self.tx_state)
+        self.timing = AdaptiveTimeout(deadline=deadline)
+        if checkpoint is not None:
+            checkpoint.begin()
+
+        if index is not None:
+            self.c_hist_start_index.write(index)
+        elif count is not None:
+            entries = self.c_hist_nb_entries.read()
+            last = self.c_hist_last_index.read()
+            print("entries:", entries)
+            print("last:", last)
+            # first entry in history seems to be entirely different
+            if count > entries:
+                count = entries
+            if count < 1:
+                count = 1
+            first = last-count+1
+            print("first:", first)
+            self.c_hist_start_index.write(first)
+
+        self.set_rx_state(self.RX_RECEIVING)
+        self.timing.start('status')
+        while True:
+            step = receiver_step(self.tx_state, self.frames, self.timing)
+            2 <= debug and print("TX state %d: %s" % (self.tx_state, step))
+            if step == 'deadline':
+                print("deadline reached")
+                self.stats.timeout('deadline')
+                self.set_rx_state(self.RX_CANCEL)
+                break
+
+            elif step == 'done':
+                print("all done, entering standby")
+                self.set_rx_state(self.RX_STANDBY)
+                break
+
+            elif step in ('status', 'frames'):
+                if not self.wait(step):
+                    self.set_rx_state(self.RX_ERROR)
+                    break
+
+            elif step in ('ack', 'nack'):
+                updates = self.tx_updates
+                if step == 'ack':
+                    self.stats.ack()
+                    self.c_upload_rxs.write(self.RX_ACK)
+                    if checkpoint is not None:
+                        checkpoint.update(self.frames)
+                else:
+                    self.stats.nack()
+                    self.c_upload_rxs.write(self.RX_NACK)
+                self.timing.start('status')
+                # do not repeat ACK/NACK before the sender reacted, it might apply to the next window
+                while self.tx_updates == updates:
+                    if not self.wait('status'):
+                        break
+                if self.tx_updates == updates:
+                    self.set_rx_state(self.RX_ERROR)
+                    break
+
+            else:
+                print("unknown TX state %d:", self.tx_state)
+                self.set_rx_state(self.RX_CANCEL)
+                break
+
+        print("upload done.")
+        if checkpoint is not None and not self.frames.frames_complete:
+            checkpoint.sync()
+        self.stats.finish(self.frames)
+        print("transfer statistics: %s" % self.stats.str())
+        self.data = self.frames.data()
+        if not self.data:
+            return self
+        if checkpoint is not None and checkpoint.base:
+            self.data = checkpoint.data()
+            print("stitched to %d records received before" % checkpoint.base)
+        print("got data of length %d" % len(self.data))
+        d1, d2, self.records, self.last_ts, self.last_idx, self.session, self.period = \
+            struct.unpack(">BBHLLHH", self.data[0:16])
+
+        return self
+
+    def raw(self):
+        return self.data
+
+    def history(self):
+        return History.from_bytes(self.data)
+
+    def str(self):
+        return self.history().str()
+
+
+class PlantSensor(DefaultDelegate):
+
+    def __init__(self, p, iface=None, cache=None, peripheral=None):
+        """Connect to the sensor with address (or scan entry) p.
+
+        peripheral is used instead of connecting, e.g. a simulator.FakePeripheral.
+        """
+        DefaultDelegate.__init__(self)
+        if peripheral is not None:
+            self.p = peripheral
+        elif iface is not None and hasattr(p, 'addrType'):
+            # connect to a scanned device through another adapter than the one it was seen on
+            self.p = Peripheral(p.addr, p.addrType, iface)
+        else:
+            self.p = Peripheral(p, iface=iface)
+        self.p.setDelegate(self)
+        self.addr = getattr(p, 'addr', p).lower()
+        self.handles = {}
+        self.services = {}
+        self.char_handles = {}
+        self.cache = cache
+        self.cached = 0
+
+        if cache is not None:
+            try:
+                self.char_handles = self.cached_handles()
+                self.cached = len(self.char_handles) > 0
+                if self.cached:
+                    self.init_regs()
+            except BTLEException as e:
+                print("%s: cached handles not valid (%s), discovering services" % (self.addr, e))
+                cache.invalidate(self.addr)
+                self.handles = {}
+                self.char_handles = {}
+                self.cached = 0
+        if not self.cached:
+            self.init_regs()
+            self.store_handles()
+        1 <= debug and print("%s: %s handles" % (self.addr, self.cached and "using cached" or "discovered"))
+
+    def cached_handles(self):
+        """Return the cached handles if the firmware revision read through the cached handle matches."""
+        entries = self.cache.get(self.addr)
+        for fw, handles in entries.items():
+            key = '%08x' % FP_INFO_FW_VERSION
+            if key not in handles:
+                continue
+            fw_now = FPRegister(self.p, handles[key], CT_UTF8).values()
+            if fw_now in entries:
+                return dict((k, int(v)) for k, v in entries[fw_now].items())
+            break
+        return {}
+
+    def store_handles(self):
+        if self.cache is not None:
+            self.cache.put(self.addr, self.c_fw_ver.values(), self.char_handles)
+
+    def char_handle(self, service, char):
+        key = '%08x' % char
+        if key not in self.char_handles:
+            if service not in self.services:
+                self.services[service] = self.p.getServiceByUUID(FP_UUID(service))
+            self.char_handles[key] = self.services[service].getCharacteristics(FP_UUID(char))[0].getHandle()
+        return self.char_handles[key]
+
+    def register(self, service, char, fmt):
+        return FPRegister(self.p, self.char_handle(service, char), fmt)
+
+    def optional_register(self, service, char, fmt):
+        """Return the register or None if not supported by the sensor firmware."""
+        key = '%08x' % char
+        if key not in self.char_handles:
+            try:
+                self.char_handle(service, char)
+            except (BTLEException, IndexError) as e:
+                if not not_found(e):
+                    raise
+                # remember as missing, handle 0 is never valid
+                self.char_handles[key] = 0
+        if not self.char_handles[key]:
+            return None
+        return FPRegister(self.p, self.char_handles[key], fmt)
+
+    def snapshot(self):
+        """Read all registers once and return them as a Snapshot.
+
+        With handles known from the cache, this takes exactly one read request per
+        supported register and no service discovery.
+        """
+        known = len(self.char_handles)
+        values = {'addr': self.addr, 'time': int(time())}
+        for field, service, char, fmt in SNAPSHOT_REGS:
+            reg = self.optional_register(service, char, fmt)
+            value = None
+            if reg is not None:
+                value = reg.values()
+                if fmt != CT_UTF8 and len(value) == 1:
+                    value = value[0]
+                elif fmt != CT_UTF8:
+                    value = list(value)
+            values[field] = value
+        if len(self.char_handles) > known:
+            self.store_handles()
+        return Snapshot(**values)
+
+    def init_regs(self):
+        self.c_name = self.register(FP_GAP, FP_DEV_NAME, CT_UTF8)
+        self.c_fw_ver = self.register(FP_INFO, FP_INFO_FW_VERSION, CT_UTF8)
+        self.c_calib_data = self.register(FB_CALIB, FB_CALIB_DATA, '<11H')
+        self.r_bat = self.register(FB_BATTERY, FB_BATTERY_LEVEL, CT_U8)
+        self.c_time = self.register(FB_CLOCK, FB_TIME, CT_U32)
+
+        self.r_dli = self.register(FP_SERVICE_LIFE, FP_CHAR_LIFE_DLI, CT_U16)
+        self.r_soil_ec = self.register(FP_SERVICE_LIFE, FP_CHAR_LIFE_SEC, CT_U16)
+        self.r_soil_temp = self.register(FP_SERVICE_LIFE, FP_CHAR_LIFE_STEMP, CT_U16)
+        self.r_air_temp = self.register(FP_SERVICE_LIFE, FP_CHAR_LIFE_ATEMP, CT_U16)
+        self.r_soil_vwc = self.register(FP_SERVICE_LIFE, FP_CHAR_LIFE_VWC, CT_U16)
+        self.r_dlic = self.register(FP_SERVICE_LIFE, FP_CHAR_LIFE_DLI_CAL, CT_F32)
+        self.c_dli = self.r_dli
+        self.c_dlic = self.r_dlic
+        self.c_lifep = self.register(FP_SERVICE_LIFE, FP_CHAR_LIFE_PERIOD, CT_U8)
+
+        self.upload = FPUpload(self)
+        self.subscribe(self.upload.c_upload_txb, self.upload.handle_tx_buffer)
+        self.subscribe(self.upload.c_upload_txs, self.upload.handle_tx_status)
+
+        2 <= debug and print("handle for dli : 0x%04x" % self.c_dli.getHandle())
+        2 <= debug and print("handle for dlic: 0x%04x" % self.c_dlic.getHandle())
+
+        self.r_new_1 = None
+        self.r_new_2 = None
+        self.r_new_3 = None
+        self.r_new_4 = None
+        self.r_new_5 = None
+        self.r_new_6 = None
+
+    def init_fw_202_regs(self):
+        known = len(self.char_handles)
+        self.r_new_1 = self.register(FP_SERVICE_NEW, FP_CHAR_NEW_1, CT_U16)
+        self.r_new_2 = self.register(FP_SERVICE_NEW, FP_CHAR_NEW_2, CT_U16)
+        self.r_new_3 = self.register(FP_SERVICE_NEW, FP_CHAR_NEW_3, CT_U16)
+        self.r_new_4 = self.register(FP_SERVICE_NEW, FP_CHAR_NEW_4, CT_U16)
+        self.r_new_5 = self.register(FP_SERVICE_NEW, FP_CHAR_NEW_5, CT_U16)
+        self.r_new_6 = self.register(FP_SERVICE_NEW, FP_CHAR_NEW_6, CT_U8)
+        if len(self.char_handles) > known:
+            self.store_handles()
+
+    def set_life_period(self, secs):
+        if secs > 0:
+            self.subscribe(self.c_dli, self.handle_dli)
+            self.subscribe(self.c_dlic, self.handle_dlic)
+        else:
+            self.unsubscribe(self.c_dli.getHandle())
+            self.unsubscribe(self.c_dlic.getHandle())
+        if secs > 255:
+            secs = 255
+        self.c_lifep.write(secs)
+
+    def subscribe(self, char, func):
+        handle = char.getHandle()
+        self.handles[handle] = func
+        self.p.writeCharacteristic(handle+1, struct.pack('<H', 0x1))
+        1 <= debug and print("registered for handle 0x%04x" % handle)
+        return handle
+
+    def unsubscribe(self, handle):
+        if handle in self.handles.keys():
+            self.handles.pop(handle)
+        self.p.writeCharacteristic(handle + 1, struct.pack('<H', 0x0))
+
+    def handle_dli(self, data):
+        2 <= debug and print("got data for DLI:  %d" % struct.unpack('<H', data))
+
+    def handle_dlic(self, data):
+        2 <= debug and print("got data for DLIC: %f" % struct.unpack('<f', data))
+
+    def handleNotification(self, handle, data):
+        # ... perhaps check cHandle
+        # ... process 'data'
+        # print("got data for handle 0x%04x" % handle)
+        if handle in self.handles.keys():
+            self.handles[handle](data)
+
+
+def life_test(p):
+    my_count = 0
+    p.set_life_period(1)
+    while True:
+        my_count += 1
+        if my_count > 10:
+            break
+        if not p.p.waitForNotifications(2.0):
+            print("Waiting...")
+        # Perhaps do something else here
+    p.set_life_period(0)
+
+
+class LiveStream:
+    """Stream live measurements of a sensor using live period notifications.
+
+    All notifications received within one period are coalesced into one timestamped
+    record, which is handed to put(), e.g. SinkWorker.put. Values not notified within
+    a period are None.
+    """
+
+    def __init__(self, sensor, period, put):
+        self.sensor = sensor
+        self.period = max(1, min(period, 255))
+        self.put = put
+        self.values = {}
+        self.handles = []
+        self.records = 0
+
+    def handler(self, field, fmt):
+        def handle(data):
+            self.values[field] = struct.unpack(fmt, data)[0]
+        return handle
+
+    def start(self):
+        self.sensor.set_life_period(self.period)
+        for field, char, fmt in LIVE_REGS:
+            reg = self.sensor.optional_register(FP_SERVICE_LIFE, char, fmt)
+            if reg is not None:
+                self.handles.append(self.sensor.subscribe(reg, self.handler(field, fmt)))
+
+    def stop(self):
+        for handle in self.handles:
+            self.sensor.unsubscribe(handle)
+        self.handles = []
+        self.sensor.set_life_period(0)
+
+    def emit(self, ts):
+        if not self.values:
+            return
+        record = dict((field, None) for field in LIVE_FIELDS)
+        record.update(self.values)
+        record['addr'] = self.sensor.addr
+        record['time'] = ts
+        self.values = {}
+        self.put(record)
+        self.records += 1
+
+    def run(self, duration=0):
+        """Receive notifications for duration seconds, or forever if duration is 0."""
+        self.start()
+        try:
+            start = time()
+            next_emit = start + self.period
+            while not duration or time() - start < duration:
+                now = time()
+                if now >= next_emit:
+                    self.emit(round(now, 3))
+                    next_emit += self.period * (int((now - next_emit) / self.period) + 1)
+                    continue
+                self.sensor.p.waitForNotifications(next_emit - now)
+            self.emit(round(time(), 3))
+        finally:
+            self.stop()
+        return self.records
@@ -0,0 +1,335 @@
+from __future__ import print_function
+
+import heapq
+import random
+import struct
+from time import time, sleep
+
+from bluepy import btle
+from bluepy.btle import BTLEException
+
+from pyflowerpower.sensor import FP_UUID, SNAPSHOT_REGS, UploadStates, \
+    FP_UPLOAD, FP_UPLOAD_TX_BUFFER, FP_UPLOAD_TX_STATUS, FP_UPLOAD_RX_STATUS, \
+    FP_HISTORY, FP_HISTORY_NB_ENTRIES, FP_HISTORY_LAST_INDEX, FP_HISTORY_START_INDEX, \
+    FP_HISTORY_SESSION_ID, FP_HISTORY_SESSION_START, FP_HISTORY_SESSION_PERIOD, \
+    FP_SERVICE_NEW, FP_INFO_FW_VERSION
+from pyflowerpower.history import HEADER_FORMAT, SESSION_MARKER
+from pyflowerpower.upload import FRAME_PAYLOAD, WINDOW_BITS, WINDOW_SIZE
+
+debug = 0
+
+'''
+In-process stand-in for a bluepy Peripheral connected to a FlowerPower sensor.
+
+FakePeripheral serves all characteristics read by PlantSensor and implements the
+sender side of the upload service: after rx status RECEIVING, it sends the history
+buffer starting at the history start index in windows of 128 frames (frame 0 carrying
+the buffer size), announcing each window with tx status TRANSFER and WAIT_ACK, and
+proceeds with the next window on ACK or repeats the window on NACK.
+
+Link properties are simulated with a notification latency, a minimal interval between
+notifications, a random jitter added to each notification and a loss probability for
+data frames. Requests (discovery, reads) take one round trip of twice the latency.
+With disconnect_after, the link is lost after sending that many data frames, with
+silent_after, the sensor stops sending but keeps the link.
+Like bluepy, notifications due while a request is pending are dispatched to the delegate.
+
+    p = FakePeripheral(entries=4096, latency=0.01, loss=0.01)
+    ps = PlantSensor(p.addr, peripheral=p)
+    ps.upload.receive(count=4096)
+    assert ps.upload.raw() == p.buffer(p.last_index - 4095)
+'''
+
+
+def gatt_error(message):
+    return bluepy_error('BTLEGattError', 'GATT_ERROR', message)
+
+
+def disconnect_error(message):
+    return bluepy_error('BTLEDisconnectError', 'DISCONNECTED', message)
+
+
+def bluepy_error(cls, code, message):
+    if hasattr(btle, cls):
+        return getattr(btle, cls)(message)
+    # bluepy < 1.3 has error codes instead of subclasses
+    return BTLEException(getattr(BTLEException, code), message)
+
+
+class FakeCharacteristic:
+
+    def __init__(self, uuid, handle):
+        self.uuid = uuid
+        self.handle = handle
+
+    def getHandle(self):
+        return self.handle
+
+
+class FakeService:
+
+    def __init__(self, peripheral, uuid):
+        self.peripheral = peripheral
+        self.uuid = uuid
+        self.chars = {}
+
+    def getCharacteristics(self, forUUID=None):
+        self.peripheral.request('discover')
+        if forUUID is None:
+            return list(self.chars.values())
+        key = str(forUUID).lower()
+        return [self.chars[key]] if key in self.chars else []
+
+
+class FakePeripheral(UploadStates):
+
+    def __init__(self, addr='a0:14:3d:00:00:01', entries=4096, last_index=None, session=1, period=900,
+                 firmware='2.0.2', new_service=True, latency=0.0, interval=0.0, jitter=0.0, loss=0.0,
+                 write_delay=0.0, disconnect_after=None, silent_after=None, seed=0):
+        self.addr = addr
+        self.addrType = 'public'
+        self.latency = latency
+        self.interval = interval
+        self.jitter = jitter
+        self.loss = loss
+        self.write_delay = write_delay
+        self.disconnect_after = disconnect_after
+        self.silent_after = silent_after
+        self.random = random.Random(seed)
+        self.delegate = None
+        self.connected = True
+
+        self.entries = entries
+        self.last_index = entries - 1 if last_index is None else last_index
+        self.session = session
+        self.period = period
+        self.sensor_time = max(1000000, (self.last_index + 1) * period)
+        self.records = self.make_records()
+
+        self.services = {}
+        self.chars = {}
+        self.values = {}
+        self.subscribed = set()
+        self.queue = []
+        self.sequence = 0
+        self.last_due = 0.0
+        self.requests = {}
+        self.frames_sent = 0
+        self.frames_lost = 0
+
+        self.tx_state = self.TX_IDLE
+        self.start_index = self.last_index - entries + 1
+        self.data = b""
+        self.frames_max = 0
+        self.window = 0
+        self.ack_after = 0.0
+        self.ignored = 0
+
+        for field, service, char, fmt in SNAPSHOT_REGS:
+            if service == FP_SERVICE_NEW and not new_service:
+                continue
+            self.add_char(service, char, self.default_value(field, fmt))
+        self.set_value(FP_INFO_FW_VERSION, firmware.encode('utf8'))
+        for char in [FP_UPLOAD_TX_BUFFER, FP_UPLOAD_TX_STATUS, FP_UPLOAD_RX_STATUS]:
+            self.add_char(FP_UPLOAD, char, b"\0")
+        for char in [FP_HISTORY_NB_ENTRIES, FP_HISTORY_LAST_INDEX, FP_HISTORY_START_INDEX,
+                     FP_HISTORY_SESSION_ID, FP_HISTORY_SESSION_START, FP_HISTORY_SESSION_PERIOD]:
+            self.add_char(FP_HISTORY, char, b"\0")
+        self.update_history_values()
+
+    def default_value(self, field, fmt):
+        if fmt == 'utf8':
+            return ('Flower power %s' % self.addr[-5:].replace(':', '')).encode('utf8')
+        if field == 'sensor_time':
+            return struct.pack(fmt, self.sensor_time)
+        if field == 'battery':
+            return struct.pack(fmt, 87)
+        if field == 'period':
+            return struct.pack(fmt, 0)
+        count = len(struct.unpack(fmt, b"\0" * struct.calcsize(fmt)))
+        return struct.pack(fmt, *([1] * count))
+
+    def make_records(self):
+        """Return the raw records of all history entries, the oldest one marking the session start."""
+        rng = random.Random(self.last_index)
+        records = bytearray()
+        for i in range(0, self.entries):
+            if i == 0:
+                records += struct.pack('>6H', SESSION_MARKER, self.session, self.period, 0, 0, 0)
+            else:
+                records += struct.pack('>6H', *[rng.getrandbits(15) for n in range(0, 6)])
+        return bytes(records)
+
+    def buffer(self, start_index):
+        """Return the upload buffer the sensor sends for the given start index."""
+        first = self.last_index - self.entries + 1
+        start = max(first, min(start_index, self.last_index))
+        records = self.records[(start - first) * 12:]
+        header = struct.pack(HEADER_FORMAT, 0, 0, int(len(records) / 12), self.sensor_time,
+                             self.last_index, self.session, self.period)
+        return header + records
+
+    def add_char(self, service, char, value):
+        key = str(FP_UUID(service)).lower()
+        if key not in self.services:
+            self.services[key] = FakeService(self, key)
+        # leave room for the client characteristic configuration descriptor at handle+1
+        handle = 0x10 + 3 * len(self.chars)
+        uuid = str(FP_UUID(char)).lower()
+        self.services[key].chars[uuid] = FakeCharacteristic(uuid, handle)
+        self.chars[char] = handle
+        self.values[handle] = value
+
+    def set_value(self, char, value):
+        self.values[self.chars[char]] = value
+
+    def update_history_values(self):
+        self.set_value(FP_HISTORY_NB_ENTRIES, struct.pack('<H', min(self.entries, 0xffff)))
+        self.set_value(FP_HISTORY_LAST_INDEX, struct.pack('<L', self.last_index))
+        self.set_value(FP_HISTORY_START_INDEX, struct.pack('<L', self.start_index))
+        self.set_value(FP_HISTORY_SESSION_ID, struct.pack('<H', self.session))
+        self.set_value(FP_HISTORY_SESSION_START, struct.pack('<L', self.last_index - self.entries + 1))
+        self.set_value(FP_HISTORY_SESSION_PERIOD, struct.pack('<H', self.period))
+
+    # bluepy Peripheral interface
+
+    def setDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def getServiceByUUID(self, uuidVal):
+        self.request('discover')
+        key = str(uuidVal).lower()
+        if key not in self.services:
+            raise gatt_error("Service %s not found" % key)
+        return self.services[key]
+
+    def readCharacteristic(self, handle):
+        self.request('read')
+        if handle not in self.values:
+            raise gatt_error("Invalid handle 0x%04x" % handle)
+        return self.values[handle]
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        self.requests['write'] = self.requests.get('write', 0) + 1
+        self.check_connected()
+        if self.write_delay:
+            self.advance(time() + self.write_delay)
+        if handle - 1 in self.values:
+            # client characteristic configuration descriptor
+            if struct.unpack('<H', val)[0] & 1:
+                self.subscribed.add(handle - 1)
+            else:
+                self.subscribed.discard(handle - 1)
+        elif handle == self.chars[FP_HISTORY_START_INDEX]:
+            self.start_index = struct.unpack('<L', val)[0]
+            self.update_history_values()
+        elif handle == self.chars[FP_UPLOAD_RX_STATUS]:
+            self.rx_status(struct.unpack('<B', val)[0])
+        elif handle in self.values:
+            self.values[handle] = val
+        else:
+            raise gatt_error("Invalid handle 0x%04x" % handle)
+        self.advance(time())
+
+    def waitForNotifications(self, timeout):
+        """Dispatch the next notification due within timeout, return False if there is none."""
+        self.check_connected()
+        now = time()
+        if not self.queue or (timeout is not None and self.queue[0][0] > now + timeout):
+            if timeout:
+                sleep(timeout)
+            return False
+        self.dispatch()
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        self.queue = []
+
+    # link simulation
+
+    def check_connected(self):
+        if not self.connected:
+            raise disconnect_error("Device disconnected")
+
+    def request(self, kind):
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+        self.check_connected()
+        self.advance(time() + 2 * self.latency)
+
+    def advance(self, until):
+        """Dispatch all notifications due up to the given time and wait for it."""
+        while self.queue and self.queue[0][0] <= until:
+            self.dispatch()
+        delay = until - time()
+        if delay > 0:
+            sleep(delay)
+
+    def dispatch(self):
+        due, seq, handle, data = heapq.heappop(self.queue)
+        delay = due - time()
+        if delay > 0:
+            sleep(delay)
+        if self.delegate is not None:
+            self.delegate.handleNotification(handle, data)
+
+    def notify(self, char, data, lossy=False):
+        handle = self.chars[char]
+        if handle not in self.subscribed:
+            return
+        due = time() + self.latency
+        if self.jitter:
+            due += self.random.uniform(0, self.jitter)
+        # notifications on one link are never reordered
+        self.last_due = due = max(due, self.last_due + self.interval)
+        if lossy and self.loss and self.random.random() < self.loss:
+            self.frames_lost += 1
+            return due
+        self.sequence += 1
+        heapq.heappush(self.queue, (due, self.sequence, handle, data))
+        return due
+
+    def set_tx_state(self, state):
+        self.tx_state = state
+        self.set_value(FP_UPLOAD_TX_STATUS, struct.pack('<B', state))
+        return self.notify(FP_UPLOAD_TX_STATUS, struct.pack('<B', state))
+
+    def send_window(self):
+        self.set_tx_state(self.TX_TRANSFER)
+        first = self.window << WINDOW_BITS
+        for frame in range(first, min(first + WINDOW_SIZE - 1, self.frames_max) + 1):
+            if frame == 0:
+                payload = struct.pack('<L', len(self.data)) + b"\0" * (FRAME_PAYLOAD - 4)
+            else:
+                payload = self.data[(frame - 1) * FRAME_PAYLOAD:frame * FRAME_PAYLOAD]
+            if self.disconnect_after is not None and self.frames_sent >= self.disconnect_after:
+                # the link is lost, notifications not delivered yet are gone too
+                self.disconnect()
+                return
+            if self.silent_after is not None and self.frames_sent >= self.silent_after:
+                return
+            self.frames_sent += 1
+            self.notify(FP_UPLOAD_TX_BUFFER, struct.pack('<H', frame) + payload, lossy=True)
+        # the window is sent when WAIT_ACK arrives, ACK and NACK written before are ignored
+        self.ack_after = self.set_tx_state(self.TX_WAIT_ACK)
+
+    def rx_status(self, state):
+        2 <= debug and print("fake %s: rx status %d in tx state %d" % (self.addr, state, self.tx_state))
+        if state == self.RX_RECEIVING and self.tx_state == self.TX_IDLE:
+            self.data = self.buffer(self.start_index)
+            self.frames_max = int((len(self.data) + FRAME_PAYLOAD - 1) / FRAME_PAYLOAD)
+            self.window = 0
+            self.send_window()
+        elif state in (self.RX_ACK, self.RX_NACK) and (self.tx_state != self.TX_WAIT_ACK or time() < self.ack_after):
+            self.ignored += 1
+        elif state == self.RX_ACK:
+            self.window += 1
+            if self.window > self.frames_max >> WINDOW_BITS:
+                self.set_tx_state(self.TX_IDLE)
+            else:
+                self.send_window()
+        elif state == self.RX_NACK:
+            self.send_window()
+        elif state in (self.RX_STANDBY, self.RX_CANCEL, self.RX_ERROR) and self.tx_state != self.TX_IDLE:
+            self.set_tx_state(self.TX_IDLE)
@@ -0,0 +1,132 @@
+from __future__ import print_function
+
+import json
+import sqlite3
+import threading
+
+try:
+    from queue import Queue, Full, Empty
+except ImportError:
+    from Queue import Queue, Full, Empty
+
+'''
+Sinks for live measurement records, fed through a bounded queue by a background thread.
+
+A record is a dict with the keys given by the sink's fields. Sinks open their output
+lazily from the writer thread, which is required for sqlite connections.
+'''
+
+debug = 0
+
+
+class NdjsonSink:
+
+    def __init__(self, filename, fields):
+        self.filename = filename
+        self.fields = fields
+        self.f = None
+
+    def write(self, record):
+        if self.f is None:
+            self.f = open(self.filename, 'a')
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+class CsvSink(NdjsonSink):
+
+    def write(self, record):
+        if self.f is None:
+            self.f = open(self.filename, 'a')
+            if self.f.tell() == 0:
+                self.f.write(','.join(self.fields) + '\n')
+        self.f.write(','.join('' if record.get(k) is None else str(record[k]) for k in self.fields) + '\n')
+        self.f.flush()
+
+
+class SqliteSink:
+
+    def __init__(self, filename, fields, table='live'):
+        self.filename = filename
+        self.fields = fields
+        self.table = table
+        self.db = None
+
+    def write(self, record):
+        if self.db is None:
+            self.db = sqlite3.connect(self.filename)
+            self.db.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (self.table, ', '.join(self.fields)))
+        self.db.execute('INSERT INTO %s VALUES (%s)' % (self.table, ', '.join('?' * len(self.fields))),
+                        [record.get(k) for k in self.fields])
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+
+SINKS = {
+    'ndjson': NdjsonSink,
+    'csv': CsvSink,
+    'sqlite': SqliteSink,
+}
+
+
+def make_sink(spec, fields):
+    """Create a sink from a specification of the form 'TYPE:FILENAME'."""
+    kind, filename = spec.split(':', 1)
+    if kind not in SINKS:
+        raise ValueError("unknown sink type '%s', use one of %s" % (kind, ', '.join(sorted(SINKS))))
+    return SINKS[kind](filename, fields)
+
+
+class SinkWorker:
+    """Pass records from a bounded queue to all sinks in a background thread.
+
+    put() never blocks: if the queue is full, the oldest record is dropped, so a slow
+    sink can not stall the thread receiving notifications.
+    """
+
+    def __init__(self, sinks, size=1000):
+        self.sinks = sinks
+        self.queue = Queue(size)
+        self.dropped = 0
+        self.written = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, record):
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    1 <= debug and print("sink queue full, dropped oldest record")
+                except Empty:
+                    pass
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for sink in self.sinks:
+                try:
+                    sink.write(record)
+                except Exception as e:
+                    print("Problems writing record to %s:" % sink.filename, e)
+            self.written += 1
+        for sink in self.sinks:
+            sink.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
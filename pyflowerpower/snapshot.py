@@ -0,0 +1,80 @@
+from __future__ import print_function
+
+from collections import namedtuple
+import csv
+import io
+import json
+import threading
+
+'''
+Snapshot of all live values, calibration data and device info of a sensor, with
+json and csv serialization. Values not available with the sensor's firmware are None.
+'''
+
+SNAPSHOT_FIELDS = [
+    'addr', 'time', 'name', 'firmware', 'sensor_time', 'battery', 'calib',
+    'dli', 'soil_ec', 'soil_temp', 'air_temp', 'soil_vwc', 'period', 'led', 'last_move',
+    'dli_cal', 'vwc_cal', 'air_temp_cal', 'ea_cal', 'ecb_cal', 'ec_porous_cal',
+    'new_1', 'new_2', 'new_3', 'new_4', 'new_5', 'new_6',
+]
+
+
+class Snapshot(namedtuple('Snapshot', SNAPSHOT_FIELDS)):
+
+    def dict(self):
+        return dict(zip(SNAPSHOT_FIELDS, self))
+
+    def json(self):
+        return json.dumps(self.dict(), sort_keys=True)
+
+    def csv_values(self):
+        """Return the values as csv fields, lists separated by spaces and None as empty."""
+        values = []
+        for value in self:
+            if value is None:
+                value = ''
+            elif isinstance(value, (list, tuple)):
+                value = ' '.join(map(str, value))
+            values.append(str(value))
+        return values
+
+    def csv(self):
+        f = io.StringIO()
+        csv.writer(f, lineterminator='').writerow(self.csv_values())
+        return f.getvalue()
+
+
+def has_content(f):
+    """Whether the file is positioned after existing content, e.g. opened for appending to a non-empty file."""
+    try:
+        return f.tell() > 0
+    except (IOError, OSError, ValueError):
+        # not seekable, e.g. a pipe
+        return False
+
+
+class SnapshotWriter:
+    """Write snapshots to a file as ndjson or csv, safe to use from several threads.
+
+    The csv header is written only if the file has no content yet.
+    """
+
+    def __init__(self, f, fmt='json'):
+        self.f = f
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        self.count = 0
+        self.csv = csv.writer(f, lineterminator='\n')
+        self.header = fmt == 'csv' and not has_content(f)
+
+    def write(self, snapshot):
+        with self.lock:
+            if self.fmt == 'csv':
+                if self.header:
+                    self.csv.writerow(SNAPSHOT_FIELDS)
+                    self.header = False
+                self.csv.writerow(snapshot.csv_values())
+            else:
+                self.f.write(snapshot.json() + '\n')
+            self.f.flush()
+            self.count += 1
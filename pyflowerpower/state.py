@@ -0,0 +1,51 @@
+from __future__ import print_function
+
+import json
+import os
+import threading
+
+'''
+Persistent per-sensor state, kept in a json file keyed by sensor address.
+'''
+
+
+class SensorState:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.sensors = {}
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            try:
+                self.sensors = json.loads(open(filename).read())
+            except ValueError:
+                print("Could not read sensor state from file '%s', starting over." % filename)
+
+    def get(self, addr):
+        with self.lock:
+            return dict(self.sensors.get(addr.lower(), {}))
+
+    def update(self, addr, **values):
+        with self.lock:
+            self.sensors.setdefault(addr.lower(), {}).update(values)
+            self.save()
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.sensors, indent=4, sort_keys=True))
+        os.rename(tmp, self.filename)
+
+
+class HandleCache(SensorState):
+    """GATT characteristic handles per sensor address and firmware revision."""
+
+    def put(self, addr, fw, handles):
+        with self.lock:
+            self.sensors[addr.lower()] = {fw: dict(handles)}
+            self.save()
+
+    def invalidate(self, addr):
+        with self.lock:
+            if self.sensors.pop(addr.lower(), None) is not None:
+                self.save()
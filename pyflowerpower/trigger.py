@@ -0,0 +1,123 @@
+from __future__ import print_function
+
+from time import time, sleep
+
+from bluepy.btle import DefaultDelegate, BTLEException
+
+from pyflowerpower.discovery import start_scan, stop_scan, pause_scan
+from pyflowerpower.sensor import device_is_fp, device_flags
+
+'''
+Advertisement driven downloads: sensors are watched passively and only queued for a
+download when there is new history worth fetching.
+
+A sensor is due if it was never downloaded, if at least min_entries history entries
+were recorded since the last download (elapsed time over session period), or if its
+advertised flags changed since the last download and at least one entry was recorded.
+After a failed download (including the scheduler's retries), a sensor is not triggered
+again before a backoff doubling with each consecutive failure has passed.
+'''
+
+debug = 0
+
+
+class DownloadTrigger(DefaultDelegate):
+
+    def __init__(self, scheduler, state, store, min_entries=96, registry=(), backoff=60.0, max_backoff=3600.0,
+                 scan_retry=5.0):
+        """Watch advertisements with store (an AdvertisementStore) and submit due sensors to scheduler.
+
+        The scheduler has to call done(key, ok) when a download is finished, see
+        DownloadScheduler's done argument. With a registry, other sensors are ignored.
+        A failed sensor waits backoff seconds, doubled per consecutive failure up to
+        max_backoff; after a scan error, scanning restarts after scan_retry seconds.
+        """
+        DefaultDelegate.__init__(self)
+        self.scheduler = scheduler
+        self.state = state
+        self.store = store
+        self.min_entries = min_entries
+        self.registry = set(registry)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.scan_retry = scan_retry
+        self.queued = set()
+        self.failures = {}
+        self.retry_at = {}
+        self.triggered = 0
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if not device_is_fp(dev):
+            return
+        addr = dev.addr.lower()
+        if self.registry and addr not in self.registry:
+            return
+        self.store.add(addr, dev.rssi, device_flags(dev))
+        if addr in self.queued or self.retry_at.get(addr, 0) > time():
+            return
+        reason = self.due(addr)
+        if not reason:
+            return
+        print("%s: download triggered, %s" % (addr, reason))
+        self.queued.add(addr)
+        self.triggered += 1
+        self.scheduler.submit(dev.addr, dev, -self.entries(addr))
+
+    def entries(self, addr, now=None):
+        """Estimated number of history entries recorded since the last download."""
+        known = self.state.get(addr)
+        if 'time' not in known or not known.get('period'):
+            return float('inf')
+        return ((now or time()) - known['time']) / float(known['period'])
+
+    def due(self, addr, now=None):
+        """Return why addr should be downloaded now, or None."""
+        known = self.state.get(addr)
+        if 'time' not in known:
+            return "never downloaded"
+        entries = self.entries(addr, now)
+        if entries >= self.min_entries:
+            return "about %d new entries" % entries
+        if entries >= 1 and self.store.flags_changed(addr, since=known['time']):
+            return "flags changed, about %d new entries" % entries
+        return None
+
+    def done(self, key, ok, now=None):
+        addr = key.lower()
+        self.queued.discard(addr)
+        if ok:
+            self.failures.pop(addr, None)
+            self.retry_at.pop(addr, None)
+            return
+        failures = self.failures.get(addr, 0) + 1
+        self.failures[addr] = failures
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        self.retry_at[addr] = (now or time()) + delay
+        print("%s: download failed %d time(s), next attempt in %d s at the earliest" % (addr, failures, delay))
+
+    def run(self, scanner, duration=0, gate=None):
+        """Scan with scanner (using this delegate) for duration seconds, or forever if 0.
+
+        With a gate (ScanGate), scanning pauses while downloads run on the scanning adapter.
+        """
+        start = time()
+        while not duration or time() - start < duration:
+            try:
+                scanner.clear()
+                start_scan(scanner, gate)
+                while not duration or time() - start < duration:
+                    scanner.process(1.0)
+                    pause_scan(scanner, gate)
+            except BTLEException as e:
+                print("Problems during scan:", e)
+                failed = 1
+            else:
+                failed = 0
+            finally:
+                try:
+                    stop_scan(scanner, gate)
+                except BTLEException:
+                    pass
+            if failed:
+                sleep(self.scan_retry)
+        return self.triggered
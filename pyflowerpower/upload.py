@@ -0,0 +1,206 @@
+from __future__ import print_function
+
+import struct
+from time import time
+
+'''
+Helpers for the FlowerPower upload service.
+
+The sensor sends the history buffer as a sequence of 20 byte notifications on the
+upload tx buffer characteristic: a 2 byte frame number followed by 18 bytes of payload.
+Frame 0 carries the total buffer size (U32), frames 1..n carry the actual data.
+Frames are grouped in windows of 128 frames, each of which has to be acknowledged
+by the receiver before the sensor proceeds with the next one.
+'''
+
+FRAME_PAYLOAD = 18
+WINDOW_BITS = 7
+WINDOW_SIZE = 1 << WINDOW_BITS
+
+
+class UploadStates:
+    """States of receiver (written to rx status) and sender (notified on tx status)."""
+    RX_STANDBY = 0
+    RX_RECEIVING = 1
+    RX_ACK = 2
+    RX_NACK = 3
+    RX_CANCEL = 4
+    RX_ERROR = 5
+
+    TX_IDLE = 0
+    TX_TRANSFER = 1
+    TX_WAIT_ACK = 2
+
+
+def receiver_step(tx_state, frames, timing):
+    """Return the next step of the receiver loop for the last notified sender state.
+
+    'deadline'  the deadline was reached before all frames arrived, cancel
+    'done'      all frames were received and the sender is idle, back to standby
+    'status'    wait for the sender to change its state
+    'frames'    wait for more frames of the current window
+    'ack'       the window (or the whole transfer) is complete, acknowledge it
+    'nack'      frames of the window are missing, request it again
+    'unknown'   the sender is in an unknown state, cancel
+    """
+    if timing.expired() and not frames.frames_complete:
+        return 'deadline'
+    if tx_state == UploadStates.TX_IDLE:
+        return 'done' if frames.frames_complete else 'status'
+    if tx_state == UploadStates.TX_TRANSFER:
+        return 'frames'
+    if tx_state == UploadStates.TX_WAIT_ACK:
+        return 'ack' if frames.frames_complete or frames.frames_ready else 'nack'
+    return 'unknown'
+
+
+class FrameAssembler:
+    """Reassemble upload frames into one preallocated buffer.
+
+    Each frame is written to its final position through a memoryview as it arrives.
+    Received frames are tracked in a per-frame bitmap, completeness of each window
+    in a per-window counter, so deciding between ACK and NACK does not depend on
+    the number of frames received so far.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buffer_size = 0
+        self.frames_max = 0
+        self.frame_set = 0
+        self.frames_ready = 0
+        self.frames_complete = 0
+        self.frames_received = 0
+        self.duplicates = 0
+        self.buffer = None
+        self.view = None
+        self.received = None
+        self.window_count = None
+
+    def windows(self):
+        """Number of windows of the transfer, 0 before frame 0 was received."""
+        return len(self.window_count) if self.window_count is not None else 0
+
+    def window_frames(self, window):
+        """Number of frames expected in the given window."""
+        first = window << WINDOW_BITS
+        last = min(first + WINDOW_SIZE - 1, self.frames_max)
+        return last - first + 1
+
+    def start(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.frames_max = int((buffer_size + FRAME_PAYLOAD - 1) / FRAME_PAYLOAD)
+        self.buffer = bytearray(self.frames_max * FRAME_PAYLOAD)
+        self.view = memoryview(self.buffer)
+        self.received = bytearray(self.frames_max + 1)
+        self.window_count = [0] * ((self.frames_max >> WINDOW_BITS) + 1)
+
+    def add(self, frame, payload):
+        """Store the payload of one frame, return 0 if the frame was not accepted."""
+        if frame == 0 and self.buffer is None:
+            self.start(struct.unpack('<L', payload[0:4])[0])
+        self.frame_set = frame >> WINDOW_BITS
+        if self.buffer is None or frame > self.frames_max:
+            # without frame 0, the window can not be completed and will be re-sent after NACK
+            self.frames_ready = 0
+            return 0
+
+        if self.received[frame]:
+            self.duplicates += 1
+        else:
+            self.received[frame] = 1
+            self.window_count[self.frame_set] += 1
+            self.frames_received += 1
+            if frame > 0:
+                pos = (frame - 1) * FRAME_PAYLOAD
+                size = min(len(payload), FRAME_PAYLOAD)
+                self.view[pos:pos + size] = payload[0:size]
+
+        self.frames_ready = int(self.window_count[self.frame_set] == self.window_frames(self.frame_set))
+        if self.frames_ready and self.frames_received == self.frames_max + 1:
+            # all windows are complete, not only the last one
+            self.frames_complete = 1
+        return 1
+
+    def bytes_received(self):
+        if self.buffer is None:
+            return 0
+        return min(self.buffer_size, (self.frames_received - self.received[0]) * FRAME_PAYLOAD)
+
+    def contiguous(self):
+        """Number of leading buffer bytes for which all frames were received, in whole windows."""
+        if self.buffer is None:
+            return 0
+        windows = 0
+        while windows < len(self.window_count) and self.window_count[windows] == self.window_frames(windows):
+            windows += 1
+        if windows == len(self.window_count):
+            return self.buffer_size
+        return max(0, (windows * WINDOW_SIZE - 1) * FRAME_PAYLOAD)
+
+    def data(self):
+        """Return the reassembled buffer without frame padding, if all frames were received."""
+        if not self.frames_complete or self.frames_received < 2:
+            return b""
+        return bytes(self.view[0:self.buffer_size])
+
+
+class AdaptiveTimeout:
+    """Timeouts for the upload loop scaled to the latency observed on the link.
+
+    Two latencies are estimated with RTT-style smoothing (RFC 6298): 'frames', the
+    interval between consecutive frame notifications, and 'status', the time the sensor
+    takes to react to a change of the rx status. Until the first sample of a kind, the
+    fixed timeouts (5 s for status changes, 2 s between frames) apply. From then on the
+    timeout follows the estimate, down to an absolute minimum, so a sensor going silent
+    on a fast link is given up on after a few frame intervals, and up to the ceiling on
+    slow links. An optional deadline (absolute time) caps every timeout.
+    """
+
+    ALPHA = 0.125
+    BETA = 0.25
+
+    def __init__(self, status=5.0, frames=2.0, minimum=0.5, ceiling=None, factor=4.0, deadline=None):
+        self.initial = {'status': status, 'frames': frames}
+        self.minimum = minimum
+        # the BLE supervision timeout is at most 32 s
+        self.ceiling = ceiling or {'status': 30.0, 'frames': 30.0}
+        self.factor = factor
+        self.deadline = deadline
+        self.srtt = {}
+        self.rttvar = {}
+        self.pending = None
+        self.since = 0.0
+
+    def start(self, kind):
+        """Start timing the latency of the given kind up to the next notification."""
+        self.pending = kind
+        self.since = time()
+
+    def notified(self, next_kind='frames'):
+        now = time()
+        if self.pending is not None:
+            self.sample(self.pending, now - self.since)
+        self.pending = next_kind
+        self.since = now
+
+    def sample(self, kind, value):
+        if kind not in self.srtt:
+            self.srtt[kind] = value
+            self.rttvar[kind] = value / 2
+        else:
+            self.rttvar[kind] = (1 - self.BETA) * self.rttvar[kind] + self.BETA * abs(self.srtt[kind] - value)
+            self.srtt[kind] = (1 - self.ALPHA) * self.srtt[kind] + self.ALPHA * value
+
+    def timeout(self, kind):
+        t = self.initial[kind]
+        if kind in self.srtt:
+            t = min(self.ceiling[kind], max(self.minimum, self.factor * (self.srtt[kind] + 4 * self.rttvar[kind])))
+        if self.deadline is not None:
+            t = min(t, max(0.0, self.deadline - time()))
+        return t
+
+    def expired(self):
+        return self.deadline is not None and time() >= self.deadline
@@ -1,12 +1,26 @@
 from __future__ import print_function
 
-from time import gmtime, strftime
+from time import gmtime, strftime, time
 from bluepy.btle import Scanner, DefaultDelegate, BTLEException
+import argparse
 import json
 
+from pyflowerpower.adverts import AdvertisementStore
+from pyflowerpower.sensor import device_is_fp, device_flags
+
+'''
+Listen for FlowerPower advertisements, deduplicated in a per-device ring buffer store.
+
+Only changes (flags, or RSSI moving by --rssi-delta dB) are printed and recorded. The
+store is saved to --store regularly and reloaded on start, --report prints last-seen
+time, RSSI statistics and flag history per device from it.
+'''
+
+
 class ScanDelegate(DefaultDelegate):
-    def __init__(self, filename):
+    def __init__(self, filename, store):
         DefaultDelegate.__init__(self)
+        self.store = store
         self.art = {}
         try:
             self.art = json.loads(open(filename).read())
@@ -15,32 +29,72 @@ class ScanDelegate(DefaultDelegate):
             pass
 
     def handleDiscovery(self, dev, isNewDev, isNewData):
-        flags = 0
-        flower = 0
-        for (adtype, desc, value) in dev.getScanData():
-            if adtype == 0xff:
-                flags = value
-            if adtype == 6 and value == '1bc5d5a50200baafe211a88400fae139':
-                flower = 1
-        if not flower:
+        if not device_is_fp(dev):
+            return
+        flags = device_flags(dev)
+        if not self.store.add(dev.addr, dev.rssi, flags):
             return
-        #if isNewDev:
-        print(strftime("%Y-%m-%d %H:%M:%S", gmtime()), 
-              "Discovered      device", dev.addr, 
-              "rssi:", dev.rssi, 
+        print(strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+              "Discovered      device", dev.addr,
+              "rssi:", dev.rssi,
               "flags:", flags, self.resolv(dev.addr))
-        #elif isNewData:
-        #    print(strftime("%Y-%m-%d %H:%M:%S", gmtime()), "Received new data from", dev.addr, "rssi:",dev.rssi, "flags:",flags))
 
     def resolv(self, addr):
         if addr in self.art.keys():
             return self.art[addr]
         return ""
 
-scanner = Scanner().withDelegate(ScanDelegate('addresstable.json'))
-while 1:
-    try:
-        devices = scanner.scan(10.0)
-    except BTLEException:
-        print("---")
-        pass
+
+def report(store, delegate):
+    for addr in store.addresses():
+        stats = store.rssi_stats(addr)
+        print(addr, delegate.resolv(addr))
+        print("  last seen: %s" % strftime("%Y-%m-%d %H:%M:%S", gmtime(store.last_seen(addr))))
+        print("  rssi: %(count)d advertisements, mean %(mean).1f, std %(std).1f, min %(min)d, max %(max)d" % stats)
+        for ts, flags in store.flag_history(addr):
+            print("  %s flags: %s" % (strftime("%Y-%m-%d %H:%M:%S", gmtime(ts)), flags))
+
+
+parser = argparse.ArgumentParser(prog='pylescrape', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--table', default='addresstable.json',
+                    help='address table to resolve sensor names')
+parser.add_argument('--store', default='adverts.json',
+                    help='file keeping the recorded advertisements')
+parser.add_argument('--size', type=int, default=256,
+                    help='number of changes recorded per device')
+parser.add_argument('--rssi-delta', type=int, default=5,
+                    help='minimum RSSI change in dB to record an advertisement with unchanged flags')
+parser.add_argument('--save-interval', type=float, default=60.0,
+                    help='seconds between saving the store')
+parser.add_argument('--report', action='store_const', const=1, default=0,
+                    help='print a summary of the stored advertisements and exit')
+args = parser.parse_args()
+
+store = AdvertisementStore(args.size, args.rssi_delta)
+store.load(args.store)
+delegate = ScanDelegate(args.table, store)
+if args.report:
+    report(store, delegate)
+    exit(0)
+
+scanner = Scanner().withDelegate(delegate)
+saved = time()
+try:
+    while 1:
+        try:
+            scanner.clear()
+            scanner.start()
+            while time() - saved < args.save_interval:
+                scanner.process(1.0)
+        except BTLEException:
+            print("---")
+            pass
+        finally:
+            try:
+                scanner.stop()
+            except BTLEException:
+                pass
+        store.save(args.store)
+        saved = time()
+except KeyboardInterrupt:
+    store.save(args.store)
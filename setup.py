@@ -10,8 +10,8 @@ config = {
     'download_url': 'Where to download it.',
     'author_email': 'gandy92@googlemail.com',
     'version': '0.1',
-    'install_requires': ['nose'],
-    'packages': ['NAME'],
+    'install_requires': ['nose', 'numpy'],
+    'packages': ['pyflowerpower'],
     'scripts': [],
     'name': 'pyFlowerPower'
 }
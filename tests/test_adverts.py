@@ -0,0 +1,82 @@
+import pytest
+
+from pyflowerpower.adverts import AdvertisementStore, DeviceAdverts
+
+
+def test_ring_buffer():
+    dev = DeviceAdverts(4)
+    for i in range(6):
+        dev.append(float(i), -60 - i, 'f%d' % (i % 2))
+    assert list(dev.entries()) == [(2.0, -62, 'f0'), (3.0, -63, 'f1'), (4.0, -64, 'f0'), (5.0, -65, 'f1')]
+    assert dev.flag_values == ['f0', 'f1']
+
+
+def test_rssi_clamped():
+    dev = DeviceAdverts(2)
+    dev.append(0.0, -200, 'f')
+    dev.append(1.0, 300, 'f')
+    assert [e[1] for e in dev.entries()] == [-128, 127]
+
+
+def test_compact_flags():
+    dev = DeviceAdverts(3)
+    for i in range(10):
+        dev.append(float(i), -60, 'f%d' % i)
+    dev.compact()
+    assert dev.flag_values == ['f7', 'f8', 'f9']
+    assert [e[2] for e in dev.entries()] == ['f7', 'f8', 'f9']
+
+
+def test_rssi_stats():
+    dev = DeviceAdverts(4)
+    for rssi in (-60, -70, -80):
+        dev.seen(1.0, rssi)
+    stats = dev.rssi_stats()
+    assert stats['count'] == 3
+    assert stats['mean'] == pytest.approx(-70.0)
+    assert stats['std'] == pytest.approx((200 / 3.0) ** 0.5)
+    assert (stats['min'], stats['max']) == (-80, -60)
+
+
+def test_store_records_changes_only():
+    store = AdvertisementStore(size=8, rssi_delta=5)
+    assert store.add('AA:BB', -60, 'f0', ts=1.0)
+    assert not store.add('aa:bb', -62, 'f0', ts=2.0)
+    assert store.add('aa:bb', -66, 'f0', ts=3.0)
+    assert store.add('aa:bb', -66, 'f1', ts=4.0)
+    assert store.adverts == 4 and store.recorded == 3
+    assert store.last_seen('aa:bb') == 4.0
+    assert store.flags('AA:BB') == 'f1'
+    assert store.rssi_stats('aa:bb')['count'] == 4
+    assert store.addresses() == ['aa:bb']
+    assert store.flags('cc:dd') is None
+
+
+def test_flags_changed():
+    store = AdvertisementStore()
+    store.add('aa', -60, 'f0', ts=1.0)
+    assert not store.flags_changed('aa')
+    store.add('aa', -60, 'f1', ts=10.0)
+    assert store.flags_changed('aa')
+    assert store.flags_changed('aa', since=5.0)
+    assert not store.flags_changed('aa', since=10.0)
+    assert store.flag_history('aa') == [(1.0, 'f0'), (10.0, 'f1')]
+    assert store.flag_history('aa', since=5.0) == [(10.0, 'f1')]
+    assert not store.flags_changed('bb')
+
+
+def test_save_load(tmp_path):
+    filename = str(tmp_path / 'adverts.json')
+    store = AdvertisementStore(size=3)
+    for i in range(5):
+        store.add('aa', -60 - 10 * i, 'f%d' % i, ts=float(i))
+    store.save(filename)
+    loaded = AdvertisementStore(size=3)
+    loaded.load(filename)
+    assert loaded.history('aa') == store.history('aa')
+    assert loaded.rssi_stats('aa') == store.rssi_stats('aa')
+    assert loaded.last_seen('aa') == 4.0
+    # a smaller ring keeps the latest entries
+    smaller = AdvertisementStore(size=2)
+    smaller.load(filename)
+    assert smaller.history('aa') == store.history('aa')[-2:]
@@ -0,0 +1,57 @@
+import asyncio
+from time import time
+
+import pytest
+
+pytest.importorskip('bluepy')
+
+from pyflowerpower.aioupload import receive_sensor, receive_all
+from pyflowerpower.history import History
+from pyflowerpower.sensor import PlantSensor
+from pyflowerpower.simulator import FakePeripheral
+
+
+def connect(**kwargs):
+    p = FakePeripheral(**kwargs)
+    return p, PlantSensor(p.addr, peripheral=p)
+
+
+def test_receive():
+    p, ps = connect(entries=1024)
+    upload = asyncio.run(receive_sensor(ps, count=1024))
+    assert upload.data == p.buffer(p.last_index - 1023)
+    assert upload.stats.complete
+    assert upload.stats.acks == upload.frames.windows()
+    assert upload.history().str() == History.from_bytes(p.buffer(p.last_index - 1023)).str()
+
+
+def test_receive_with_loss():
+    p, ps = connect(entries=1024, loss=0.02, seed=3)
+    upload = asyncio.run(receive_sensor(ps, index=p.last_index - 511))
+    assert upload.data == p.buffer(p.last_index - 511)
+    assert upload.stats.nacks > 0
+    # notifications are routed back to the synchronous upload afterwards
+    assert ps.handles[ps.upload.c_upload_txb.getHandle()] == ps.upload.handle_tx_buffer
+
+
+def test_receive_all():
+    links = [connect(addr='a0:14:3d:00:00:%02x' % n, entries=256 * n, seed=n) for n in range(1, 4)]
+    uploads = receive_all([ps for p, ps in links], count=1024)
+    for (p, ps), upload in zip(links, uploads):
+        assert upload.name == p.addr
+        assert upload.data == p.buffer(p.last_index - p.entries + 1)
+
+
+def test_lost_link():
+    p, ps = connect(entries=1024, disconnect_after=200)
+    results = receive_all([ps], count=1024)
+    # the failure is returned instead of stopping transfers of other sensors
+    assert isinstance(results[0], Exception)
+
+
+def test_deadline():
+    p, ps = connect(entries=1024)
+    upload = asyncio.run(receive_sensor(ps, count=1024, deadline=time() - 1))
+    assert upload.rx_state == upload.RX_CANCEL
+    assert upload.stats.timeouts == {'deadline': 1}
+    assert upload.data == b""
@@ -0,0 +1,88 @@
+import random
+import struct
+
+import numpy as np
+
+from pyflowerpower.archive import HistoryArchive
+from pyflowerpower.history import History, SESSION_MARKER, HEADER_FORMAT, UNKNOWN_SESSION
+
+
+def make_history(first, records, session=4, period=900, marker=None):
+    """Return a History of records entries starting at global index first, values derived from the index."""
+    data = struct.pack(HEADER_FORMAT, 1, 2, records, 1500000000, first + records - 1, session, period)
+    for i in range(first, first + records):
+        if i == marker:
+            data += struct.pack('>6H', SESSION_MARKER, session, period, 0, 0, 0)
+        else:
+            rnd = random.Random(i)
+            data += struct.pack('>6H', *[rnd.randrange(0x8000) for n in range(6)])
+    return History.from_bytes(data)
+
+
+def test_append_and_views(tmp_path):
+    archive = HistoryArchive(str(tmp_path / 'sub' / 'ABCD'))
+    assert archive.last_index() == -1
+    history = make_history(900, 100, marker=900)
+    assert archive.append(history) == 100
+    assert archive.last_index() == 999
+    assert archive.sessions() == [4]
+
+    values = archive.range(900, 999)
+    assert (values == history.values).all()
+    # records are returned as read-only views on the mapped data file
+    assert not values.flags.owndata
+    assert not values.flags.writeable
+    assert (archive.range(950, 959) == history.values[50:60]).all()
+    assert len(archive.range(1000, 1100)) == 0
+    del values
+    archive.close()
+    assert archive.mm is None
+
+
+def test_only_new_records_appended(tmp_path):
+    path = str(tmp_path / 'ABCD')
+    archive = HistoryArchive(path)
+    first = make_history(900, 100, marker=900)
+    second = make_history(950, 100, marker=900)
+    assert archive.append(first) == 100
+    assert archive.append(second) == 50
+    assert archive.append(second) == 0
+    assert archive.append(make_history(800, 150)) == 0
+
+    # a new instance reads the index back
+    archive = HistoryArchive(path)
+    assert archive.last_index() == 1049
+    assert len(archive.entries) == 2
+    assert archive.entries[1].first_index == 1000
+    assert archive.entries[1].session == 4
+    assert archive.header(archive.entries[1]) == second.header
+    assert (archive.range(900, 1049) == np.concatenate([first.values, second.values[50:]])).all()
+
+
+def test_sessions(tmp_path):
+    archive = HistoryArchive(str(tmp_path / 'ABCD'))
+    archive.append(make_history(900, 100, marker=900))
+    # the new session starts within the next block
+    second = make_history(1000, 100, session=5, period=600, marker=1030)
+    archive.append(second)
+    assert archive.sessions() == [4, 5]
+    assert [(e.session, e.period, e.first_index, e.count) for e in archive.entries] == \
+        [(4, 900, 900, 100), (4, 900, 1000, 30), (5, 600, 1030, 70)]
+
+    session = archive.session(4)
+    assert len(session) == 130
+    assert (session[100:] == second.values[:30]).all()
+    session = archive.session(5)
+    assert session[0, 0] == SESSION_MARKER
+    assert not session.flags.owndata
+    assert len(archive.session(6)) == 0
+    assert [e.count for e, view in archive.segments(4)] == [100, 30]
+
+
+def test_unknown_session(tmp_path):
+    archive = HistoryArchive(str(tmp_path / 'ABCD'))
+    # without any marker, the records belong to the session in the header
+    archive.append(make_history(0, 10, session=7))
+    assert archive.sessions() == [7]
+    assert archive.session_at(5) == (7, 900)
+    assert archive.session_at(10) == (UNKNOWN_SESSION, 0)
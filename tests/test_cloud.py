@@ -0,0 +1,208 @@
+import io
+import threading
+from time import time, sleep
+
+from dateutil import parser as dateparser
+import numpy as np
+import pytest
+import requests
+
+from pyflowerpower.cloud import NewApiClient, OldApiClient, SampleColumns, parse_utc
+from pyflowerpower.cloudcache import SampleCache
+from pyflowerpower.cloudstub import CloudStub, NEW_SAMPLES, param_time
+from pyflowerpower.join import tolerance_join, join_stats, format_column, write_columns
+
+SCHEMA = [('temp', 'temp', float), ('level', 'level', float), ('utc', 'utc', str)]
+
+
+@pytest.mark.parametrize('text', [
+    '2017-05-01T12:34:56Z',
+    '2017-05-01T12:34:56.789Z',
+    '2017-05-01 12:34:56Z',
+    '2017-05-01T12:34:56+02:00',
+    '2017-05-01T12:34:56-0130',
+    '2016-02-29T23:59:59z',
+    '2017-05-01T12:34:56',
+    'May 1 2017 12:34:56 UTC',
+])
+def test_parse_utc(text):
+    assert parse_utc(text) == int(dateparser.parse(text).timestamp())
+
+
+def samples(times, temps, levels):
+    return [{'utc': '2017-05-01T00:%02d:00Z' % t, 'temp': temp, 'level': level}
+            for t, temp, level in zip(times, temps, levels)]
+
+
+def test_columns_keep_json_types():
+    data = SampleColumns.from_samples(SCHEMA, 'utc', samples([2, 1, 3], [19.0, 20.5, None], [3, 1, 2]))
+    assert data.titles == ['temp', 'level', 'utc']
+    assert list(data.ts) == [parse_utc('2017-05-01T00:01:00Z') + 60 * i for i in range(3)]
+    assert data.columns[0].dtype == np.float64
+    assert data.columns[1].dtype == np.int64
+    assert list(data.rows())[0][1] == (20.5, 1, '2017-05-01T00:01:00Z')
+    assert list(data.rows())[2][1][0] is None
+
+    # ints mixed with floats or missing values are kept as they are
+    data = SampleColumns.from_samples(SCHEMA, 'utc', samples([1, 2, 3], [1, 2.5, 3], [1, None, 3]))
+    assert data.columns[0].dtype == object
+    assert list(format_column(data.columns[0])) == ['1', '2.5', '3']
+    assert list(format_column(data.columns[1])) == ['1', 'None', '3']
+
+
+def test_columns_unique_and_select():
+    a = SampleColumns.from_samples(SCHEMA, 'utc', samples([1, 2, 3], [1.5, 2.5, 3.5], [1, 2, 3]))
+    b = SampleColumns.from_samples(SCHEMA, 'utc', samples([3, 4], [9.5, 4.5], [3.5, 4.5]))
+    data = SampleColumns.concat([c[0] for c in SCHEMA], [a, b])
+    assert len(data) == 4
+    # the sample of the later part is kept
+    assert list(format_column(data.columns[0])) == ['1.5', '2.5', '9.5', '4.5']
+    # ints of one part and floats of the other are kept as they are
+    assert data.columns[1].dtype == object
+    assert list(format_column(data.columns[1])) == ['1', '2', '3.5', '4.5']
+    part = data.select(data.ts[1], data.ts[2])
+    assert list(part.ts) == list(data.ts[1:3])
+    assert len(SampleColumns.concat(['temp'], [])) == 0
+
+
+def test_format_column_like_str():
+    values = [19.0, 0.1 + 0.2, 1e-05, 1e16, -0.0, 37.5, None]
+    column = SampleColumns.from_lists([('v', 'v', float)], range(len(values)), [values]).columns[0]
+    assert list(format_column(column)) == [str(v) for v in values]
+    assert list(format_column(np.array([1, -2, 65535]))) == ['1', '-2', '65535']
+    f = io.StringIO()
+    write_columns(f, [np.array([1, 2]), np.array([1.0, np.nan])], chunk=1)
+    assert f.getvalue() == '1\t1.0\n2\tNone\n'
+
+
+def test_tolerance_join():
+    records = [100, 200, 300, 400]
+    result = tolerance_join(records, [90, 150, 260, 349, 351, 1000], 50)
+    assert list(result.samples) == [0, 1, 2, 3, 4]
+    # ties go to the later record
+    assert list(result.records) == [0, 1, 2, 2, 3]
+    assert list(result.residuals) == [-10, -50, -40, 49, -49]
+    stats = join_stats(result, len(records), 6)
+    assert stats['matched'] == 5
+    assert stats['unmatched_samples'] == 1
+    assert stats['unmatched_records'] == 0
+    assert stats['offset_min'] == -50 and stats['offset_max'] == 49
+
+    assert len(tolerance_join([], [1, 2], 10).samples) == 0
+    assert len(tolerance_join([1, 2], [], 10).samples) == 0
+
+
+def test_cache_missing_ranges(tmp_path):
+    cache = SampleCache(str(tmp_path / 'cache.sqlite'), settle=0)
+    empty = SampleColumns.concat([c[0] for c in SCHEMA], [])
+    assert cache.missing('p', 'L1', 0, 1000) == [(0, 1000)]
+    cache.add('p', 'L1', 100, 200, empty)
+    cache.add('p', 'L1', 400, 500, empty)
+    assert cache.missing('p', 'L1', 0, 1000) == [(0, 100), (200, 400), (500, 1000)]
+    assert cache.missing('p', 'L1', 120, 180) == []
+    assert cache.missing('p', 'L1', 150, 450) == [(200, 400)]
+    # adjacent and overlapping ranges are merged
+    cache.add('p', 'L1', 200, 420, empty)
+    assert cache.ranges('p', 'L1') == [(100, 500)]
+    assert cache.missing('q', 'L1', 0, 10) == [(0, 10)]
+
+
+def test_cache_settle(tmp_path):
+    cache = SampleCache(str(tmp_path / 'cache.sqlite'), settle=3600)
+    now = int(time())
+    cache.add('p', 'L1', now - 7200, now, SampleColumns.concat(['temp'], []))
+    assert cache.missing('p', 'L1', now - 7200, now)[0][0] >= now - 3600 - 1
+
+
+def test_cache_samples(tmp_path):
+    filename = str(tmp_path / 'cache.sqlite')
+    data = SampleColumns.from_samples(SCHEMA, 'utc', samples([1, 2, 3], [19.0, None, 1], [3, 1, 2]))
+    cache = SampleCache(filename, settle=0)
+    cache.add('p', 'L1', 0, 2000000000, data)
+    cache.set_location('p', 'CE5E', 'L1')
+    cache.close()
+
+    cache = SampleCache(filename)
+    assert cache.location('p', 'CE5E') == 'L1'
+    cached = cache.samples('p', 'L1', SCHEMA, 0, 2000000000)
+    assert list(cached.ts) == list(data.ts)
+    for a, b in zip(cached.columns, data.columns):
+        assert list(format_column(a)) == list(format_column(b))
+    assert len(cache.samples('p', 'L1', SCHEMA, 0, 1000)) == 0
+
+
+@pytest.fixture
+def stub():
+    stub = CloudStub(['PI040AB0CE5E'], interval=900)
+    server = stub.server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    stub.url = 'http://%s:%d' % server.server_address[:2]
+    yield stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('client_class', [OldApiClient, NewApiClient])
+def test_client_against_stub(stub, client_class, tmp_path):
+    cache = SampleCache(str(tmp_path / 'cache.sqlite'), settle=0)
+    client = client_class({'url': stub.url, 'username': 'u'}, rate=0, profile='p', cache=cache)
+    from_ts = 1500000000
+    to_ts = from_ts + 14 * 86400
+    data = client.samples('CE5E', from_ts, to_ts)
+    # configuration and three windows, as a window is one second short of 7 days
+    assert len(data) == 14 * 96
+    assert client.requests == 4
+    assert np.all(np.diff(data.ts) > 0)
+    assert data.titles == [c[0] for c in client_class.COLUMNS]
+
+    # everything is served from the cache now
+    requests = stub.requests
+    cached = client.samples('CE5E', from_ts, to_ts)
+    assert stub.requests == requests
+    assert list(cached.ts) == list(data.ts)
+    assert client.samples('0000', from_ts, to_ts) is None
+
+
+def test_client_retries(stub):
+    stub.error_rate = 0.3
+    client = NewApiClient({'url': stub.url, 'username': 'u'}, rate=0, retries=10, backoff=0.01)
+    assert len(client.samples('CE5E', 1500000000, 1500000000 + 28 * 86400)) == 28 * 96
+    assert stub.errors > 0
+    # every attempt is counted, the authentication is not
+    assert client.requests == stub.requests - 1
+
+
+def test_authentication(stub):
+    stub.latency = 0.2
+    client = NewApiClient({'url': stub.url, 'username': 'u'}, rate=0)
+    headers = []
+    threads = [threading.Thread(target=lambda: headers.append(client.auth_header())) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    sleep(0.02)
+    # requests not needing a new token are not blocked while one is fetched
+    assert client.lock.acquire(timeout=0.1)
+    client.lock.release()
+    for thread in threads:
+        thread.join()
+    # one authentication for all threads
+    assert stub.requests == 1
+    assert headers == [{'Authorization': 'Bearer stub'}] * 4
+
+
+def test_stub_window_limit(stub):
+    def query(days):
+        return [('from_datetime_utc', param_time(1500000000)),
+                ('to_datetime_utc', param_time(1500000000 + days * 86400 - 1))]
+    path = NEW_SAMPLES + stub.location('PI040AB0CE5E')
+    status, response = stub.respond(path, query(7))
+    assert status == 200
+    assert len(response['samples']) == 7 * 96
+    # like the cloud, longer ranges than the client's 7 day windows are refused
+    status, response = stub.respond(path, query(8))
+    assert status == 400
+    client = NewApiClient({'url': stub.url, 'username': 'u'}, rate=0)
+    with pytest.raises(requests.HTTPError):
+        client.request(path, headers=client.auth_header(), params=dict(query(8)))
@@ -0,0 +1,88 @@
+import importlib.util
+import json
+import os
+import random
+import struct
+import threading
+
+import pytest
+
+from pyflowerpower.cloudstub import CloudStub
+from pyflowerpower.history import History, SESSION_MARKER, HEADER_FORMAT
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fp-clouddata.py')
+
+# sensor startup time, a multiple of the stub's sample interval
+STARTUP = 1500001200
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location('fp_clouddata', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_history(filename, addr, session, first, records, period=900):
+    """Write a hist-*.dat file with one session of records, the first one recorded first periods after startup."""
+    rnd = random.Random(session)
+    lts = (first + records - 1) * period
+    data = struct.pack(HEADER_FORMAT, 1, 2, records, lts, first + records - 1, session, period)
+    data += struct.pack('>6H', SESSION_MARKER, session, period, 0, 0, 0)
+    for i in range(records - 1):
+        data += struct.pack('>6H', *[rnd.randrange(0x8000) for n in range(6)])
+    with open(filename, 'w') as f:
+        f.write("# History data collected by test\n")
+        f.write("# current time: %d\n# sensor time: %d\n" % (STARTUP + lts + 60, lts + 60))
+        f.write("# sensor addr: %s\n#\n" % addr)
+        f.write(History.from_bytes(data).str())
+
+
+@pytest.fixture
+def stub():
+    stub = CloudStub(['PI040AB0CE5E'], interval=900, jitter=60)
+    server = stub.server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    stub.url = 'http://%s:%d' % server.server_address[:2]
+    yield stub
+    server.shutdown()
+    server.server_close()
+
+
+def test_handle_batch(stub, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('credentials.json', 'w') as f:
+        f.write(json.dumps({'batch': {'url': stub.url, 'username': 'u', 'method': 'newapi'}}))
+    # two sessions of one sensor in consecutive days, and a sensor unknown to the cloud
+    write_history('hist-CE5E-004.dat', 'a0:14:3d:07:ce:5e', 4, 0, 96)
+    write_history('hist-CE5E-005.dat', 'a0:14:3d:07:ce:5e', 5, 96, 96)
+    write_history('hist-0001-001.dat', 'a0:14:3d:00:00:01', 1, 0, 48)
+    with open('hist-bad-001.dat', 'w') as f:
+        f.write("# 1,2,records=x\n")
+
+    script = load_script()
+    script.args = script.parser.parse_args(['-p', 'batch', '-b', '-j', '2', '--summary', 'summary.json', '--rate', '0',
+                                            'hist-CE5E-004.dat', 'hist-CE5E-005.dat', 'hist-0001-001.dat',
+                                            'hist-bad-001.dat'])
+    script.cache = None
+    script.cassette = None
+    summary = script.handle_batch('batch', script.args.file)
+
+    assert json.loads(open('summary.json').read()) == summary
+    entries = dict((e['file'], e) for e in summary)
+    assert 'error' in entries['hist-bad-001.dat']
+    assert entries['hist-0001-001.dat']['error'] == 'no cloud location'
+    for fn, session in [('hist-CE5E-004.dat', 4), ('hist-CE5E-005.dat', 5)]:
+        entry = entries[fn]
+        assert entry['session'] == session
+        assert entry['records'] == 96
+        # every record has its cloud sample
+        assert entry['matched'] == 96
+        assert entry['unmatched_records'] == 0
+        assert abs(entry['offset_median']) <= 60
+        lines = [line for line in open(entry['output']) if not line.startswith('#')]
+        assert len(lines) == 96
+    # the adjacent ranges of both sessions are fetched in one request, after authentication and configuration
+    assert stub.requests == 3
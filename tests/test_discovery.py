@@ -0,0 +1,143 @@
+import json
+import threading
+from time import time, sleep
+
+import pytest
+
+pytest.importorskip('bluepy')
+
+from pyflowerpower.discovery import StreamingDiscovery, load_registry, overdue_priority, pause_scan
+from pyflowerpower.scheduler import ScanGate
+
+FP_UUID = '1bc5d5a50200baafe211a88400fae139'
+
+
+class Device:
+
+    def __init__(self, addr, rssi=-60, fp=True):
+        self.addr = addr
+        self.addrType = 'public'
+        self.rssi = rssi
+        self.fp = fp
+
+    def getScanData(self):
+        return [(6, 'Complete 128b Services', FP_UUID if self.fp else '0000')]
+
+
+class Scanner:
+    """Deliver one advertisement per process() call, like a scan in progress."""
+
+    def __init__(self, delegate, adverts):
+        self.delegate = delegate
+        self.adverts = list(adverts)
+        self.running = False
+        self.starts = 0
+        self.processed = 0
+
+    def clear(self):
+        pass
+
+    def start(self):
+        self.running = True
+        self.starts += 1
+
+    def stop(self):
+        self.running = False
+
+    def process(self, timeout):
+        assert self.running
+        self.processed += 1
+        if self.adverts:
+            self.delegate.handleDiscovery(self.adverts.pop(0), True, True)
+        else:
+            sleep(timeout)
+
+
+class Scheduler:
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, key, item, priority=0):
+        self.submitted.append((key, priority))
+
+
+class State:
+
+    def __init__(self, sensors):
+        self.sensors = sensors
+
+    def get(self, addr):
+        return dict(self.sensors.get(addr, {}))
+
+
+def test_submit_once():
+    scheduler = Scheduler()
+    discovery = StreamingDiscovery(scheduler, State({}), order='rssi')
+    adverts = [Device('A0:14:3D:00:00:01', -70), Device('00:11:22:33:44:55', fp=False),
+               Device('a0:14:3d:00:00:02', -50), Device('a0:14:3d:00:00:01', -40)]
+    seen = discovery.run(Scanner(discovery, adverts), timeout=0.1, step=0.01)
+    assert seen == {'a0:14:3d:00:00:01', 'a0:14:3d:00:00:02'}
+    assert scheduler.submitted == [('A0:14:3D:00:00:01', 70), ('a0:14:3d:00:00:02', 50)]
+
+
+def test_accept():
+    scheduler = Scheduler()
+    discovery = StreamingDiscovery(scheduler, State({}), accept=lambda addr: addr.endswith('02'))
+    adverts = [Device('a0:14:3d:00:00:01'), Device('a0:14:3d:00:00:02')]
+    discovery.run(Scanner(discovery, adverts), timeout=0.1, step=0.01)
+    assert [key for key, priority in scheduler.submitted] == ['a0:14:3d:00:00:02']
+
+
+def test_overdue_priority():
+    state = {'a0:14:3d:00:00:01': {'time': 1000.0}, 'a0:14:3d:00:00:02': {'time': 2000.0}}
+    never = overdue_priority(Device('a0:14:3d:00:00:03'), {}, now=3000.0)
+    old = overdue_priority(Device('a0:14:3d:00:00:01'), state['a0:14:3d:00:00:01'], now=3000.0)
+    recent = overdue_priority(Device('a0:14:3d:00:00:02', -40), state['a0:14:3d:00:00:02'], now=3000.0)
+    assert never < old < recent
+    assert old == pytest.approx(-2000.0 + 0.06)
+
+
+def test_registry_stops_scan(tmp_path):
+    filename = str(tmp_path / 'addresstable.json')
+    with open(filename, 'w') as f:
+        f.write(json.dumps({'A0:14:3D:00:00:01': 'ficus', 'a0:14:3d:00:00:02': 'basil'}))
+    registry = load_registry(filename)
+    assert registry == {'a0:14:3d:00:00:01', 'a0:14:3d:00:00:02'}
+    assert load_registry(str(tmp_path / 'missing.json')) == set()
+
+    scheduler = Scheduler()
+    discovery = StreamingDiscovery(scheduler, State({}), registry=registry)
+    adverts = [Device('a0:14:3d:00:00:01'), Device('a0:14:3d:00:00:03'), Device('a0:14:3d:00:00:02'),
+               Device('a0:14:3d:00:00:04')]
+    scanner = Scanner(discovery, adverts)
+    start = time()
+    discovery.run(scanner, timeout=5.0, step=0.5)
+    # scanning stops once all registered sensors were seen, not after the timeout
+    assert time() - start < 1.0
+    assert discovery.complete()
+    assert scanner.processed == 3
+    assert not scanner.running
+    assert len(scheduler.submitted) == 3
+
+
+def test_pause_scan():
+    gate = ScanGate(0)
+    scanner = Scanner(None, [])
+    scanner.start()
+    gate.start_scan()
+    assert pause_scan(scanner, gate) == 0.0
+    assert scanner.starts == 1
+    # a worker waits for the scan to stop before connecting
+    gate.connections += 1
+    assert gate.paused()
+    restarted = []
+    thread = threading.Thread(target=lambda: restarted.append(pause_scan(scanner, gate)))
+    thread.start()
+    sleep(0.05)
+    assert not gate.scanning
+    gate.leave(0)
+    thread.join(5)
+    assert restarted and restarted[0] >= 0.04
+    assert scanner.running and gate.scanning
+    assert scanner.starts == 2
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+pytest.importorskip('bluepy')
+
+from bluepy.btle import BTLEException
+
+from pyflowerpower.sensor import PlantSensor, FP_INFO_FW_VERSION, \
+    FP_SERVICE_NEW, FP_CHAR_NEW_1, CT_U16
+from pyflowerpower.simulator import FakePeripheral
+from pyflowerpower.state import HandleCache
+
+
+def test_cache_put_invalidate(tmp_path):
+    filename = str(tmp_path / 'handles.json')
+    cache = HandleCache(filename)
+    cache.put('A0:14:3D:00:00:01', '2.0.2', {'00000001': 17})
+    assert HandleCache(filename).get('a0:14:3d:00:00:01') == {'2.0.2': {'00000001': 17}}
+    # a new firmware revision replaces the entry
+    cache.put('a0:14:3d:00:00:01', '2.0.3', {'00000001': 18})
+    assert list(cache.get('a0:14:3d:00:00:01')) == ['2.0.3']
+    cache.invalidate('a0:14:3d:00:00:01')
+    assert HandleCache(filename).get('a0:14:3d:00:00:01') == {}
+
+
+def test_cached_handles_skip_discovery(tmp_path):
+    cache = HandleCache(str(tmp_path / 'handles.json'))
+    p = FakePeripheral()
+    PlantSensor(p.addr, cache=cache, peripheral=p)
+    assert p.requests['discover'] > 0
+    assert '2.0.2' in cache.get(p.addr)
+
+    p = FakePeripheral()
+    ps = PlantSensor(p.addr, cache=cache, peripheral=p)
+    assert ps.cached
+    assert 'discover' not in p.requests
+    assert ps.c_fw_ver.values() == '2.0.2'
+
+
+def test_other_firmware_discovers(tmp_path):
+    cache = HandleCache(str(tmp_path / 'handles.json'))
+    p = FakePeripheral()
+    PlantSensor(p.addr, cache=cache, peripheral=p)
+
+    p = FakePeripheral(firmware='2.0.3')
+    ps = PlantSensor(p.addr, cache=cache, peripheral=p)
+    assert not ps.cached
+    assert p.requests['discover'] > 0
+    assert list(cache.get(p.addr)) == ['2.0.3']
+
+
+def test_invalid_cached_handles_fall_back(tmp_path):
+    filename = str(tmp_path / 'handles.json')
+    p = FakePeripheral()
+    with open(filename, 'w') as f:
+        f.write(json.dumps({p.addr: {'2.0.2': {'%08x' % FP_INFO_FW_VERSION: 0x7777}}}))
+    cache = HandleCache(filename)
+    ps = PlantSensor(p.addr, cache=cache, peripheral=p)
+    assert not ps.cached
+    assert p.requests['discover'] > 0
+    handles = cache.get(p.addr)['2.0.2']
+    assert handles['%08x' % FP_INFO_FW_VERSION] == p.chars[FP_INFO_FW_VERSION]
+
+
+def test_missing_service_cached_as_missing(tmp_path):
+    cache = HandleCache(str(tmp_path / 'handles.json'))
+    p = FakePeripheral(new_service=False)
+    snapshot = PlantSensor(p.addr, cache=cache, peripheral=p).snapshot()
+    assert snapshot.new_1 is None
+    assert snapshot.battery is not None
+    assert cache.get(p.addr)['2.0.2']['%08x' % FP_CHAR_NEW_1] == 0
+
+
+def test_disconnect_during_discovery_not_cached(tmp_path):
+    cache = HandleCache(str(tmp_path / 'handles.json'))
+    p = FakePeripheral()
+    ps = PlantSensor(p.addr, cache=cache, peripheral=p)
+    p.disconnect()
+    with pytest.raises(BTLEException):
+        ps.optional_register(FP_SERVICE_NEW, FP_CHAR_NEW_1, CT_U16)
+    assert '%08x' % FP_CHAR_NEW_1 not in ps.char_handles
+    assert '%08x' % FP_CHAR_NEW_1 not in cache.get(p.addr)['2.0.2']
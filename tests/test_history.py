@@ -0,0 +1,110 @@
+import random
+import struct
+
+import numpy as np
+
+from pyflowerpower.history import History, Session, SESSION_MARKER, UNKNOWN_SESSION, HEADER_FORMAT, \
+    read_history_file, append_history, session_index, session_times
+
+
+def make_buffer(records, session=4, period=900, marker=None, seed=0):
+    """Return a raw upload buffer with random records, with a session marker at record marker."""
+    rnd = random.Random(seed)
+    data = struct.pack(HEADER_FORMAT, 1, 2, records, 1500000000, 20000, session, period)
+    for i in range(records):
+        if i == marker:
+            data += struct.pack('>6H', SESSION_MARKER, session, period, 0, 0, 0)
+        else:
+            data += struct.pack('>6H', *[rnd.randrange(0x8000) for n in range(6)])
+    return data
+
+
+def baseline_str(data):
+    """History text as formatted by fp-download.py before History was introduced."""
+    s = "# %d,%d,records=%d,lts=%d,lidx=%d,sid=%d,sp=%d\n" % struct.unpack(">BBHLLHH", data[0:16])
+    s += "#\n"
+    n = int((len(data) - 16) / 12)
+    for i in range(0, n):
+        s += "%d " % i
+        s += (" 0x%02x%02x" * 6) % struct.unpack(">12B", data[16+12*i:28+12*i])
+        s += (" %d" * 6) % struct.unpack(">6H", data[16+12*i:28+12*i])
+        s += "\n"
+    return s
+
+
+def test_str_matches_baseline():
+    data = make_buffer(5000, marker=1234)
+    # values with all bits set are formatted like any other
+    data += struct.pack('>6H', 0xffff, 0, 0x8000, 1, 0x7fff, 0xfffe)
+    history = History.from_bytes(data)
+    assert history.str() == baseline_str(data)
+    assert history.bytes() == data
+
+
+def test_header():
+    history = History.from_bytes(make_buffer(10, session=7, period=600))
+    assert (history.records, history.last_ts, history.last_idx, history.session, history.period) == \
+        (10, 1500000000, 20000, 7, 600)
+    assert len(history) == 10
+    assert history.index(0) == 19991
+
+
+def test_text_roundtrip(tmp_path):
+    data = make_buffer(3000, marker=100)
+    filename = str(tmp_path / 'hist-TEST-004.dat')
+    with open(filename, 'w') as f:
+        f.write("# History data collected by test\n# sensor addr: a0:14:3d:07:ce:5e\n")
+        f.write(History.from_bytes(data).str())
+    history = History.from_text(filename)
+    assert history.bytes() == data
+
+    params, values, head = read_history_file(filename, chunk_lines=256)
+    assert params['sensor addr'] == 'a0:14:3d:07:ce:5e'
+    assert params['sid'] == '4'
+    assert head.startswith("# History data collected by test\n")
+    assert np.array_equal(values, History.from_bytes(data).values)
+
+
+def test_read_last_session(tmp_path):
+    data = make_buffer(3000, marker=2500)
+    filename = str(tmp_path / 'hist.dat')
+    with open(filename, 'w') as f:
+        f.write(History.from_bytes(data).str())
+    params, values, head = read_history_file(filename, last_session=True, chunk_lines=256)
+    assert len(values) == 500
+    assert values[0, 0] == SESSION_MARKER
+
+
+def test_append_history(tmp_path):
+    data = make_buffer(300)
+    first = History.from_bytes(data[:16 + 12 * 200])
+    filename = str(tmp_path / 'hist.dat')
+    with open(filename, 'w') as f:
+        f.write("# old head\n" + first.str())
+    rest = History.from_bytes(struct.pack(HEADER_FORMAT, 1, 2, 100, 1500000000, 20000, 4, 900) + data[16 + 12 * 200:])
+    append_history(filename, "# new head\n", rest)
+    with open(filename) as f:
+        text = f.read()
+    assert text == "# new head\n" + baseline_str(data)
+
+
+def test_session_index():
+    values = History.from_bytes(make_buffer(100, session=4, period=900, marker=30)).values
+    assert session_index(values) == [Session(UNKNOWN_SESSION, 0, 0, 30), Session(4, 900, 30, 100)]
+
+    values = History.from_bytes(make_buffer(100, marker=0)).values
+    assert session_index(values) == [Session(4, 900, 0, 100)]
+
+    # without markers, the records belong to the session given
+    values = History.from_bytes(make_buffer(100)).values
+    assert session_index(values, 4, 900) == [Session(4, 900, 0, 100)]
+    assert session_index(values[:0]) == []
+
+
+def test_session_times():
+    sessions = [Session(3, 600, 0, 10), Session(4, 900, 10, 20)]
+    times = session_times(sessions, 100000)
+    assert times == [100000 - 9 * 900 - 600 - 9 * 600, 100000 - 9 * 900]
+    # times before a session with unknown period are unknown
+    sessions = [Session(UNKNOWN_SESSION, 0, 0, 10), Session(4, 900, 10, 20)]
+    assert session_times(sessions, 100000) == [None, 100000 - 9 * 900]
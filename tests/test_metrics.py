@@ -0,0 +1,84 @@
+import os
+import struct
+
+from pyflowerpower.metrics import TransferStats, PrometheusFile, METRICS
+from pyflowerpower.upload import FrameAssembler, FRAME_PAYLOAD
+
+
+def make_stats(acks=3, nacks=1):
+    frames = FrameAssembler()
+    size = FRAME_PAYLOAD * 10
+    frames.add(0, struct.pack('<L', size) + b'\0' * (FRAME_PAYLOAD - 4))
+    for frame in range(1, 11):
+        frames.add(frame, b'\1' * FRAME_PAYLOAD)
+    frames.add(5, b'\1' * FRAME_PAYLOAD)
+    stats = TransferStats()
+    stats.start(0)
+    stats.state(1)
+    stats.state(2)
+    for i in range(acks):
+        stats.ack()
+    for i in range(nacks):
+        stats.nack()
+    stats.timeout('frames')
+    stats.timeout('frames')
+    stats.finish(frames)
+    return stats
+
+
+def test_stats():
+    stats = make_stats()
+    assert stats.bytes == FRAME_PAYLOAD * 10
+    assert stats.frames == 11
+    assert stats.duplicates == 1
+    assert stats.windows == 1
+    assert stats.complete
+    assert stats.timeouts == {'frames': 2}
+    assert sorted(stats.state_seconds) == ['idle', 'transfer', 'wait_ack']
+    assert stats.duration() >= sum(stats.state_seconds.values())
+    values = stats.dict()
+    assert values['acks'] == 3 and values['nacks'] == 1
+    assert '180 bytes in 11 frames (1 duplicates), 1 windows, 3 ACK, 1 NACK' in stats.str()
+
+
+def test_stats_empty_transfer():
+    stats = TransferStats()
+    stats.start()
+    stats.finish(FrameAssembler())
+    assert stats.bytes == 0
+    assert not stats.complete
+    assert stats.throughput() >= 0.0
+
+
+def parse(filename):
+    samples = {}
+    for line in open(filename).read().splitlines():
+        if not line.startswith('#'):
+            key, value = line.rsplit(' ', 1)
+            samples[key] = float(value)
+    return samples
+
+
+def test_prometheus_file(tmp_path):
+    filename = str(tmp_path / 'fp.prom')
+    metrics = PrometheusFile(filename)
+    metrics.update('a0:14:3d:00:00:02', make_stats(acks=1))
+    metrics.update('a0:14:3d:00:00:01', make_stats(acks=3))
+    assert not os.path.exists(filename + '.tmp')
+
+    text = open(filename).read()
+    for name, desc, value in METRICS:
+        assert '# HELP %s %s\n# TYPE %s gauge\n' % (name, desc, name) in text
+    # sensors are sorted by address
+    assert text.index('fp_upload_acks{addr="a0:14:3d:00:00:01"}') < \
+        text.index('fp_upload_acks{addr="a0:14:3d:00:00:02"}')
+
+    samples = parse(filename)
+    assert samples['fp_upload_acks{addr="a0:14:3d:00:00:01"}'] == 3.0
+    assert samples['fp_upload_bytes{addr="a0:14:3d:00:00:02"}'] == FRAME_PAYLOAD * 10
+    assert samples['fp_upload_timeouts{addr="a0:14:3d:00:00:01",kind="frames"}'] == 2
+    assert 'fp_upload_state_seconds{addr="a0:14:3d:00:00:01",state="wait_ack"}' in samples
+
+    # a new transfer replaces the statistics of the sensor
+    metrics.update('a0:14:3d:00:00:01', make_stats(acks=5))
+    assert parse(filename)['fp_upload_acks{addr="a0:14:3d:00:00:01"}'] == 5.0
@@ -0,0 +1,68 @@
+import pytest
+
+from pyflowerpower.planner import DownloadPlanner, observe
+
+
+def test_observe_capacity():
+    values = observe({}, 80, 1000, 5000)
+    assert values == {'battery': 80, 'entries': 1000, 'sensor_last_index': 5000}
+    # entries still growing
+    assert 'capacity' not in observe(values, 80, 1100, 5100)
+    # same number of entries while the index advanced: the buffer is full
+    assert observe(values, 80, 1000, 5100)['capacity'] == 1000
+    assert 'capacity' not in observe(values, 80, 1000, 5000)
+
+
+def test_fill_fraction():
+    planner = DownloadPlanner(safety=0.5, max_fill=0.9, low_battery=20, good_battery=50)
+    assert planner.fill_fraction(None) == 0.5
+    assert planner.fill_fraction(80) == 0.5
+    assert planner.fill_fraction(10) == 0.9
+    assert planner.fill_fraction(35) == pytest.approx(0.7)
+
+
+def test_interval():
+    planner = DownloadPlanner(capacity=1000, min_interval=3600)
+    assert planner.interval({'period': 900}) == 0.5 * 1000 * 900
+    assert planner.interval({'period': 900, 'battery': 5, 'capacity': 2000}) == 0.9 * 2000 * 900
+    # never less than min_interval, unless entries would be lost
+    assert planner.interval({'period': 1, 'capacity': 100}) == 0.9 * 100
+    assert DownloadPlanner(capacity=6, min_interval=3600).interval({'period': 900}) == 3600
+
+
+def test_due():
+    planner = DownloadPlanner(capacity=1000)
+    assert planner.due({}) == 0
+    assert planner.reason({}) == "never downloaded"
+    known = {'time': 100000, 'period': 900, 'battery': 30}
+    assert planner.due(known) == 100000 + planner.interval(known)
+    assert planner.reason(known) == "battery 30%"
+    assert planner.reason({'time': 0, 'battery': 90}) == "capacity"
+    assert planner.is_due(known, now=planner.due(known))
+    assert not planner.is_due(known, now=planner.due(known) - 1)
+    # planner observations only, never downloaded
+    assert planner.is_due(observe({}, 80, 1000, 5000), now=0)
+
+
+def test_plan_slots():
+    planner = DownloadPlanner(capacity=1000, slot=300, per_slot=2)
+    sensors = dict(('s%d' % i, {}) for i in range(5))
+    sensors['late'] = {'time': 100000, 'period': 900}
+    plan = planner.plan(sensors, now=1000)
+    assert [e.time for e in plan[:5]] == [1000, 1000, 1300, 1300, 1600]
+    assert plan[-1].addr == 'late'
+    assert plan[-1].time == plan[-1].due == 100000 + 0.5 * 1000 * 900
+    assert all(e.reason == "never downloaded" for e in plan[:5])
+
+
+def test_current_slot():
+    planner = DownloadPlanner(capacity=1000, slot=300, per_slot=2)
+    sensors = dict(('s%d' % i, {}) for i in range(3))
+    sensors['late'] = {'time': 100000, 'period': 900}
+    sensors['soon'] = {'time': 1100 - planner.interval({'period': 900}), 'period': 900}
+    # three sensors due, two connections per slot: the third one is deferred
+    current = planner.current(sensors, now=1000)
+    assert len(current) == 2
+    assert current < set(['s0', 's1', 's2'])
+    assert planner.current({'soon': sensors['soon']}, now=1000) == set(['soon'])
+    assert planner.current({'late': sensors['late']}, now=1000) == set()
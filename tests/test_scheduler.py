@@ -0,0 +1,99 @@
+import threading
+from time import sleep
+
+import pytest
+
+from pyflowerpower.scheduler import DownloadScheduler, ScanGate
+
+
+def test_results_and_retries():
+    calls = {}
+    lock = threading.Lock()
+
+    def job(item, iface):
+        with lock:
+            calls[item] = calls.get(item, 0) + 1
+        return item != 'bad' and (item != 'flaky' or calls[item] > 1)
+
+    done = {}
+    scheduler = DownloadScheduler(job, adapters=(0, 1), retries=2, retry_delay=0.01,
+                                  done=lambda key, ok: done.update({key: ok}))
+    for item in ('good', 'flaky', 'bad'):
+        scheduler.submit(item, item)
+    results = scheduler.run()
+    assert results == {'good': True, 'flaky': True, 'bad': False}
+    assert done == results
+    assert calls == {'good': 1, 'flaky': 2, 'bad': 3}
+    assert scheduler.attempts['bad'] == 3
+
+
+def test_concurrency_limit():
+    running = [0, 0]
+    lock = threading.Lock()
+
+    def job(item, iface):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return 1
+
+    scheduler = DownloadScheduler(job, adapters=(0, 1), links=3, concurrency=2)
+    for i in range(10):
+        scheduler.submit(i, i)
+    scheduler.run()
+    assert running[1] == 2
+
+
+def test_scan_gate():
+    gate = ScanGate(0)
+    scanning = [False]
+    overlaps = []
+
+    def job(item, iface):
+        overlaps.append(iface == 0 and scanning[0])
+        sleep(0.05)
+        return 1
+
+    scheduler = DownloadScheduler(job, adapters=(0, 1), gate=gate)
+    scheduler.start()
+    gate.start_scan()
+    scanning[0] = True
+    for i in range(4):
+        scheduler.submit(i, i)
+    # jobs on other adapters do not pause the scan
+    while len(overlaps) < 2 and not gate.paused():
+        sleep(0.01)
+    for n in range(200):
+        if gate.paused():
+            scanning[0] = False
+            gate.stop_scan()
+            gate.start_scan()
+            scanning[0] = True
+        sleep(0.005)
+    scanning[0] = False
+    gate.stop_scan()
+    scheduler.wait()
+    scheduler.stop()
+    assert len(overlaps) == 4
+    assert not any(overlaps)
+
+
+def test_trigger_backoff():
+    pytest.importorskip('bluepy')
+    from pyflowerpower.trigger import DownloadTrigger
+
+    trigger = DownloadTrigger(None, None, None, backoff=60, max_backoff=200)
+    trigger.queued.add('aa')
+    trigger.done('AA', 0, now=1000)
+    assert 'aa' not in trigger.queued
+    assert trigger.retry_at['aa'] == 1060
+    trigger.done('aa', 0, now=2000)
+    assert trigger.retry_at['aa'] == 2120
+    trigger.done('aa', 0, now=3000)
+    trigger.done('aa', 0, now=4000)
+    assert trigger.retry_at['aa'] == 4200
+    trigger.done('aa', 1)
+    assert 'aa' not in trigger.retry_at and 'aa' not in trigger.failures
@@ -0,0 +1,114 @@
+import csv
+import json
+import sqlite3
+import struct
+import threading
+from time import time
+
+import pytest
+
+from pyflowerpower.sinks import SinkWorker, make_sink
+
+FIELDS = ['addr', 'time', 'dli', 'air_temp']
+
+
+def records(n):
+    return [{'addr': 'a0:14:3d:00:00:01', 'time': 1500000000 + i, 'dli': i, 'air_temp': None}
+            for i in range(n)]
+
+
+def test_make_sink():
+    assert make_sink('csv:live.csv', FIELDS).filename == 'live.csv'
+    with pytest.raises(ValueError):
+        make_sink('xml:live.xml', FIELDS)
+
+
+def test_sinks(tmp_path):
+    names = dict((kind, str(tmp_path / ('live.' + kind))) for kind in ['ndjson', 'csv', 'sqlite'])
+    # the second worker appends to the files of the first one
+    for part in [records(3), records(5)[3:]]:
+        worker = SinkWorker([make_sink('%s:%s' % item, FIELDS) for item in sorted(names.items())])
+        for record in part:
+            worker.put(record)
+        worker.close()
+        assert worker.written == len(part)
+        assert worker.dropped == 0
+
+    lines = open(names['ndjson']).read().splitlines()
+    assert [json.loads(line) for line in lines] == records(5)
+
+    rows = list(csv.reader(open(names['csv'])))
+    assert rows[0] == FIELDS
+    assert [row[2] for row in rows[1:]] == ['0', '1', '2', '3', '4']
+    assert rows[1][3] == ''
+
+    db = sqlite3.connect(names['sqlite'])
+    assert db.execute('SELECT dli, air_temp FROM live ORDER BY time').fetchall() == [(i, None) for i in range(5)]
+    db.close()
+
+
+class BlockingSink:
+
+    def __init__(self):
+        self.filename = 'blocking'
+        self.records = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, record):
+        self.started.set()
+        self.release.wait(5)
+        self.records.append(record['dli'])
+
+    def close(self):
+        pass
+
+
+def test_worker_drops_oldest():
+    sink = BlockingSink()
+    worker = SinkWorker([sink], size=3)
+    worker.put(records(1)[0])
+    assert sink.started.wait(5)
+    # the writer thread is stuck in the sink, put() must not block
+    for record in records(10)[1:]:
+        worker.put(record)
+    assert worker.dropped == 6
+    sink.release.set()
+    worker.close()
+    assert sink.records == [0, 7, 8, 9]
+
+
+def test_live_stream():
+    pytest.importorskip('bluepy')
+    from pyflowerpower.sensor import PlantSensor, LiveStream, LIVE_FIELDS, \
+        FP_CHAR_LIFE_DLI, FP_CHAR_LIFE_ATEMP, FP_CHAR_LIFE_PERIOD
+    from pyflowerpower.simulator import FakePeripheral
+
+    p = FakePeripheral()
+    ps = PlantSensor(p.addr, peripheral=p)
+    out = []
+    stream = LiveStream(ps, 300, out.append)
+    assert stream.period == 255
+    stream.start()
+    assert p.values[p.chars[FP_CHAR_LIFE_PERIOD]] == b'\xff'
+    assert p.chars[FP_CHAR_LIFE_DLI] in p.subscribed
+
+    # notifications within one period are coalesced into one record
+    p.notify(FP_CHAR_LIFE_DLI, struct.pack('<H', 1200))
+    p.notify(FP_CHAR_LIFE_ATEMP, struct.pack('<H', 300))
+    p.notify(FP_CHAR_LIFE_DLI, struct.pack('<H', 1234))
+    p.advance(time())
+    stream.emit(1500000000.0)
+    # nothing notified, no record
+    stream.emit(1500000255.0)
+    assert len(out) == 1
+    assert sorted(out[0]) == sorted(LIVE_FIELDS)
+    assert out[0]['addr'] == p.addr
+    assert out[0]['time'] == 1500000000.0
+    assert out[0]['dli'] == 1234
+    assert out[0]['air_temp'] == 300
+    assert out[0]['soil_ec'] is None
+
+    stream.stop()
+    assert p.values[p.chars[FP_CHAR_LIFE_PERIOD]] == b'\0'
+    assert p.chars[FP_CHAR_LIFE_DLI] not in p.subscribed
@@ -0,0 +1,92 @@
+import csv
+import json
+
+import pytest
+
+from pyflowerpower.snapshot import Snapshot, SnapshotWriter, SNAPSHOT_FIELDS
+
+
+def make_snapshot(**values):
+    fields = dict((field, None) for field in SNAPSHOT_FIELDS)
+    fields.update(addr='a0:14:3d:00:00:01', time=1500000000, name='Flower power 0001',
+                  battery=87, calib=[1, 2, 3], dli_cal=0.5)
+    fields.update(values)
+    return Snapshot(**fields)
+
+
+def test_json():
+    snapshot = make_snapshot()
+    assert json.loads(snapshot.json()) == snapshot.dict()
+    assert json.loads(snapshot.json())['soil_ec'] is None
+
+
+def test_writer_json(tmp_path):
+    filename = str(tmp_path / 'snapshots.ndjson')
+    with open(filename, 'a') as f:
+        writer = SnapshotWriter(f)
+        writer.write(make_snapshot())
+        writer.write(make_snapshot(battery=86))
+    lines = open(filename).read().splitlines()
+    assert writer.count == 2
+    assert [json.loads(line)['battery'] for line in lines] == [87, 86]
+
+
+def test_sensor_snapshot(tmp_path):
+    pytest.importorskip('bluepy')
+    from pyflowerpower.sensor import PlantSensor
+    from pyflowerpower.simulator import FakePeripheral
+    from pyflowerpower.state import HandleCache
+
+    cache = HandleCache(str(tmp_path / 'handles.json'))
+    p = FakePeripheral()
+    snapshot = PlantSensor(p.addr, cache=cache, peripheral=p).snapshot()
+    assert snapshot.addr == p.addr
+    assert snapshot.name == 'Flower power 0001'
+    assert snapshot.firmware == '2.0.2'
+    assert snapshot.battery == 87
+    assert snapshot.sensor_time == p.sensor_time
+    assert snapshot.calib == [1] * 11
+    assert snapshot.new_1 == 1
+
+    # with cached handles, one read per register and no discovery
+    p = FakePeripheral()
+    ps = PlantSensor(p.addr, cache=cache, peripheral=p)
+    reads = p.requests['read']
+    again = ps.snapshot()
+    assert again == snapshot._replace(time=again.time)
+    assert 'discover' not in p.requests
+    assert p.requests['read'] == reads + len(SNAPSHOT_FIELDS) - 2
+
+
+def test_sensor_snapshot_old_firmware():
+    pytest.importorskip('bluepy')
+    from pyflowerpower.sensor import PlantSensor
+    from pyflowerpower.simulator import FakePeripheral
+
+    p = FakePeripheral(new_service=False)
+    snapshot = PlantSensor(p.addr, peripheral=p).snapshot()
+    assert snapshot.battery == 87
+    assert [snapshot.dict()['new_%d' % n] for n in range(1, 7)] == [None] * 6
+
+
+def test_writer_csv_quoting(tmp_path):
+    filename = str(tmp_path / 'snapshots.csv')
+    with open(filename, 'a') as f:
+        SnapshotWriter(f, 'csv').write(make_snapshot(name='Ficus, "kitchen"'))
+    rows = list(csv.reader(open(filename)))
+    assert rows[0] == SNAPSHOT_FIELDS
+    row = dict(zip(rows[0], rows[1]))
+    assert row['name'] == 'Ficus, "kitchen"'
+    assert row['calib'] == '1 2 3'
+    assert row['soil_ec'] == ''
+    assert len(rows[1]) == len(SNAPSHOT_FIELDS)
+
+
+def test_writer_csv_header_once(tmp_path):
+    filename = str(tmp_path / 'snapshots.csv')
+    for battery in [87, 86]:
+        with open(filename, 'a') as f:
+            SnapshotWriter(f, 'csv').write(make_snapshot(battery=battery))
+    rows = list(csv.reader(open(filename)))
+    assert rows[0] == SNAPSHOT_FIELDS
+    assert [row[SNAPSHOT_FIELDS.index('battery')] for row in rows[1:]] == ['87', '86']
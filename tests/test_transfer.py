@@ -0,0 +1,112 @@
+import os
+from time import time
+
+import pytest
+
+pytest.importorskip('bluepy')
+
+from bluepy.btle import BTLEException
+
+from pyflowerpower.checkpoint import TransferCheckpoint
+from pyflowerpower.history import History
+from pyflowerpower.sensor import PlantSensor
+from pyflowerpower.simulator import FakePeripheral
+
+
+def connect(p):
+    return PlantSensor(p.addr, peripheral=p)
+
+
+def test_receive():
+    p = FakePeripheral(entries=1000)
+    ps = connect(p)
+    ps.upload.receive(count=1000)
+    assert ps.upload.raw() == p.buffer(p.last_index - 999)
+    stats = ps.upload.stats
+    assert stats.complete
+    assert stats.nacks == 0
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_receive_with_loss(seed):
+    p = FakePeripheral(entries=2000, loss=0.05, jitter=0.001, seed=seed)
+    ps = connect(p)
+    ps.upload.receive(count=2000)
+    assert ps.upload.raw() == p.buffer(p.last_index - 1999)
+    assert ps.upload.stats.nacks > 0
+    assert len(ps.upload.history()) == 2000
+
+
+def test_receive_from_index():
+    p = FakePeripheral(entries=4096)
+    ps = connect(p)
+    ps.upload.receive(index=p.last_index - 99)
+    history = ps.upload.history()
+    assert ps.upload.raw() == p.buffer(p.last_index - 99)
+    assert history.last_idx == p.last_index
+    assert history.index(0) == p.last_index - 99
+
+
+def test_incomplete_transfer_has_no_data():
+    p = FakePeripheral(entries=2000, disconnect_after=500)
+    ps = connect(p)
+    with pytest.raises(BTLEException):
+        ps.upload.receive(count=2000)
+    assert ps.upload.data == b""
+
+
+def test_silent_sensor_aborted():
+    p = FakePeripheral(entries=2000, interval=0.001, silent_after=200)
+    ps = connect(p)
+    start = time()
+    ps.upload.receive(count=2000)
+    # the timeout follows the frame interval, not the fixed 2 s used before the first frame
+    assert time() - start < 1.2
+    assert ps.upload.rx_state == ps.upload.RX_ERROR
+    assert ps.upload.stats.timeouts == {'frames': 1}
+    assert ps.upload.data == b""
+
+
+def test_checkpoint_resume(tmp_path):
+    filename = str(tmp_path / 'checkpoints' / 'hist-TEST.part')
+    p = FakePeripheral(entries=4096, disconnect_after=1500, seed=1)
+    checkpoint = TransferCheckpoint(filename)
+    with pytest.raises(BTLEException):
+        connect(p).upload.receive(count=4096, checkpoint=checkpoint)
+    checkpoint.sync()
+    assert checkpoint.records > 0
+    assert checkpoint.unsynced == 0
+
+    # the next attempt continues where the first one stopped
+    checkpoint = TransferCheckpoint(filename)
+    first = checkpoint.first_index()
+    assert first == p.last_index - 4095
+    assert checkpoint.resumable(p.last_index, p.entries)
+    p = FakePeripheral(entries=4096, seed=2)
+    ps = connect(p)
+    ps.upload.receive(index=checkpoint.next_index(), checkpoint=checkpoint)
+    assert ps.upload.raw() == p.buffer(first)
+    assert ps.upload.stats.complete
+
+    checkpoint.clear()
+    assert not os.path.exists(filename)
+    assert not os.path.exists(os.path.dirname(filename))
+
+
+def test_checkpoint_discarded_after_wrap(tmp_path):
+    filename = str(tmp_path / 'hist-TEST.part')
+    p = FakePeripheral(entries=1000, disconnect_after=300)
+    checkpoint = TransferCheckpoint(filename)
+    with pytest.raises(BTLEException):
+        connect(p).upload.receive(count=1000, checkpoint=checkpoint)
+    checkpoint.sync()
+    checkpoint = TransferCheckpoint(filename)
+    assert not checkpoint.resumable(checkpoint.next_index() + 2000, 1000)
+
+
+def test_history_from_bytes_matches_sensor():
+    p = FakePeripheral(entries=500, session=7, period=600)
+    ps = connect(p)
+    ps.upload.receive(count=500)
+    history = History.from_bytes(ps.upload.raw())
+    assert (history.session, history.period, history.last_idx) == (7, 600, p.last_index)
@@ -0,0 +1,158 @@
+import random
+import struct
+from time import time
+
+from pyflowerpower.upload import FrameAssembler, AdaptiveTimeout, UploadStates, receiver_step, \
+    FRAME_PAYLOAD, WINDOW_SIZE
+
+
+def make_frames(size, seed=0):
+    """Return the data of a buffer of size bytes and its frames (frame number, payload)."""
+    rnd = random.Random(seed)
+    data = bytes(bytearray(rnd.randrange(256) for i in range(size)))
+    frames = [(0, struct.pack('<L', size) + b'\0' * (FRAME_PAYLOAD - 4))]
+    for n, pos in enumerate(range(0, size, FRAME_PAYLOAD)):
+        payload = data[pos:pos + FRAME_PAYLOAD]
+        frames.append((n + 1, payload + b'\0' * (FRAME_PAYLOAD - len(payload))))
+    return data, frames
+
+
+def test_complete_transfer():
+    data, frames = make_frames(FRAME_PAYLOAD * 300 + 5)
+    fa = FrameAssembler()
+    for frame, payload in frames:
+        assert fa.add(frame, payload)
+    assert fa.frames_max == 301
+    assert fa.windows() == 3
+    assert fa.frames_complete
+    assert fa.data() == data
+    assert fa.contiguous() == len(data)
+    assert fa.bytes_received() == len(data)
+
+
+def test_lost_frame_blocks_window():
+    data, frames = make_frames(FRAME_PAYLOAD * 300)
+    fa = FrameAssembler()
+    lost = WINDOW_SIZE + 5
+    for frame, payload in frames:
+        if frame != lost:
+            fa.add(frame, payload)
+    assert not fa.frames_complete
+    assert fa.data() == b""
+    # only the first window counts as received in order
+    assert fa.contiguous() == (WINDOW_SIZE - 1) * FRAME_PAYLOAD
+    # the resent window completes the transfer
+    for frame, payload in frames[WINDOW_SIZE:2 * WINDOW_SIZE]:
+        fa.add(frame, payload)
+    assert fa.frames_complete
+    assert fa.data() == data
+    assert fa.duplicates == WINDOW_SIZE - 1
+
+
+def test_window_ready_independent_of_order():
+    data, frames = make_frames(FRAME_PAYLOAD * 200)
+    fa = FrameAssembler()
+    # frame 0 has to come first, it carries the buffer size
+    fa.add(*frames[0])
+    window = frames[1:WINDOW_SIZE]
+    random.Random(1).shuffle(window)
+    for frame, payload in window[:-1]:
+        fa.add(frame, payload)
+        assert not fa.frames_ready
+    fa.add(*window[-1])
+    assert fa.frames_ready
+
+
+def test_duplicate_frames():
+    data, frames = make_frames(FRAME_PAYLOAD * 10)
+    fa = FrameAssembler()
+    for frame, payload in frames + frames[3:6]:
+        fa.add(frame, payload)
+    assert fa.duplicates == 3
+    assert fa.frames_received == len(frames)
+    assert fa.data() == data
+
+
+def test_out_of_range_frames():
+    data, frames = make_frames(FRAME_PAYLOAD * 10)
+    fa = FrameAssembler()
+    # without frame 0, the buffer size is unknown
+    assert not fa.add(1, frames[1][1])
+    assert fa.buffer is None
+    for frame, payload in frames:
+        fa.add(frame, payload)
+    assert not fa.add(len(frames), b'\xff' * FRAME_PAYLOAD)
+    assert not fa.add(0x7fff, b'\xff' * FRAME_PAYLOAD)
+    assert fa.data() == data
+
+
+def test_reset():
+    data, frames = make_frames(FRAME_PAYLOAD * 10)
+    fa = FrameAssembler()
+    for frame, payload in frames:
+        fa.add(frame, payload)
+    fa.reset()
+    assert fa.windows() == 0
+    assert fa.data() == b""
+
+
+def test_receiver_step():
+    data, frames = make_frames(FRAME_PAYLOAD * 200)
+    fa = FrameAssembler()
+    timing = AdaptiveTimeout()
+    assert receiver_step(UploadStates.TX_IDLE, fa, timing) == 'status'
+    assert receiver_step(UploadStates.TX_TRANSFER, fa, timing) == 'frames'
+    for frame, payload in frames[:WINDOW_SIZE - 1]:
+        fa.add(frame, payload)
+    assert receiver_step(UploadStates.TX_WAIT_ACK, fa, timing) == 'nack'
+    fa.add(*frames[WINDOW_SIZE - 1])
+    assert receiver_step(UploadStates.TX_WAIT_ACK, fa, timing) == 'ack'
+    assert receiver_step(7, fa, timing) == 'unknown'
+    for frame, payload in frames:
+        fa.add(frame, payload)
+    assert receiver_step(UploadStates.TX_IDLE, fa, timing) == 'done'
+
+
+def test_receiver_step_deadline():
+    fa = FrameAssembler()
+    timing = AdaptiveTimeout(deadline=time() - 1)
+    for state in [UploadStates.TX_IDLE, UploadStates.TX_TRANSFER, UploadStates.TX_WAIT_ACK]:
+        assert receiver_step(state, fa, timing) == 'deadline'
+    # a complete transfer is finished even after the deadline
+    for frame, payload in make_frames(FRAME_PAYLOAD * 10)[1]:
+        fa.add(frame, payload)
+    assert receiver_step(UploadStates.TX_WAIT_ACK, fa, timing) == 'ack'
+
+
+def test_timeout_initial_and_ceiling():
+    t = AdaptiveTimeout(status=5.0, frames=2.0)
+    assert t.timeout('frames') == 2.0
+    assert t.timeout('status') == 5.0
+    for i in range(20):
+        t.sample('frames', 0.01)
+    # fast links shorten the timeout down to the minimum
+    assert t.timeout('frames') == 0.5
+    assert t.timeout('status') == 5.0
+    for i in range(20):
+        t.sample('status', 20.0)
+    assert t.timeout('status') == 30.0
+
+
+def test_timeout_follows_estimate():
+    t = AdaptiveTimeout()
+    for i in range(50):
+        t.sample('frames', 0.2)
+    assert 0.8 <= t.timeout('frames') < 1.0
+    # jitter widens the timeout
+    for i in range(50):
+        t.sample('frames', 0.1 + 0.2 * (i % 2))
+    assert t.timeout('frames') > 1.0
+
+
+def test_timeout_deadline():
+    t = AdaptiveTimeout(deadline=0.0)
+    assert t.timeout('status') == 0.0
+    assert t.expired()
+    t = AdaptiveTimeout(deadline=time() + 0.2)
+    assert t.timeout('status') <= 0.2
+    assert not t.expired()